@@ -0,0 +1 @@
+"""Copyright 2016 Dana-Farber Cancer Institute"""
@@ -0,0 +1,87 @@
+"""Copyright 2016 Dana-Farber Cancer Institute"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+import tempfile
+import pandas as pd
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from matchengine.frames import read_patient_csv, frame_records, GENOMIC_CATEGORIES
+from matchengine.synthetic import generate_cohort, write_cohort
+
+
+def run_size(n_patients, seed):
+    """
+    Writes a synthetic genomic CSV file and reads it with inferred and with dense column types
+
+    :return: Dictionary with the frame size and read time of both, and the time to build the documents
+    """
+
+    directory = tempfile.mkdtemp()
+    try:
+        clinical, genomic = generate_cohort(n_patients, seed=seed)
+        clinical_path = os.path.join(directory, 'clinical.csv')
+        genomic_path = os.path.join(directory, 'genomic.csv')
+        write_cohort(clinical, genomic, clinical_path, genomic_path)
+        del clinical, genomic
+
+        start = time.time()
+        inferred = pd.read_csv(genomic_path, low_memory=False)
+        inferred_seconds = time.time() - start
+        inferred_mb = inferred.memory_usage(deep=True).sum() / 1e6
+        n_rows = len(inferred.index)
+        del inferred
+
+        start = time.time()
+        dense = read_patient_csv(genomic_path, GENOMIC_CATEGORIES)
+        dense_seconds = time.time() - start
+        dense_mb = dense.memory_usage(deep=True).sum() / 1e6
+
+        start = time.time()
+        for _ in frame_records(dense):
+            pass
+        records_seconds = time.time() - start
+    finally:
+        shutil.rmtree(directory)
+
+    return {
+        'patients': n_patients,
+        'genomic_rows': n_rows,
+        'inferred_mb': round(inferred_mb, 1),
+        'dense_mb': round(dense_mb, 1),
+        'inferred_read_seconds': round(inferred_seconds, 2),
+        'dense_read_seconds': round(dense_seconds, 2),
+        'records_seconds': round(records_seconds, 2)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compares the memory and read time of genomic files read with '
+                                                 'inferred and with dense column types.')
+    parser.add_argument('--sizes', default='1000,10000,100000',
+                        help='Comma separated cohort sizes (patients). Default is 1000,10000,100000.')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed. Default is 0.')
+    parser.add_argument('-o', dest='outpath', default='bench_load.json', help='Path of the JSON results.')
+    args = parser.parse_args()
+
+    results = []
+    for size in args.sizes.split(','):
+        report = run_size(int(size), args.seed)
+        results.append(report)
+        logging.info('%s patients, %d genomic rows: %.1f MB inferred, %.1f MB dense (%.1fx)' % (
+            size, report['genomic_rows'], report['inferred_mb'], report['dense_mb'],
+            report['inferred_mb'] / max(report['dense_mb'], 0.1)))
+
+    with open(args.outpath, 'w') as f:
+        json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='[%(levelname)s] %(asctime)s: %(message)s')
+    main()
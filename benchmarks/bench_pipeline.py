@@ -0,0 +1,118 @@
+"""Copyright 2016 Dana-Farber Cancer Institute"""
+
+import os
+import sys
+import json
+import logging
+import argparse
+import subprocess
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from matchengine.instrument import Instrumentation
+from matchengine.monitor import register_monitor
+from matchengine.synthetic import generate_cohort, generate_trials
+from matchengine.utilities import get_db, create_load_indexes
+
+COLLECTIONS = ['clinical', 'genomic', 'genomic_summary', 'trial', 'trial_match', 'trial_cache', 'map']
+
+
+def _insert(collection, docs, batch=10000):
+    """Inserts documents in batches"""
+    for i in xrange(0, len(docs), batch):
+        collection.insert_many(docs[i:i + batch])
+
+
+def run_size(db, n_patients, n_trials, seed, monitor=None):
+    """
+    Generates a cohort and a set of trials, loads them into a fresh database and runs the full pipeline:
+    matching, sorting, and writing trial matches.
+
+    :return: Dictionary with wall time, peak memory, and query counts per stage
+    """
+
+    # imported here so the engine import is part of what the benchmark process pays for
+    from matchengine.engine import MatchEngine
+    from matchengine.utilities import annotate_genomic, update_ancestry, update_sv_genes
+    from matchengine.summary import update_summary
+
+    stats = Instrumentation(top_n=5)
+
+    with stats.timer('generate'):
+        clinical, genomic = generate_cohort(n_patients, seed=seed)
+        trials = generate_trials(n_trials, seed=seed)
+
+    for name in COLLECTIONS:
+        db.drop_collection(name)
+
+    with stats.timer('load'):
+        _insert(db.clinical, clinical)
+        _insert(db.genomic, [annotate_genomic(item) for item in genomic])
+        update_summary(db, genomic)
+        _insert(db.trial, trials)
+        create_load_indexes(db)
+
+        # the fields load derives after inserting, which the engine uses when every document has them
+        update_ancestry(db)
+        update_sv_genes(db)
+
+    del clinical, genomic, trials
+
+    with stats.timer('match'):
+        me = MatchEngine(db, stats=stats)
+        me.find_trial_matches()
+
+    report = stats.report()
+    report['patients'] = n_patients
+    report['trials'] = n_trials
+    report['genomic_documents'] = db.genomic.count()
+    report['leaf_queries'] = sum(s['calls'] for k, s in stats.stages.iteritems() if k.startswith('leaf.'))
+    if monitor is not None:
+        report['mongo'] = monitor.report()['operations']
+
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Runs the matching pipeline against synthetic cohorts of '
+                                                 'increasing size and records time, queries, and memory per stage.')
+    parser.add_argument('--sizes', default='1000,10000,100000',
+                        help='Comma separated cohort sizes (patients). Default is 1000,10000,100000.')
+    parser.add_argument('--trials', type=int, default=200, help='Number of synthetic trials. Default is 200.')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed. Default is 0.')
+    parser.add_argument('--mongo-uri', dest='mongo_uri', default=os.getenv('MONGO_URI', 'mongodb://localhost:27017'),
+                        help='MongoDB to benchmark against, or memory:// for the in-memory database. Defaults to '
+                             '$MONGO_URI.')
+    parser.add_argument('--database', default='matchminer_benchmark',
+                        help='Database to load the synthetic data into. It is dropped and reloaded for every size.')
+    parser.add_argument('-o', dest='outpath', default='bench_pipeline.json', help='Path of the JSON results.')
+    parser.add_argument('--single', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    # every size runs in its own process so peak memory is measured per size
+    if args.single:
+        monitor = register_monitor()
+        db = get_db(args.mongo_uri, name=args.database)
+        report = run_size(db, int(args.sizes), args.trials, args.seed, monitor=monitor)
+        json.dump(report, sys.stdout, default=str)
+        return
+
+    results = []
+    for size in args.sizes.split(','):
+        logging.info('Benchmarking %s patients and %d trials' % (size, args.trials))
+        out = subprocess.check_output([
+            sys.executable, os.path.abspath(__file__), '--single', '--sizes', size, '--trials', str(args.trials),
+            '--seed', str(args.seed), '--mongo-uri', args.mongo_uri, '--database', args.database
+        ])
+        report = json.loads(out)
+        results.append(report)
+        logging.info('%s patients: %.1fs, %d leaf queries, %.0f MB peak' % (
+            size, report['wall_seconds'], report['leaf_queries'], report['peak_rss_mb']))
+
+    with open(args.outpath, 'w') as f:
+        json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='[%(levelname)s] %(asctime)s: %(message)s')
+    main()
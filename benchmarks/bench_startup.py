@@ -0,0 +1,90 @@
+"""Copyright 2016 Dana-Farber Cancer Institute"""
+
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import subprocess
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+SCRIPT = os.path.join(ROOT, 'matchengine.py')
+
+# subcommands that should start without loading the engine or pandas; an idle worker polls an empty queue
+LIGHT_COMMANDS = [
+    ['--help'],
+    ['load', '--help'],
+    ['match', '--help'],
+    ['coordinate', '--help'],
+    ['work', '--help'],
+    ['work', '--exit-when-idle', '--mongo-uri', 'memory://'],
+]
+
+# modules timed on their own, in a fresh interpreter each, as "python -X importtime" would in Python 3
+MODULES = ['matchengine.utilities', 'matchengine.shard', 'matchengine.engine', 'pymongo', 'pandas', 'networkx',
+           'yaml', 'cerberus1']
+
+
+def _median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def time_process(cmd, repeat):
+    """
+    Runs a command in a fresh interpreter several times
+
+    :param cmd: Argument list
+    :param repeat: Number of runs
+    :return: Median wall time in milliseconds
+    """
+
+    seconds = []
+    with open(os.devnull, 'w') as devnull:
+        for _ in range(repeat):
+            start = time.time()
+            subprocess.check_call(cmd, cwd=ROOT, stdout=devnull, stderr=devnull)
+            seconds.append(time.time() - start)
+    return round(_median(seconds) * 1000, 1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Times the cold start of the lightweight subcommands and the '
+                                                 'import of the heavy modules, each in a fresh interpreter.')
+    parser.add_argument('--repeat', type=int, default=5, help='Runs per command; the median is kept. Default is 5.')
+    parser.add_argument('--budget', type=float, default=200,
+                        help='Milliseconds a lightweight subcommand may take to start. Default is 200.')
+    parser.add_argument('-o', dest='outpath', default='bench_startup.json', help='Path of the JSON results.')
+    args = parser.parse_args()
+
+    interpreter = time_process([sys.executable, '-c', 'pass'], args.repeat)
+    logging.info('%-60s %8.1f ms' % ('python', interpreter))
+
+    commands = []
+    for argv in LIGHT_COMMANDS:
+        ms = time_process([sys.executable, SCRIPT] + argv, args.repeat)
+        commands.append({'command': ' '.join(argv), 'ms': ms, 'over_budget': ms > args.budget})
+        logging.info('%-60s %8.1f ms%s' % (' '.join(argv), ms, ' (over budget)' if ms > args.budget else ''))
+
+    modules = []
+    for module in MODULES:
+        try:
+            ms = time_process([sys.executable, '-c', 'import %s' % module], args.repeat)
+        except subprocess.CalledProcessError:
+            logging.info('%-60s not importable' % module)
+            continue
+        modules.append({'module': module, 'ms': ms})
+        logging.info('%-60s %8.1f ms' % ('import %s' % module, ms))
+
+    with open(args.outpath, 'w') as f:
+        json.dump({'interpreter_ms': interpreter, 'budget_ms': args.budget, 'commands': commands,
+                   'modules': modules}, f, indent=2)
+
+    if any(command['over_budget'] for command in commands):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='[%(levelname)s] %(asctime)s: %(message)s')
+    main()
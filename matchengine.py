@@ -3,18 +3,17 @@
 import os
 import sys
 import json
-import time
-import yaml
 import logging
 import argparse
 import subprocess
-import pandas as pd
 import datetime as dt
-from pymongo import ASCENDING
 
-from matchengine.engine import MatchEngine
+from matchengine.settings import TRIAL_UPDATED
 from matchengine.utilities import get_db
 
+# Every subcommand imports the modules it needs when it runs, so that the engine, pandas, and the other heavy
+# dependencies are only loaded by the subcommands that use them. See benchmarks/bench_startup.py.
+
 MONGO_URI = ""
 MONGO_DBNAME = "matchminer"
 MATCH_FIELDS = "mrn,sample_id,first_last,protocol_no,nct_id,genomic_alteration,tier,match_type," \
@@ -95,14 +94,17 @@ class Patient:
         self.genomic_df = None
 
     def load_csv(self, clinical, genomic):
-        """Load CSV file into a Pandas dataframe"""
-        self.clinical_df = pd.read_csv(clinical)
-        self.genomic_df = pd.read_csv(genomic, low_memory=False)
+        """Load CSV file into a Pandas dataframe with dense column types"""
+        from matchengine.frames import read_patient_csv, CLINICAL_CATEGORIES, GENOMIC_CATEGORIES
+        self.clinical_df = read_patient_csv(clinical, CLINICAL_CATEGORIES)
+        self.genomic_df = read_patient_csv(genomic, GENOMIC_CATEGORIES)
 
     def load_pkl(self, clinical, genomic):
-        """Load PKL file into a Pandas dataframe"""
-        self.clinical_df = pd.read_pickle(clinical)
-        self.genomic_df = pd.read_pickle(genomic)
+        """Load PKL file into a Pandas dataframe with dense column types"""
+        import pandas as pd
+        from matchengine.frames import densify, CLINICAL_CATEGORIES, GENOMIC_CATEGORIES
+        self.clinical_df = densify(pd.read_pickle(clinical), CLINICAL_CATEGORIES)
+        self.genomic_df = densify(pd.read_pickle(genomic), GENOMIC_CATEGORIES)
 
     @staticmethod
     def load_bson(clinical, genomic):
@@ -154,6 +156,10 @@ def load(args):
     :param args: trials: Path to bson trial file.
     """
 
+    from matchengine.utilities import annotate_genomic, update_ancestry, update_sv_genes, create_load_indexes
+    from matchengine.summary import summary_key, refresh_summary, summary_is_current, rebuild_summary
+    from matchengine.frames import frame_records
+
     db = get_db(args.mongo_uri)
     t = Trial(db)
     p = Patient(db)
@@ -181,49 +187,59 @@ def load(args):
                         print '##         ## trial age restrictions properly.'
                         print '##         ## System error: \n%s' % exc
 
-            p.genomic_df['TRUE_TRANSCRIPT_EXON'] = p.genomic_df['TRUE_TRANSCRIPT_EXON'].apply(
-                lambda x: int(x) if x != '' and pd.notnull(x) else x)
-
             # Add clinical data to mongo
             logging.info('Adding clinical data to mongo...')
-            clinical_json = json.loads(p.clinical_df.T.to_json()).values()
-            for item in clinical_json:
-                for col in ['BIRTH_DATE', 'REPORT_DATE']:
-                    if col in item:
-                        item[col] = dt.datetime.strptime(str(item[col]), '%Y-%m-%d %X')
+            for clinical_json in frame_records(p.clinical_df):
+                for item in clinical_json:
+                    for col in ['BIRTH_DATE', 'REPORT_DATE']:
+                        if col in item:
+                            item[col] = dt.datetime.strptime(str(item[col]), '%Y-%m-%d %X')
 
-            db.clinical.insert(clinical_json)
+                db.clinical.insert(clinical_json)
 
             # Get clinical ids from mongo
             logging.info('Adding clinical ids to genomic data...')
             clinical_doc = list(db.clinical.find({}, {"_id": 1, "SAMPLE_ID": 1}))
             clinical_dict = dict(zip([i['SAMPLE_ID'] for i in clinical_doc], [i['_id'] for i in clinical_doc]))
 
-            # pd -> json
-            if args.trial_format == 'pkl':
-                genomic_json = json.loads(p.genomic_df.to_json(orient='records'))
-            else:
-                genomic_json = json.loads(p.genomic_df.T.to_json()).values()
+            # Add genomic data to mongo a chunk at a time, with the clinical ids and the fields derived for
+            # indexed matching
+            logging.info('Adding genomic data to mongo...')
+            keys = set()
+            for genomic_json in frame_records(p.genomic_df):
+                for item in genomic_json:
+                    item["CLINICAL_ID"] = clinical_dict.get(item['SAMPLE_ID'])
+                    annotate_genomic(item)
 
-            # Map clinical ids to genomic data
-            for item in genomic_json:
-                if item['SAMPLE_ID'] in clinical_dict:
-                    item["CLINICAL_ID"] = clinical_dict[item['SAMPLE_ID']]
-                else:
-                    item["CLINICAL_ID"] = None
+                db.genomic.insert(genomic_json)
+                keys.update(summary_key(item) for item in genomic_json)
 
-            # Add genomic data to mongo
-            logging.info('Adding genomic data to mongo...')
-            db.genomic.insert(genomic_json)
+            logging.info('Updating %d genomic summary documents' % len(keys))
+            refresh_summary(db, keys)
 
         # Create index
         logging.info('Creating index...')
-        db.genomic.create_index([("TRUE_HUGO_SYMBOL", ASCENDING), ("WILDTYPE", ASCENDING)])
+        create_load_indexes(db)
 
     elif args.clinical and not args.genomic or args.genomic and not args.clinical:
         logging.error('If loading patient information, please provide both clinical and genomic data.')
         sys.exit(1)
 
+    # store the oncotree ancestry of new clinical documents, including those loaded by other means
+    n = update_ancestry(db)
+    if n:
+        logging.info('Added the oncotree ancestry to %d clinical documents' % n)
+
+    # and the structural variant gene tokens of genomic documents, which structural variant criteria search
+    n = update_sv_genes(db)
+    if n:
+        logging.info('Added the structural variant gene tokens to %d genomic documents' % n)
+
+    # the genomic summary misses documents loaded, edited or removed by other means, e.g. restored from BSON
+    if not summary_is_current(db):
+        logging.info('Rebuilding the genomic summary...')
+        rebuild_summary(db)
+
 
 def add_trial(yml, db):
     """
@@ -233,13 +249,34 @@ def add_trial(yml, db):
     :param db: MongoDB connection
     """
 
+    import yaml
+
     with open(yml) as f:
         t = yaml.load(f.read())
+        t.setdefault(TRIAL_UPDATED, dt.datetime.utcnow())
         db.trial.insert_one(t)
 
 
 def export_results(connection_string, file_format, outpath):
     """Return csv file containing the match results to the current working directory"""
+
+    # in-memory databases have no server for mongoexport to connect to
+    connection_string = connection_string or os.getenv('MONGO_URI')
+    if connection_string and connection_string.startswith('memory://'):
+        fields = MATCH_FIELDS.split(',')
+        matches = list(get_db(connection_string).trial_match.find({}, fields))
+        if file_format == 'json':
+            from bson import json_util
+            with open('%s.json' % outpath, 'w') as f:
+                for match in matches:
+                    f.write(json.dumps(match, default=json_util.default) + '\n')
+        else:
+            import pandas as pd
+            df = pd.DataFrame(matches, columns=fields)
+            df['_id'] = df['_id'].apply(str)
+            df.to_csv('%s.csv' % outpath, index=False, encoding='utf-8')
+        return
+
     cmd = "mongoexport --uri {3} -c trial_match --fields {0} " \
           "--type {1} --out {2}.{1}".format(MATCH_FIELDS, file_format, outpath, connection_string)
     subprocess.call(cmd.split(' '))
@@ -249,40 +286,281 @@ def match(args):
     """
     Matches all trials in database to patients
 
-    :param daemon: Boolean flag; when true, runs the matchengine once per 24 hours.
+    :param daemon: Boolean flag; when true, keeps running and matches trials and patients as they change.
+    :param profile: Path of a JSON report with stage timings and the slowest trials and leaf queries.
+    :param monitor: Path of a JSON report with Mongo query counts and latencies per collection.
+    :param debounce: Seconds without changes before the daemon matches pending changes.
+    :param max_staleness: Maximum seconds a change waits to be matched by the daemon.
+    :param quiet_hours: Hours of the day, e.g. "2-5", in which the daemon runs its daily full match.
+    :param poll_interval: Seconds between checks for changes.
+    :param counts_only: Boolean flag; when true, only counts the samples and patients matched per trial segment
+        and gene into the trial_match_counts collection.
+    :param resume: Id of a full match run that died, to resume from its last matched trial.
+    :param partition_size: Match full runs this many samples at a time, writing the matches of every partition
+        as it is done.
+    :param max_time_ms: Time limit of every leaf query in milliseconds.
+    :param trial_budget: Seconds a trial may take before it is deferred to the retry pass at the end of the run.
+    :param retry_factor: How many times larger the time limits of the retry pass are. No retry pass if 0.
     """
 
+    from matchengine.engine import MatchEngine
+    from matchengine.instrument import Instrumentation
+    from matchengine.monitor import register_monitor
+    from matchengine.runs import MatchRun, unfinished_runs, expire_runs
+
+    # the command listener has to be registered before connecting
+    monitor = register_monitor() if args.monitor else None
+
     db = get_db(args.mongo_uri)
 
-    while True:
-        me = MatchEngine(db)
-        me.find_trial_matches()
-
-        # exit if it is not set to run as a nightly automated daemon, otherwise sleep for a day
-        if not args.daemon:
-
-            # choose output file format
-            if args.json_format:
-                file_format = 'json'
-            elif args.outpath and len(args.outpath.split('.')) > 1:
-                file_format = args.outpath.split('.')[-1]
-                if file_format not in ['json', 'csv']:
-                    file_format = 'csv'
-            else:
-                file_format = 'csv'
-
-            # choose output path
-            if args.outpath:
-                outpath = args.outpath.split('.')[0]
-            else:
-                outpath = './results'
-
-            # export results
-            export_results(args.mongo_uri, file_format, outpath)
-
-            break
+    # staged matches of runs abandoned long ago are removed
+    expire_runs(db)
+
+    # only the first full run resumes
+    resume = [args.resume]
+    if not args.resume and not args.counts_only:
+        for manifest in unfinished_runs(db):
+            logging.info('Match run %s did not finish; resume it with --resume %s' % (manifest['_id'], manifest['_id']))
+
+    # time limits of the matching runs
+    limits = {'max_time_ms': args.max_time_ms, 'trial_budget': args.trial_budget, 'retry_factor': args.retry_factor}
+
+    def run(protocol_nos=None, sample_ids=None):
+        stats = Instrumentation(enabled=bool(args.profile), top_n=args.profile_top)
+        if args.counts_only:
+            MatchEngine(db, stats=stats).count_trial_matches()
+        elif protocol_nos is None and sample_ids is None and args.partition_size:
+            MatchEngine(db, stats=stats, **limits).find_partitioned_matches(args.partition_size)
+        elif protocol_nos is None and sample_ids is None:
+
+            # full runs are checkpointed per trial
+            try:
+                checkpoint = MatchRun(db, run_id=resume.pop() if resume else None)
+            except ValueError as e:
+                logging.error(str(e))
+                sys.exit(1)
+            MatchEngine(db, stats=stats, **limits).find_trial_matches(run=checkpoint)
         else:
-            time.sleep(86400)   # sleep for 24 hours
+            me = MatchEngine(db, stats=stats, sample_ids=sample_ids, **limits)
+            me.find_trial_matches(protocol_nos=protocol_nos)
+
+        if args.profile:
+            stats.write(args.profile)
+
+        if monitor is not None:
+            monitor.write(args.monitor)
+
+    # keep matching changes as they arrive
+    if args.daemon:
+        from matchengine.scheduler import ChangeWatcher, MatchScheduler
+
+        quiet_hours = None
+        if args.quiet_hours:
+            quiet_hours = tuple(int(h) for h in args.quiet_hours.split('-'))
+
+        watcher = ChangeWatcher(db)
+        scheduler = MatchScheduler(watcher, run, debounce=args.debounce, max_staleness=args.max_staleness,
+                                   quiet_hours=quiet_hours, poll_interval=args.poll_interval)
+        scheduler.run_forever()
+        return
+
+    run()
+    if args.counts_only:
+        return
+
+    # choose output file format
+    if args.json_format:
+        file_format = 'json'
+    elif args.outpath and len(args.outpath.split('.')) > 1:
+        file_format = args.outpath.split('.')[-1]
+        if file_format not in ['json', 'csv']:
+            file_format = 'csv'
+    else:
+        file_format = 'csv'
+
+    # choose output path
+    if args.outpath:
+        outpath = args.outpath.split('.')[0]
+    else:
+        outpath = './results'
+
+    # export results
+    export_results(args.mongo_uri, file_format, outpath)
+
+
+def indexes(args):
+    """
+    Proposes the indexes that serve the leaf queries of every trial in the database and optionally creates them.
+
+    :param create: Boolean flag; when true, creates the proposed indexes and compares the documents examined per
+        query shape before and after.
+    :param max_indexes: Maximum number of indexes proposed per collection.
+    """
+
+    from matchengine.indexes import IndexAdvisor, format_proposals, format_explains
+
+    db = get_db(args.mongo_uri)
+    advisor = IndexAdvisor(db, max_indexes=args.max_indexes)
+    advisor.collect()
+
+    proposals = advisor.propose()
+    print format_proposals(proposals)
+
+    before = advisor.explain()
+    after = None
+    if args.create:
+        advisor.create(proposals)
+        after = advisor.explain()
+
+    print
+    print format_explains(before, after)
+
+
+def explain(args):
+    """
+    Prints the compiled match trees of a trial, or of every trial, with the Mongo query of each leaf and how
+    Mongo executed it. Leaves that scan a whole collection are highlighted.
+
+    :param protocol_no: Protocol number of the trial to explain. Every trial if not given.
+    :param outpath: Path of a JSON file with the full explanation.
+    """
+
+    from bson import json_util
+    from matchengine.engine import MatchEngine
+    from matchengine.explain import explain_trial, format_trial, format_run
+
+    db = get_db(args.mongo_uri)
+    me = MatchEngine(db)
+
+    query = {'protocol_no': args.protocol_no} if args.protocol_no else {}
+    trials = list(db.trial.find(query, {'protocol_no': 1, 'treatment_list': 1}))
+    if not trials:
+        logging.error('No trial found with protocol number %s' % args.protocol_no)
+        sys.exit(1)
+
+    explained = [(trial['protocol_no'], explain_trial(me, trial)) for trial in trials]
+
+    if args.protocol_no:
+        for protocol_no, segments in explained:
+            print format_trial(protocol_no, segments)
+    else:
+        print format_run(explained)
+
+    if args.outpath:
+        with open(args.outpath, 'w') as f:
+            json.dump([{'protocol_no': p, 'segments': s} for p, s in explained], f, indent=2,
+                      default=json_util.default)
+
+
+def simulate(args):
+    """
+    Prints how many samples and patients every step, arm, and dose level of a draft trial would match, without
+    storing the trial or its matches.
+
+    :param trial: Path to the trial file, in YML or JSON.
+    :param samples: Boolean flag; when true, also prints the matched sample ids.
+    :param outpath: Path of a JSON file with the full result.
+    """
+
+    from bson import json_util
+    from matchengine.engine import MatchEngine
+
+    db = get_db(args.mongo_uri)
+    me = MatchEngine(db)
+
+    with open(args.trial) as f:
+        result = me.simulate_trial(f.read())
+
+    if result['errors']:
+        logging.error('Invalid trial %s: %s' % (args.trial, result['errors']))
+        sys.exit(1)
+
+    print '%-6s %-12s %-8s %-8s %10s %10s' % ('level', 'internal_id', 'code', 'status', 'samples', 'patients')
+    for segment in result['segments']:
+        print '%-6s %-12s %-8s %-8s %10d %10d' % (
+            segment['match_level'], segment['internal_id'], segment['code'], segment['trial_accrual_status'],
+            segment['n_samples'], segment['n_patients'])
+        if args.samples:
+            print '       %s' % ', '.join(segment['sample_ids'])
+    print 'Trial %s: %d samples, %d patients' % (result['protocol_no'], result['n_samples'], result['n_patients'])
+
+    if args.outpath:
+        with open(args.outpath, 'w') as f:
+            json.dump(result, f, indent=2, default=json_util.default)
+
+
+def serve(args):
+    """
+    Keeps the patients and compiled trials in memory and answers match requests over HTTP on localhost
+
+    :param host: Interface to listen on.
+    :param port: Port to listen on.
+    """
+
+    from matchengine.service import MatchService, serve as serve_matches
+
+    db = get_db(args.mongo_uri)
+    serve_matches(MatchService(db), host=args.host, port=args.port)
+
+
+def coordinate(args):
+    """
+    Runs a full match split into shards matched by workers, then sorts and publishes the matches of every shard
+    together. Workers on other hosts can join with the work command.
+
+    :param by: "trial" to shard by protocol number or "sample" to shard by sample id range.
+    :param shards: Number of shards.
+    :param workers: Number of local worker processes to start. Shards are matched in this process if 0.
+    :param resume: Id of a sharded run whose coordinator died.
+    """
+
+    from matchengine.runs import expire_runs
+    from matchengine.shard import Coordinator, Worker
+
+    db = get_db(args.mongo_uri)
+    expire_runs(db)
+    try:
+        coordinator = Coordinator(db, by=args.by, n_shards=args.shards, run_id=args.resume)
+    except ValueError as e:
+        logging.error(str(e))
+        sys.exit(1)
+    coordinator.enqueue()
+
+    # the in-memory database is private to this process
+    n_workers = args.workers
+    if n_workers and os.environ.get('MONGO_URI', '').startswith('memory://'):
+        logging.info('Matching shards in the coordinator, since workers cannot share an in-memory database')
+        n_workers = 0
+
+    cmd = [sys.executable, os.path.abspath(__file__), 'work', '--exit-when-idle']
+    if args.mongo_uri:
+        cmd += ['--mongo-uri', args.mongo_uri]
+    workers = [subprocess.Popen(cmd) for _ in range(n_workers)]
+
+    try:
+        coordinator.wait(poll=args.poll_interval, worker=None if workers else Worker(db))
+    except RuntimeError as e:
+        logging.error(str(e))
+        sys.exit(1)
+    finally:
+        for worker in workers:
+            worker.wait()
+
+    coordinator.publish()
+
+
+def work(args):
+    """
+    Matches shards queued by coordinators
+
+    :param exit_when_idle: Boolean flag; when true, exits once no shard is pending or running.
+    """
+
+    from matchengine.shard import Worker
+
+    db = get_db(args.mongo_uri)
+    Worker(db).run(poll=args.poll_interval, exit_when_idle=args.exit_when_idle)
+
 
 if __name__ == '__main__':
 
@@ -291,7 +569,23 @@ if __name__ == '__main__':
     param_mongo_uri_help = 'Your MongoDB URI. If you do not supply one it will default to whatever is set to ' \
                            '"MONGO_URI" in your secrets file. ' \
                            'See https://docs.mongodb.com/manual/reference/connection-string/ for more information.'
-    param_daemon_help = 'Set to launch the matchengine as a nightly automated process'
+    param_daemon_help = 'Set to keep the matchengine running and match trials and patients as they change'
+    param_counts_only_help = 'Only count the samples and patients matched per trial segment and gene into the ' \
+                             '"trial_match_counts" collection. Trial matches are neither built nor exported.'
+    param_resume_help = 'Id of a match run that did not finish. Trials it already matched are not matched again.'
+    param_partition_size_help = 'Match this many samples at a time against every trial to bound memory. ' \
+                                'Matches are written per partition and the run is not checkpointed.'
+    param_max_time_ms_help = 'Time limit of every leaf query in milliseconds. A trial whose query runs over it is ' \
+                             'deferred to the retry pass. No limit by default.'
+    param_trial_budget_help = 'Seconds a trial may take to match. Trials over budget are deferred while the others ' \
+                              'are matched, and listed in the run manifest if the retry pass cannot match them ' \
+                              'either. No budget by default.'
+    param_retry_factor_help = 'How many times larger the time limits of the retry pass of deferred trials are. ' \
+                              'Set to 0 to skip the retry pass. Default is 4.'
+    param_debounce_help = 'Seconds without changes before the daemon matches pending changes. Default is 60.'
+    param_max_staleness_help = 'Maximum seconds a change waits to be matched by the daemon. Default is 900.'
+    param_quiet_hours_help = 'Hours of the day in which the daemon runs its daily full match. Default is 2-5.'
+    param_poll_interval_help = 'Seconds between checks for changes by the daemon. Default is 10.'
     param_clinical_help = 'Path to your clinical file. Default expected format is CSV.'
     param_genomic_help = 'Path to your genomic file. Default expected format is CSV'
     param_json_help = 'Set this flag to export your results in a .json file.'
@@ -299,6 +593,26 @@ if __name__ == '__main__':
     param_outpath_help = 'Destination and name of your results file.'
     param_trial_format_help = 'File format of input trial data. Default is YML.'
     param_patient_format_help = 'File format of input patient data (both clinical and genomic files). Default is CSV.'
+    param_profile_help = 'Time each stage of matching and write a JSON report of the slowest trials and leaf ' \
+                         'queries to this path.'
+    param_profile_top_help = 'Number of slowest trials and leaf queries to keep in the profile report. Default is 10.'
+    param_monitor_help = 'Record every Mongo command and write a JSON report of counts, latency percentiles, ' \
+                         'documents and bytes returned per collection, and the slowest query shapes to this path.'
+    param_create_help = 'Create the proposed indexes and report documents examined per query shape before and after.'
+    param_max_indexes_help = 'Maximum number of indexes proposed per collection. Default is 8.'
+    param_protocol_no_help = 'Protocol number of the trial to explain. Explains every trial if not given.'
+    param_explain_out_help = 'Write the full explanation as JSON to this path.'
+    param_host_help = 'Interface the match service listens on. Default is 127.0.0.1.'
+    param_simulate_trial_help = 'Path to the draft trial, in YML or JSON.'
+    param_simulate_samples_help = 'Set this flag to also print the sample ids each segment matches.'
+    param_simulate_out_help = 'Write the per segment counts, sample ids, and MRNs as JSON to this path.'
+    param_port_help = 'Port the match service listens on. Default is 8765.'
+    param_shard_by_help = 'Shard the run by "trial" or by "sample" id range. Default is trial.'
+    param_shards_help = 'Number of shards. Default is 8.'
+    param_workers_help = 'Number of local worker processes. Shards are matched by the coordinator if 0. Default is 4.'
+    param_coordinate_resume_help = 'Id of a sharded run whose coordinator did not finish.'
+    param_exit_when_idle_help = 'Set this flag to exit once no shard is waiting to be matched.'
+    param_shard_poll_help = 'Seconds between checks of the shard queue. Default is 5.'
 
     # mode parser.
     main_p = argparse.ArgumentParser()
@@ -331,8 +645,85 @@ if __name__ == '__main__':
     subp_p.add_argument('--json', dest="json_format", required=False, action="store_true", help=param_json_help)
     subp_p.add_argument('--csv', dest="csv_format", required=False, action="store_true", help=param_csv_help)
     subp_p.add_argument('-o', dest="outpath", required=False, help=param_outpath_help)
+    subp_p.add_argument('--profile', dest="profile", required=False, default=None, help=param_profile_help)
+    subp_p.add_argument('--profile-top', dest="profile_top", required=False, type=int, default=10,
+                        help=param_profile_top_help)
+    subp_p.add_argument('--monitor', dest="monitor", required=False, default=None, help=param_monitor_help)
+    subp_p.add_argument('--counts-only', dest="counts_only", required=False, action="store_true",
+                        help=param_counts_only_help)
+    subp_p.add_argument('--resume', dest="resume", required=False, default=None, help=param_resume_help)
+    subp_p.add_argument('--partition-size', dest="partition_size", required=False, type=int, default=None,
+                        help=param_partition_size_help)
+    subp_p.add_argument('--max-time-ms', dest="max_time_ms", required=False, type=int, default=None,
+                        help=param_max_time_ms_help)
+    subp_p.add_argument('--trial-budget', dest="trial_budget", required=False, type=float, default=None,
+                        help=param_trial_budget_help)
+    subp_p.add_argument('--retry-factor', dest="retry_factor", required=False, type=float, default=4,
+                        help=param_retry_factor_help)
+    subp_p.add_argument('--debounce', dest="debounce", required=False, type=int, default=60,
+                        help=param_debounce_help)
+    subp_p.add_argument('--max-staleness', dest="max_staleness", required=False, type=int, default=900,
+                        help=param_max_staleness_help)
+    subp_p.add_argument('--quiet-hours', dest="quiet_hours", required=False, default='2-5',
+                        help=param_quiet_hours_help)
+    subp_p.add_argument('--poll-interval', dest="poll_interval", required=False, type=int, default=10,
+                        help=param_poll_interval_help)
     subp_p.set_defaults(func=match)
 
+    # indexes
+    subp_p = subp.add_parser('indexes', help='Proposes indexes for the trial criteria in the database.')
+    subp_p.add_argument('--mongo-uri', dest='mongo_uri', required=False, default=None, help=param_mongo_uri_help)
+    subp_p.add_argument('--create', dest="create", required=False, action="store_true", help=param_create_help)
+    subp_p.add_argument('--max-indexes', dest="max_indexes", required=False, type=int, default=8,
+                        help=param_max_indexes_help)
+    subp_p.set_defaults(func=indexes)
+
+    # explain
+    subp_p = subp.add_parser('explain', help='Shows the queries of each match tree leaf and how Mongo runs them.')
+    subp_p.add_argument('--mongo-uri', dest='mongo_uri', required=False, default=None, help=param_mongo_uri_help)
+    subp_p.add_argument('--protocol-no', dest="protocol_no", required=False, default=None,
+                        help=param_protocol_no_help)
+    subp_p.add_argument('-o', dest="outpath", required=False, default=None, help=param_explain_out_help)
+    subp_p.set_defaults(func=explain)
+
+    # simulate
+    subp_p = subp.add_parser('simulate', help='Counts the patients a draft trial would match without storing it.')
+    subp_p.add_argument('trial', help=param_simulate_trial_help)
+    subp_p.add_argument('--mongo-uri', dest='mongo_uri', required=False, default=None, help=param_mongo_uri_help)
+    subp_p.add_argument('--samples', dest="samples", required=False, action="store_true",
+                        help=param_simulate_samples_help)
+    subp_p.add_argument('-o', dest="outpath", required=False, default=None, help=param_simulate_out_help)
+    subp_p.set_defaults(func=simulate)
+
+    # serve
+    subp_p = subp.add_parser('serve', help='Answers match requests over HTTP with patients and trials in memory.')
+    subp_p.add_argument('--mongo-uri', dest='mongo_uri', required=False, default=None, help=param_mongo_uri_help)
+    subp_p.add_argument('--host', dest="host", required=False, default='127.0.0.1', help=param_host_help)
+    subp_p.add_argument('--port', dest="port", required=False, type=int, default=8765, help=param_port_help)
+    subp_p.set_defaults(func=serve)
+
+    # coordinate
+    subp_p = subp.add_parser('coordinate', help='Matches all trials in shards spread over worker processes.')
+    subp_p.add_argument('--mongo-uri', dest='mongo_uri', required=False, default=None, help=param_mongo_uri_help)
+    subp_p.add_argument('--by', dest="by", required=False, default='trial', choices=['trial', 'sample'],
+                        help=param_shard_by_help)
+    subp_p.add_argument('--shards', dest="shards", required=False, type=int, default=8, help=param_shards_help)
+    subp_p.add_argument('--workers', dest="workers", required=False, type=int, default=4, help=param_workers_help)
+    subp_p.add_argument('--resume', dest="resume", required=False, default=None,
+                        help=param_coordinate_resume_help)
+    subp_p.add_argument('--poll-interval', dest="poll_interval", required=False, type=int, default=5,
+                        help=param_shard_poll_help)
+    subp_p.set_defaults(func=coordinate)
+
+    # work
+    subp_p = subp.add_parser('work', help='Matches shards queued by the coordinate command.')
+    subp_p.add_argument('--mongo-uri', dest='mongo_uri', required=False, default=None, help=param_mongo_uri_help)
+    subp_p.add_argument('--exit-when-idle', dest="exit_when_idle", required=False, action="store_true",
+                        help=param_exit_when_idle_help)
+    subp_p.add_argument('--poll-interval', dest="poll_interval", required=False, type=int, default=5,
+                        help=param_shard_poll_help)
+    subp_p.set_defaults(func=work)
+
     # parse args.
     args = main_p.parse_args()
     args.func(args)
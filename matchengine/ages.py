@@ -0,0 +1,92 @@
+"""Copyright 2016 Dana-Farber Cancer Institute"""
+
+import numpy as np
+import datetime as dt
+
+from matchengine.utilities import search_birth_date
+
+_EPOCH = dt.datetime(1970, 1, 1)
+
+# comparison of a birth date to the cutoff of an age restriction, by Mongo operator
+_COMPARISONS = {
+    '$lte': np.less_equal,
+    '$lt': np.less,
+    '$gte': np.greater_equal,
+    '$gt': np.greater
+}
+
+
+def _ordinal(date):
+    """Microseconds between the epoch and a date"""
+    delta = date - _EPOCH
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+
+class AgeCriteria(object):
+    """
+    Translates age restrictions such as ">=18" or "<0.5" into birth date ranges as of one date. Every leaf of a
+    run is compared to the same cutoff, and each age expression is translated once.
+
+    :param as_of: Date ages are computed at. Defaults to now, which moves forward on every refresh.
+    """
+
+    def __init__(self, as_of=None):
+        self.fixed = as_of is not None
+        self.as_of = as_of or dt.datetime.today()
+        self.cutoffs = {}
+
+    def refresh(self):
+        """
+        Moves the date ages are computed at to now and forgets the cutoffs of the previous date, unless a date was
+        given. Called at the start of every run or request, so an engine kept between them does not match ages
+        as of the day it was created.
+        """
+        if not self.fixed:
+            self.as_of = dt.datetime.today()
+            self.cutoffs = {}
+
+    def condition(self, txt):
+        """
+        Returns the birth date range of an age restriction
+
+        :param txt: Age restriction, e.g. ">=18"
+        :return: Mongo condition on BIRTH_DATE, e.g. {'$lte': <date 18 years before the as of date>}
+        """
+        if txt not in self.cutoffs:
+            self.cutoffs[txt] = search_birth_date({'BIRTH_DATE': {'$eq': txt}}, today=self.as_of)
+        return self.cutoffs[txt]
+
+
+class BirthDateIndex(object):
+    """
+    Birth dates of every clinical document as an array of ordinals, so an age restriction is evaluated as one
+    vectorized comparison instead of a scan of the documents. Used with the in-memory database, where a query
+    is a scan. Documents without a birth date, or with one that is not a date, match no age restriction, as in
+    Mongo.
+
+    :param db: Database connection
+    """
+
+    def __init__(self, db):
+        sample_ids = []
+        ordinals = []
+        for doc in db.clinical.find({}, {'SAMPLE_ID': 1, 'BIRTH_DATE': 1}):
+            if isinstance(doc.get('BIRTH_DATE'), dt.datetime):
+                sample_ids.append(doc.get('SAMPLE_ID'))
+                ordinals.append(_ordinal(doc['BIRTH_DATE']))
+
+        self.sample_ids = np.array(sample_ids, dtype=object)
+        self.ordinals = np.array(ordinals, dtype=np.int64)
+
+    def match(self, condition):
+        """
+        Returns the sample ids whose birth date satisfies a condition
+
+        :param condition: Mongo condition on BIRTH_DATE returned by AgeCriteria.condition
+        :return: Set of sample ids
+        """
+
+        mask = np.ones(len(self.ordinals), dtype=bool)
+        for op, date in condition.iteritems():
+            mask &= _COMPARISONS[op](self.ordinals, _ordinal(date))
+        return set(self.sample_ids[mask])
@@ -0,0 +1,193 @@
+"""Copyright 2016 Dana-Farber Cancer Institute"""
+
+import re
+import json
+import hashlib
+import logging
+import datetime as dt
+import networkx as nx
+from bson import json_util
+
+from matchengine.settings import TUMOR_TREE, TRIAL_UPDATED
+
+# bump whenever the layout of a compiled trial plan or the query translation changes
+CACHE_VERSION = 8
+
+# how the values of compiled queries json has no type for are tagged in a stored plan
+_REGEX = '__regex__'
+_DATETIME = '__datetime__'
+_DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+# compiled plans kept in memory between runs of the same process, keyed by protocol number
+_PLANS = {}
+
+_SALT = []
+
+
+def _salt():
+    """Returns the part of the cache key that does not depend on the trial document itself"""
+
+    if not _SALT:
+        with open(TUMOR_TREE) as f:
+            tree_hash = hashlib.sha1(f.read()).hexdigest()
+        _SALT.append('%s:%s:%s' % (CACHE_VERSION, nx.__version__, tree_hash))
+    return _SALT[0]
+
+
+def _default(obj):
+    """Serializes values json cannot handle, such as ObjectIds and dates"""
+    try:
+        return json_util.default(obj)
+    except TypeError:
+        return str(obj)
+
+
+def trial_hash(trial, options=None):
+    """
+    Returns a stable hash of a trial document. The Mongo "_id" and the time of the last edit are ignored so that
+    re-inserting identical trial content does not invalidate its compiled plan.
+
+    :param trial: Trial document
+    :param options: Optional compile options that change the compiled queries
+    :return: Hex digest
+    """
+
+    content = dict((k, v) for k, v in trial.iteritems() if k not in ('_id', TRIAL_UPDATED))
+    blob = json.dumps([_salt(), options, content], sort_keys=True, default=_default)
+    return hashlib.sha1(blob).hexdigest()
+
+
+def _encode(obj):
+    """Tags the regexes and dates of compiled queries so they can be stored as json"""
+    if isinstance(obj, re._pattern_type):
+        return {_REGEX: obj.pattern, 'flags': obj.flags}
+    if isinstance(obj, dt.datetime):
+        return {_DATETIME: obj.strftime(_DATETIME_FORMAT)}
+    raise TypeError('%r cannot be stored in a compiled plan' % obj)
+
+
+def _decode(obj):
+    """Restores the values tagged by _encode"""
+    if _REGEX in obj:
+        return re.compile(obj[_REGEX], obj['flags'])
+    if _DATETIME in obj:
+        return dt.datetime.strptime(obj[_DATETIME], _DATETIME_FORMAT)
+    return obj
+
+
+def dump_plan(plan):
+    """
+    Serializes a compiled plan as json: every segment with its match tree as lists of nodes and edges. Only plain
+    data is stored, so reading a plan back never executes code.
+
+    :param plan: List of segments returned by MatchEngine.compile_trial
+    :return: Json string
+    """
+
+    segments = []
+    for segment in plan:
+        tree = segment['match_tree']
+        segments.append({
+            'match_segment': segment['match_segment'],
+            'trial_segment': segment['trial_segment'],
+            'nodes': [[node, data] for node, data in tree.nodes(data=True)],
+            'edges': [[u, v] for u, v in tree.edges()]
+        })
+    return json.dumps(segments, default=_encode, sort_keys=True)
+
+
+def load_plan(blob):
+    """
+    Reads a compiled plan serialized by dump_plan
+
+    :param blob: Json string
+    :return: List of segments with their match tree as a DiGraph
+    """
+
+    plan = []
+    for segment in json.loads(blob, object_hook=_decode):
+        tree = nx.DiGraph()
+        for node, data in segment['nodes']:
+            tree.add_node(node, data)
+        tree.add_edges_from(segment['edges'])
+        plan.append({
+            'match_segment': segment['match_segment'],
+            'trial_segment': segment['trial_segment'],
+            'match_tree': tree
+        })
+    return plan
+
+
+class TrialCache(object):
+    """
+    Stores compiled trial plans (segment metadata and match trees with their compiled leaf queries) in memory
+    and in the side collection "trial_cache", as json, see dump_plan. Plans are keyed by the hash of the trial
+    document, so a trial is only recompiled when its content changes.
+    """
+
+    def __init__(self, db, collection='trial_cache'):
+        self.db = db
+        self.collection = collection
+        self.hits = 0
+        self.misses = 0
+
+    def load(self, trial, compile_trial, options=None, persist=True):
+        """
+        Returns the compiled plan of a trial, compiling and storing it if it is not cached yet.
+
+        :param trial: Trial document
+        :param compile_trial: Function compiling a trial document into a plan
+        :param options: Optional compile options that are part of the cache key
+        :param persist: Set to False to leave the side collection untouched, e.g. in read-only commands
+        :return: Compiled plan
+        """
+
+        key = trial_hash(trial, options)
+        protocol_no = trial.get('protocol_no')
+
+        # in-process cache
+        if protocol_no in _PLANS and _PLANS[protocol_no][0] == key:
+            self.hits += 1
+            return _PLANS[protocol_no][1]
+
+        # side collection
+        plan = None
+        doc = self.db[self.collection].find_one({'_id': key}, {'plan': 1})
+        if doc is not None:
+            try:
+                plan = load_plan(doc['plan'])
+                self.hits += 1
+            except Exception as exc:
+                logging.warning('Discarding unreadable compiled plan for trial %s: %s' % (protocol_no, exc))
+
+        if plan is None:
+            self.misses += 1
+            plan = compile_trial(trial)
+            if persist:
+                self.store(key, protocol_no, plan)
+
+        _PLANS[protocol_no] = (key, plan)
+        return plan
+
+    def store(self, key, protocol_no, plan):
+        """Writes a compiled plan to the side collection and removes outdated plans of the same trial"""
+
+        try:
+            blob = dump_plan(plan)
+        except TypeError as exc:
+            logging.warning('Not storing the compiled plan of trial %s: %s' % (protocol_no, exc))
+            return
+
+        doc = {
+            '_id': key,
+            'protocol_no': protocol_no,
+            'version': CACHE_VERSION,
+            'plan': blob
+        }
+        self.db[self.collection].replace_one({'_id': key}, doc, upsert=True)
+        self.db[self.collection].delete_many({'protocol_no': protocol_no, '_id': {'$ne': key}})
+
+    def clear(self):
+        """Drops all compiled plans"""
+        _PLANS.clear()
+        self.db.drop_collection(self.collection)
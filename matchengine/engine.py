@@ -1,49 +1,160 @@
 """Copyright 2016 Dana-Farber Cancer Institute"""
 
-from cerberus1 import schema_registry
-import networkx as nx
 import gc
+import time
+import yaml
 import logging
+import pandas as pd
+import networkx as nx
+from collections import OrderedDict
 
+import oncotreenx
+from pymongo.errors import ExecutionTimeout
 from matchengine import schema
-from matchengine.validation import ConsentValidatorCerberus
 from matchengine.utilities import *
-from matchengine.sort import add_sort_order
+from matchengine.sort import add_sort_order, SORT_FIELDS
+from matchengine.cache import TrialCache, trial_hash
+from matchengine.instrument import Instrumentation
+from matchengine.ages import AgeCriteria, BirthDateIndex
+from matchengine.storage import MemoryDatabase
+from matchengine.summary import summarizable, summary_is_current, summary_sample_ids
+from matchengine.samples import Complement, intersect, materialize, union, sample_range_condition, sample_range_query
+
+# genomic fields copied into trial matches
+GENOMIC_PROJECTION = {
+    'SAMPLE_ID': 1,
+    'TRUE_HUGO_SYMBOL': 1,
+    'TRUE_PROTEIN_CHANGE': 1,
+    'TRUE_VARIANT_CLASSIFICATION': 1,
+    'VARIANT_CATEGORY': 1,
+    'CNV_CALL': 1,
+    'WILDTYPE': 1,
+    'CHROMOSOME': 1,
+    'POSITION': 1,
+    'TRUE_CDNA_CHANGE': 1,
+    'REFERENCE_ALLELE': 1,
+    'TRUE_TRANSCRIPT_EXON': 1,
+    'CANONICAL_STRAND': 1,
+    'ALLELE_FRACTION': 1,
+    'TIER': 1,
+    'CLINICAL_ID': 1,
+    'MMR_STATUS': 1,
+    'ACTIONABILITY': 1,
+    '_id': 1
+}
+SAMPLE_ID_PROJECTION = {'SAMPLE_ID': 1, '_id': 0}
 
 # logging
 logging.basicConfig(level=logging.DEBUG, format='[%(levelname)s] %(asctime)s: %(message)s', )
 
-# modify schema for advanced recursive support (not yet supported in python-eve so it has to happen after the fact)
-parent_schema_adv = schema.parent_schema.copy()
-parent_schema_adv['children'] = {
-    'type': 'list',
-    'schema': {
-        'type': 'dict',
-        'schema': 'child_schema'
+# the retry pass of a run matches the trials it deferred with time limits this many times larger
+RETRY_FACTOR = 4
+
+# set once the trial schemas are registered, see register_schemas
+_SCHEMAS_REGISTERED = []
+
+
+def register_schemas():
+    """
+    Registers the trial schemas with cerberus the first time a trial is validated, so that commands which never
+    validate a trial do not pay for it at startup. The parent schema is modified for advanced recursive support
+    (not yet supported in python-eve so it has to happen after the fact).
+    """
+
+    if _SCHEMAS_REGISTERED:
+        return
+
+    from cerberus1 import schema_registry
+
+    parent_schema_adv = schema.parent_schema.copy()
+    parent_schema_adv['children'] = {
+        'type': 'list',
+        'schema': {
+            'type': 'dict',
+            'schema': 'child_schema'
+        }
     }
-}
-parent_schema_adv['match'] = {
-    'type': 'list',
-    'schema': {
-        'type': 'dict',
-        'schema': 'yaml_match_schema'
+    parent_schema_adv['match'] = {
+        'type': 'list',
+        'schema': {
+            'type': 'dict',
+            'schema': 'yaml_match_schema'
+        }
     }
+    schema_registry.add('parent_schema', parent_schema_adv)
+    schema_registry.add('yaml_match_schema', schema.yaml_match_schema)
+    schema_registry.add('yaml_genomic_schema', schema.yaml_genomic_schema)
+    schema_registry.add('yaml_clinical_schema', schema.yaml_clinical_schema)
+    schema_registry.add('map', schema.map)
+    _SCHEMAS_REGISTERED.append(True)
+
+# trial trees built through the tree API, keyed by trial hash, least recently used first
+_TRIAL_TREES = OrderedDict()
+_TRIAL_TREES_MAX = 1024
+
+# trial fields needed to match a trial
+TRIAL_PROJECTION = {'protocol_no': 1, 'nct_id': 1, 'treatment_list': 1, '_summary': 1}
+
+# collection written by count_trial_matches
+COUNTS_COLLECTION = 'trial_match_counts'
+
+# trial segment fields needed to record a match, by segment level
+SEGMENT_FIELDS = {
+    'step': ['step_internal_id', 'step_code'],
+    'arm': ['arm_internal_id', 'arm_code', 'arm_suspended'],
+    'dose': ['level_internal_id', 'level_code', 'level_suspended']
 }
-schema_registry.add('parent_schema', parent_schema_adv)
-schema_registry.add('yaml_match_schema', schema.yaml_match_schema)
-schema_registry.add('yaml_genomic_schema', schema.yaml_genomic_schema)
-schema_registry.add('yaml_clinical_schema', schema.yaml_clinical_schema)
-schema_registry.add('map', schema.map)
+
+
+class TrialDeferred(Exception):
+    """Raised when a trial runs over its time budget, or one of its leaf queries over the query time limit"""
+    pass
 
 
 class MatchEngine(object):
 
-    def __init__(self, db):
+    def __init__(self, db, stats=None, sample_ids=None, sample_range=None, as_of=None, max_time_ms=None,
+                 trial_budget=None, retry_factor=RETRY_FACTOR):
         # get the database.
         self.db = db
 
-        # stores the complete list as easy lookup
-        self.all_match = set(self.db.clinical.distinct('SAMPLE_ID'))
+        # compiled trial plans
+        self.cache = TrialCache(db)
+
+        # timers and counters; disabled unless an enabled Instrumentation is passed in
+        self.stats = stats if stats is not None else Instrumentation(enabled=False)
+        self.current_protocol_no = None
+
+        # stores the complete list as easy lookup, restricted to the given samples for incremental runs
+        self.sample_filter = None
+        self.restrict_range(sample_range)
+        self.restrict_samples(sample_ids)
+
+        # oncotree, built on first use
+        self._onco_tree = None
+
+        # whether the genomic summary accounts for every genomic document; checked on first use
+        self._summary_current = None
+
+        # whether every clinical document has its oncotree ancestry; checked on first use
+        self._ancestry_current = None
+
+        # whether every genomic document has its structural variant gene tokens; checked on first use
+        self._sv_genes_current = None
+
+        # age restrictions are translated as of one date for the whole run
+        self.ages = AgeCriteria(as_of)
+
+        # birth dates of the in-memory database as an array; built on first use
+        self._birth_dates = None
+
+        # time limits of a leaf query in milliseconds and of a trial in seconds, with their multiplier in the
+        # retry pass; the reason every deferred trial was deferred, by protocol number
+        self.max_time_ms = max_time_ms
+        self.trial_budget = trial_budget
+        self.retry_factor = retry_factor
+        self.deferred = {}
+        self._deadline = None
 
         # get mapping values between yml and db
         self.bootstrap_map()
@@ -55,6 +166,43 @@ class MatchEngine(object):
             {'key_old': 'MS_STATUS', 'key_new': 'MMR_STATUS', 'values': {}}
         ])
 
+    def restrict_samples(self, sample_ids):
+        """
+        Restricts matching to some samples
+
+        :param sample_ids: Sample ids to match, or None to match every sample
+        """
+        self.sample_filter = set(sample_ids) if sample_ids is not None else None
+        self.all_match = set(self.cohort)
+        if self.sample_filter is not None:
+            self.all_match &= self.sample_filter
+
+    def restrict_range(self, sample_range):
+        """
+        Restricts matching to a range of sample ids, e.g. one partition of the cohort. Only the sample ids of the
+        range are loaded, and every leaf query is limited to the range.
+
+        :param sample_range: Dictionary with the first sample id of the range, "min", and the first sample id after
+            it, "max", either of which may be None. Every sample if not given.
+        """
+        self.sample_range = sample_range
+        self.cohort = set(self.db.clinical.find(sample_range_query(sample_range or {})).distinct('SAMPLE_ID'))
+        self.restrict_samples(self.sample_filter)
+
+    def sample_condition(self):
+        """Returns the query condition on sample ids of a run restricted to some samples, or None"""
+
+        condition = sample_range_condition(self.sample_range or {})
+        if self.sample_filter is not None:
+            condition['$in'] = sorted(self.sample_filter)
+        return condition or None
+
+    def onco_tree(self):
+        """Returns the oncotree, which is built once per engine"""
+        if self._onco_tree is None:
+            self._onco_tree = build_oncotree()
+        return self._onco_tree
+
     def bootstrap_map(self):
         """Loads the map into the database between yaml field names and their corresponding database field names"""
 
@@ -104,9 +252,10 @@ class MatchEngine(object):
                 item['values'] = {}
             mapping.append(item)
 
-        # add to db
-        self.db.drop_collection("map")
-        self.db.map.insert_many(mapping)
+        # add to db in place, so engines started concurrently never read a partial map
+        for item in mapping:
+            self.db.map.replace_one({'key_old': item['key_old']}, item, upsert=True)
+        self.db.map.delete_many({'key_old': {'$nin': key_map.keys()}})
 
     @staticmethod
     def validate_yaml_format(data):
@@ -133,6 +282,9 @@ class MatchEngine(object):
         :return:
         """
 
+        from matchengine.validation import ConsentValidatorCerberus
+
+        register_schemas()
         v = ConsentValidatorCerberus(schema.parent_schema)
         v.validate(data_json)
         return v.errors
@@ -211,6 +363,13 @@ class MatchEngine(object):
         else:
             data = raw_data
 
+        # the same trial content always yields the same tree; callers get a copy they may modify
+        key = trial_hash(data)
+        if key in _TRIAL_TREES:
+            G = _TRIAL_TREES.pop(key)
+            _TRIAL_TREES[key] = G
+            return 0, G.copy()
+
         # create the graph
         G = nx.DiGraph()
 
@@ -218,9 +377,208 @@ class MatchEngine(object):
         self._recursive_create(None, data, G)
         self._annotate_match(G)
 
+        _TRIAL_TREES[key] = G.copy()
+        if len(_TRIAL_TREES) > _TRIAL_TREES_MAX:
+            _TRIAL_TREES.popitem(last=False)
+
         # return the tree.
         return 0, G
 
+    def compile_leaf(self, node):
+        """
+        Translates a genomic or clinical leaf of a match tree into its Mongo query. Age restrictions are kept
+        in their yaml form and translated into dates when the query is run.
+
+        :param node: Leaf node of a match tree
+        :return: Dictionary with the collection to query, the query, the equivalent query that is executed,
+            whether the query is negative or on structural variants, and whether it can be answered from the
+            genomic summary. Negative leaves also carry the genomic alteration recorded for every sample they
+            match, structural variant leaves the equivalent query on the comment, and clinical leaves on a diagnosis
+            the equivalent query on the oncotree ancestry. None if the node is not a genomic or clinical criterium.
+        """
+
+        # copy so the trial document is left untouched
+        item = dict(node['value'])
+
+        if node['type'] == 'genomic':
+            g, neg, sv = self.prepare_genomic_criteria(item)
+            search = indexed_genomic_query(g)
+            leaf = {'collection': 'genomic', 'query': g, 'search': search, 'neg': neg, 'sv': sv,
+                    'summary': summarizable(search)}
+
+            # structural variants are searched in the comment itself while documents lack their gene tokens
+            if sv:
+                leaf['comment'] = indexed_genomic_query(
+                    self.prepare_genomic_criteria(dict(node['value']), sv_tokens=False)[0])
+
+            if neg:
+                leaf['descriptor'] = self.negative_descriptor(g)
+            return leaf
+
+        elif node['type'] == 'clinical':
+            c = self.prepare_clinical_criteria(dict(item), resolve_age=False)
+            leaf = {'collection': 'clinical', 'query': c, 'neg': False, 'sv': False}
+
+            unexpanded = self.prepare_clinical_criteria(item, resolve_age=False, expand_diagnosis=False)
+            if 'ONCOTREE_PRIMARY_DIAGNOSIS_NAME' in unexpanded:
+                leaf['ancestry'] = self._search_oncotree_ancestry(self.onco_tree(), unexpanded)
+            return leaf
+
+    @staticmethod
+    def negative_descriptor(g):
+        """
+        Returns the genomic alteration recorded for the samples that matched a negative genomic leaf. It only
+        depends on the trial criteria, so it is shared by every sample of the leaf.
+
+        :param g: Genomic query of the leaf
+        """
+        alteration, is_variant = format_not_match(g)
+        return {'match_type': is_variant, 'genomic_alteration': alteration}
+
+    def summary_is_current(self):
+        """True if leaves can be answered from the genomic summary"""
+        if self._summary_current is None:
+            self._summary_current = summary_is_current(self.db)
+            if not self._summary_current:
+                logging.info('Genomic summary is missing or out of date and will not be used')
+        return self._summary_current
+
+    def ancestry_is_current(self):
+        """True if diagnoses can be matched on the oncotree ancestry of clinical documents"""
+        if self._ancestry_current is None:
+            self._ancestry_current = ancestry_is_current(self.db)
+            if not self._ancestry_current:
+                logging.info('Oncotree ancestry is missing from clinical documents and will not be used')
+        return self._ancestry_current
+
+    def sv_genes_is_current(self):
+        """True if structural variants can be matched on the gene tokens of genomic documents"""
+        if self._sv_genes_current is None:
+            self._sv_genes_current = sv_genes_is_current(self.db)
+            if not self._sv_genes_current:
+                logging.info('Structural variant gene tokens are missing from genomic documents and will not be used')
+        return self._sv_genes_current
+
+    def birth_dates(self):
+        """Returns the birth dates of the cohort as a BirthDateIndex, which is built once per engine"""
+        if self._birth_dates is None:
+            self._birth_dates = BirthDateIndex(self.db)
+        return self._birth_dates
+
+    def leaf_query(self, leaf):
+        """
+        Returns how a compiled leaf is executed when the match tree is evaluated. Only sample ids are fetched,
+        which a covering index can return without reading documents. Age restrictions are translated into birth
+        dates as of the start of the run or request.
+
+        :param leaf: Compiled leaf returned by compile_leaf
+        :return: Tuple of the collection, the Mongo query, and the projection
+        """
+
+        if leaf['collection'] == 'genomic':
+            if leaf.get('comment') is not None and not self.sv_genes_is_current():
+                return 'genomic', leaf['comment'], dict(SAMPLE_ID_PROJECTION)
+            return 'genomic', leaf.get('search', leaf['query']), dict(SAMPLE_ID_PROJECTION)
+
+        c = leaf['query']
+        if leaf.get('ancestry') is not None and self.ancestry_is_current():
+            c = leaf['ancestry']
+
+        # translate yaml age restrictions into proper mongo query dates
+        if 'BIRTH_DATE' in c:
+            c = dict(c)
+            c['BIRTH_DATE'] = self.ages.condition(c['BIRTH_DATE']['$eq'])
+
+        return 'clinical', c, dict(SAMPLE_ID_PROJECTION)
+
+    @staticmethod
+    def detail_projection(leaf):
+        """Returns the genomic fields fetched for the samples that matched a positive genomic leaf"""
+
+        proj = dict(GENOMIC_PROJECTION)
+
+        # record pathologist's chromosomal rearrangement comment for downstream manual analysis
+        if leaf['sv']:
+            proj['STRUCTURAL_VARIANT_COMMENT'] = 1
+
+        return proj
+
+    def compile_match_tree(self, match):
+        """
+        Creates the match tree of a match clause and compiles the Mongo query of each of its leaves
+
+        :param match: json match clause
+        :return: diGraph match tree
+        """
+
+        g = self.create_match_tree(match)
+        for node_id in g.nodes():
+            if len(g.successors(node_id)) == 0 and g.node[node_id]['type'] in ['genomic', 'clinical']:
+                g.node[node_id]['compiled'] = self.compile_leaf(g.node[node_id])
+        return g
+
+    def compile_trial(self, trial):
+        """
+        Compiles every step, arm, and dose level match clause of a trial.
+
+        :param trial: Trial document
+        :return: List of segments. Each segment holds the segment level ("match_segment"), the segment fields
+            needed to record a match ("trial_segment"), and the compiled match tree ("match_tree").
+        """
+
+        segments = []
+        for step in trial['treatment_list']['step']:
+            if 'match' in step:
+                segments.append(self._compile_segment(step, 'step'))
+
+            for arm in step['arm']:
+                if 'match' in arm:
+                    segments.append(self._compile_segment(arm, 'arm'))
+
+                for dose in arm['dose_level']:
+                    if 'match' in dose:
+                        segments.append(self._compile_segment(dose, 'dose'))
+
+        return segments
+
+    def _compile_segment(self, trial_segment, match_segment):
+        """Compiles a single step, arm, or dose level of a trial"""
+        fields = SEGMENT_FIELDS[match_segment]
+        return {
+            'match_segment': match_segment,
+            'trial_segment': dict((k, trial_segment[k]) for k in fields if k in trial_segment),
+            'match_tree': self.compile_match_tree(trial_segment['match'][0])
+        }
+
+    def restrict(self, query):
+        """Restricts a leaf query to the samples of an incremental or partitioned run"""
+        condition = self.sample_condition()
+        if condition is None:
+            return query
+        return {'$and': [query, {'SAMPLE_ID': condition}]}
+
+    def query_time_ms(self):
+        """
+        Returns the time limit of the next leaf query in milliseconds: the query time limit, lowered to what is
+        left of the budget of the trial being matched, or None without limits.
+
+        :raises TrialDeferred: once the budget of the trial is spent
+        """
+
+        limit = self.max_time_ms
+        if self._deadline is not None:
+            left = int((self._deadline - time.time()) * 1000)
+            if left <= 0:
+                raise TrialDeferred('over its budget of %ss' % self.trial_budget)
+            limit = left if limit is None else min(limit, left)
+        return limit
+
+    def limit(self, cursor):
+        """Applies the time limit of the next leaf query to a cursor"""
+
+        ms = self.query_time_ms()
+        return cursor.max_time_ms(ms) if ms is not None else cursor
+
     def run_query(self, node):
         """
         Runs genomic or clinical query against Mongo database and returns a set of sample ids that matched
@@ -233,121 +591,174 @@ class MatchEngine(object):
             matched_genomic_info: genomic information regarding each match
         """
 
-        matched_genomic_info = []
+        matched_sample_ids = self.match_leaf(node)
+        if matched_sample_ids is None:
+            return
 
-        # execute query against genomic table
-        if node['type'] == 'genomic':
+        matched_sample_ids = materialize(matched_sample_ids)
+        return matched_sample_ids, self.hydrate_leaf(node, matched_sample_ids)
 
-            item = node['value']
+    def match_leaf(self, node):
+        """
+        Returns the sample ids that match a leaf of a match tree. Only sample ids are read; the genomic detail of
+        the samples that survive the whole tree is fetched afterwards by hydrate_leaf.
 
-            # prepare genomic criteria
-            g, neg, sv = self.prepare_genomic_criteria(item)
+        :param node: Leaf node of a match tree
+        :return: Set of sample ids, or None if the node is not a genomic or clinical criterium. Negative genomic
+            leaves return a Complement of the samples they exclude.
+        """
+
+        start = self.stats.start()
+        n_docs = 0
+
+        # compile the leaf unless the match tree was compiled beforehand
+        leaf = node.get('compiled')
+        if leaf is None and node['type'] in ['genomic', 'clinical']:
+            leaf = self.compile_leaf(node)
+
+        # execute query against genomic table
+        if node['type'] == 'genomic':
 
             # execute match
-            if len(g.keys()) == 0:
-                matched_sample_ids = list()
+            _, search, proj = self.leaf_query(leaf)
+            if len(leaf['query'].keys()) == 0:
+                matched_sample_ids = set()
             else:
 
-                if neg:
-                    proj = {'SAMPLE_ID': 1}     # speeds up query
+                # gene-level criteria can be answered from the genomic summary
+                if leaf.get('summary') and self.summary_is_current():
+                    found = summary_sample_ids(self.db, search, self.sample_range)
                 else:
-                    proj = {
-                        'SAMPLE_ID': 1,
-                        'TRUE_HUGO_SYMBOL': 1,
-                        'TRUE_PROTEIN_CHANGE': 1,
-                        'TRUE_VARIANT_CLASSIFICATION': 1,
-                        'VARIANT_CATEGORY': 1,
-                        'CNV_CALL': 1,
-                        'WILDTYPE': 1,
-                        'CHROMOSOME': 1,
-                        'POSITION': 1,
-                        'TRUE_CDNA_CHANGE': 1,
-                        'REFERENCE_ALLELE': 1,
-                        'TRUE_TRANSCRIPT_EXON': 1,
-                        'CANONICAL_STRAND': 1,
-                        'ALLELE_FRACTION': 1,
-                        'TIER': 1,
-                        'CLINICAL_ID': 1,
-                        'MMR_STATUS': 1,
-                        'ACTIONABILITY': 1,
-                        '_id': 1
-                    }
-
-                    # record pathologist's chromosomal rearrangement comment for downstream manual analysis
-                    if sv:
-                        proj['STRUCTURAL_VARIANT_COMMENT'] = 1
-
-                results = list(self.db.genomic.find(g, proj))
-
-                # if a negative query was match, the formatted genomic alteration will reflect the trial criteria
-                # and the genomic information will not be copied into the trial_match document
-                if neg:
-
-                    # If the yaml criterium was negative, then subtract the matched results from the total set
-                    matched_sample_ids = self.all_match - set(x['SAMPLE_ID']for x in results)
-                    alteration, is_variant = format_not_match(g)
-
-                    # add genomic alterations per sample id
-                    matched_genomic_info = [{
-                        'sample_id': sample_id,
-                        'match_type': is_variant,
-                        'genomic_alteration': alteration
-                    } for sample_id in matched_sample_ids]
-
+                    found = set(x['SAMPLE_ID'] for x in self.limit(self.db.genomic.find(self.restrict(search), proj)))
+                if self.sample_filter is not None:
+                    found &= self.sample_filter
+                n_docs = len(found)
+
+                # If the yaml criterium was negative, then subtract the matched results from the total set
+                if leaf['neg']:
+                    matched_sample_ids = Complement(self.all_match, found)
                 else:
-                    for item in results:
-
-                        # format the genomic alteration that matched
-                        alteration, is_variant = format_genomic_alteration(item, g)
-
-                        # add genomic information and alterations that matched per sample id
-                        genomic_info = {
-                            'match_type': is_variant,
-                            'genomic_alteration': alteration
-                        }
-
-                        # copy genomic document projection into match
-                        for field in proj:
-                            if field in item:
-                                if field == '_id':
-                                    genomic_info['genomic_id'] = item[field]
-                                else:
-                                    genomic_info[field.lower()] = item[field]
-
-                        # add unique matches by sample id
-                        matched_genomic_info.append(genomic_info)
-
-                    matched_sample_ids = set(item['SAMPLE_ID'] for item in results)
+                    matched_sample_ids = found
 
         # execute query against clinical table
         elif node['type'] == 'clinical':
 
-            item = node['value']
-
-            # prepare clinical criteria
-            c = self.prepare_clinical_criteria(item)
+            _, c, _ = self.leaf_query(leaf)
 
             # execute match
             if len(c.keys()) == 0:
-                matched_sample_ids = list()
+                matched_sample_ids = set()
+            elif c.keys() == ['BIRTH_DATE'] and isinstance(self.db, MemoryDatabase):
+                matched_sample_ids = self.birth_dates().match(c['BIRTH_DATE'])
+                if self.sample_condition() is not None:
+                    matched_sample_ids &= self.all_match
+                n_docs = len(matched_sample_ids)
             else:
-                matched_sample_ids = set(self.db.clinical.find(c).distinct('SAMPLE_ID'))
+                matched_sample_ids = set(self.limit(self.db.clinical.find(self.restrict(c))).distinct('SAMPLE_ID'))
+                n_docs = len(matched_sample_ids)
 
         else:
             logging.info("bad match tree")
             return
 
-        # return a list of sample ids and match information
-        return matched_sample_ids, matched_genomic_info
+        self.stats.record_leaf(self.current_protocol_no, node, start, n_docs)
+        return matched_sample_ids
+
+    def hydrate_leaf(self, node, sample_ids):
+        """
+        Returns the genomic information of a leaf for the given samples, which must have matched the leaf.
+
+        :param node: Leaf node of a match tree
+        :param sample_ids: Sample ids to return genomic information for
+        :return: List of genomic information, one per genomic document that matched
+        """
+
+        matched_genomic_info = []
+        if node['type'] != 'genomic' or not sample_ids:
+            return matched_genomic_info
+
+        leaf = node.get('compiled') or self.compile_leaf(node)
+        g = leaf['query']
+
+        # if a negative query was match, the formatted genomic alteration will reflect the trial criteria
+        # and the genomic information will not be copied into the trial_match document
+        if leaf['neg']:
+            descriptor = leaf.get('descriptor') or self.negative_descriptor(g)
+
+            # expand the shared alteration per sample id
+            return [dict(descriptor, sample_id=sample_id) for sample_id in sample_ids]
+
+        # fetch the detail of the matching documents of these samples only
+        proj = self.detail_projection(leaf)
+        search = {'$and': [self.leaf_query(leaf)[1], {'SAMPLE_ID': {'$in': sorted(sample_ids)}}]}
+        with self.stats.timer('hydrate'):
+            results = list(self.limit(self.db.genomic.find(search, proj)))
+        self.stats.incr('documents.hydrated', len(results))
+
+        for item in results:
+
+            # format the genomic alteration that matched
+            alteration, is_variant = format_genomic_alteration(item, g)
+
+            # add genomic information and alterations that matched per sample id
+            genomic_info = {
+                'match_type': is_variant,
+                'genomic_alteration': alteration
+            }
+
+            # copy genomic document projection into match
+            for field in proj:
+                if field in item:
+                    if field == '_id':
+                        genomic_info['genomic_id'] = item[field]
+                    else:
+                        genomic_info[field.lower()] = item[field]
+
+            # add unique matches by sample id
+            matched_genomic_info.append(genomic_info)
+
+        return matched_genomic_info
 
     def traverse_match_tree(self, g):
         """ Finds matches for a given match tree
 
+        The tree is evaluated on sample ids first. Negative leaves are kept as the samples they exclude until the
+        root is reached. Genomic detail is then fetched only for the samples that matched the whole tree, with
+        one query per positive genomic leaf.
+
         :param g: diGraph match tree
         :return: match set for a tree
         """
 
+        matched, leaves = self.evaluate_match_tree(g)
+        final_sample_ids = set(materialize(matched[1]))
+
+        # genomic information of every leaf that matched a surviving sample
         tree_genomic = {}
+        for node_id in leaves:
+            survivors = intersect(final_sample_ids, matched[node_id])
+            for match in self.hydrate_leaf(g.node[node_id], survivors):
+                if match['sample_id'] not in tree_genomic:
+                    tree_genomic[match['sample_id']] = [match]
+                else:
+                    tree_genomic[match['sample_id']].append(match)
+
+        # samples matched on clinical criteria only have no genomic information
+        final_genomic_infos = [tree_genomic.get(i, []) for i in final_sample_ids]
+
+        return final_sample_ids, final_genomic_infos
+
+    def evaluate_match_tree(self, g):
+        """
+        Evaluates a match tree on sample ids only
+
+        :param g: diGraph match tree
+        :return: Tuple of a dictionary of the samples matched by every node, and the leaf node ids
+        """
+
+        # results are kept apart from the tree so that compiled trees can be reused
+        matched = {}
+        leaves = []
         for node_id in list(nx.dfs_postorder_nodes(g, source=1)):
 
             # get node and its child
@@ -356,51 +767,44 @@ class MatchEngine(object):
 
             # if leaf node then execute query
             if len(successors) == 0:
-                matched_sample_ids, matched_genomic_info = self.run_query(node)
-
-                node['matched_sample_ids'] = matched_sample_ids
-                node['matched_genomic_info'] = matched_genomic_info
-
-                for match in node['matched_genomic_info']:
-                    if match['sample_id'] not in tree_genomic:
-                        tree_genomic[match['sample_id']] = [match]
-                    else:
-                        tree_genomic[match['sample_id']].append(match)
+                matched[node_id] = self.match_leaf(node)
+                leaves.append(node_id)
 
             # else apply logic based on and/or
             else:
 
-                node['matched_sample_ids'] = set([])
-                node['matched_sample_ids'].update(g.node[successors[0]]['matched_sample_ids'])
-                node['matched_genomic_info'] = g.node[successors[0]]['matched_genomic_info']
+                matched[node_id] = matched[successors[0]]
 
                 for i in range(1, len(successors)):
-                    s_list = g.node[successors[i]]['matched_sample_ids']
+                    s_list = matched[successors[i]]
 
                     if node['type'] == 'and':
-                        node['matched_sample_ids'].intersection_update(s_list)
+                        matched[node_id] = intersect(matched[node_id], s_list)
 
                     elif node['type'] == 'or':
-                        node['matched_sample_ids'].update(s_list)
+                        matched[node_id] = union(matched[node_id], s_list)
 
-        final_sample_ids = g.node[1]['matched_sample_ids']
-        final_genomic_infos = [tree_genomic[i] for i in final_sample_ids]
+        return matched, leaves
 
-        return final_sample_ids, final_genomic_infos
+    def match_tree_samples(self, g):
+        """Returns the set of sample ids that match a match tree, without fetching any genomic detail"""
+        matched, _ = self.evaluate_match_tree(g)
+        return set(materialize(matched[1]))
 
-    def prepare_clinical_criteria(self, item):
+    def prepare_clinical_criteria(self, item, resolve_age=True, expand_diagnosis=True):
         """
         Translates match criteria from yaml format into a Mongo query
 
         :param item: the match tree criteria for a given node in yaml format
+        :param resolve_age: Translate age restrictions into birth dates. When false, the yaml age restriction
+            is kept under BIRTH_DATE as {'$eq': '>=18'}
+        :param expand_diagnosis: Expand a diagnosis into the names of every diagnosis below it in the oncotree.
+            When false, the diagnosis is kept as written in the trial.
         :return: Mongo query for clinical collection
         """
 
         c = {}
 
-        # create the oncotree.
-        onco_tree = build_oncotree()
-
         # only match by these keys
         map_keys = ["oncotree_primary_diagnosis", "age_numerical", "gender"]
 
@@ -419,20 +823,21 @@ class MatchEngine(object):
             c = build_cquery(c, norm_field, txt)
 
         # stolen Jimbo's code for adding all the oncotree nodes
-        if 'ONCOTREE_PRIMARY_DIAGNOSIS_NAME' in c:
-            c['ONCOTREE_PRIMARY_DIAGNOSIS_NAME'] = self._search_oncotree_diagnosis(onco_tree, c)
+        if 'ONCOTREE_PRIMARY_DIAGNOSIS_NAME' in c and expand_diagnosis:
+            c['ONCOTREE_PRIMARY_DIAGNOSIS_NAME'] = self._search_oncotree_diagnosis(self.onco_tree(), c)
 
         # translate yaml age restrictions into proper mongo query dates
-        if 'BIRTH_DATE' in c:
-            c['BIRTH_DATE'] = search_birth_date(c)
+        if 'BIRTH_DATE' in c and resolve_age:
+            c['BIRTH_DATE'] = self.ages.condition(c['BIRTH_DATE']['$eq'])
 
         return c
 
-    def prepare_genomic_criteria(self, item):
+    def prepare_genomic_criteria(self, item, sv_tokens=True):
         """
         Translates match criteria from yaml format into a Mongo query
 
         :param item: The match tree criteria for a given node in yaml format
+        :param sv_tokens: Set to False to search structural variants in the comment instead of its gene tokens
         :return: Mongo query for genomic collection
         """
 
@@ -476,7 +881,7 @@ class MatchEngine(object):
 
         # structural variants
         if track_sv:
-            g = get_structural_variants(g)
+            g = get_structural_variants(g, tokens=sv_tokens)
 
         # If wildtype not specified, the query defaults to false
         if not wildtype:
@@ -485,69 +890,458 @@ class MatchEngine(object):
 
         return g, track_neg, track_sv
 
-    def find_trial_matches(self):
+    def find_trial_matches(self, protocol_nos=None, run=None):
         """
         Iterates through all match clauses of all trials located in the database and matches patients to trials
         based on their clinical and genomic documents.
 
+        Runs restricted to some trials, or to some samples when the engine was created with sample ids or a sample
+        range, only replace the matches of those trials or samples.
+
+        Trials that run over the time budget are deferred while the others are matched, and matched again with
+        larger time limits at the end of the run. Trials still over budget then are listed in self.deferred and
+        in the manifest of the run, and keep the matches they had before the run.
+
+        :param protocol_nos: Protocol numbers of the trials to match. Every trial if not given.
+        :param run: MatchRun checkpointing the matches of every trial. Trials it already matched are skipped.
         :return: Dictionary containing matches
         """
 
-        # all MRNs and trials in the database
-        mrns = self.db.clinical.distinct('MRN')
-        proj = {'protocol_no': 1, 'nct_id': 1, 'treatment_list': 1, '_summary': 1}
-        all_trials = list(self.db.trial.find({}, proj))
+        # ages are computed as of the start of the run
+        self.ages.refresh()
+
+        # MRNs of the samples to match and all trials in the database
+        with self.stats.timer('load_trials'):
+            mrns = self.db.clinical.find(self.restrict({})).distinct('MRN')
+            query = {'protocol_no': {'$in': list(protocol_nos)}} if protocol_nos is not None else {}
+            all_trials = list(self.db.trial.find(query, TRIAL_PROJECTION))
 
         # create a map between sample id and MRN
-        mrn_map = samples_from_mrns(self.db, mrns)
+        with self.stats.timer('mrn_map'):
+            mrn_map = samples_from_mrns(self.db, mrns)
 
         # initialize trial matches
         trial_matches = []
+        self.deferred = {}
 
         # for all trials check for matches on the dose, arm, and step levels and keep track of what is found
+        deferred = [trial for trial in all_trials if not self._match_or_defer(trial, mrn_map, trial_matches, run)]
+        if deferred:
+            self.retry_deferred(deferred, mrn_map, trial_matches, run)
+
+        if self.deferred:
+            logging.warning('%d trials were deferred and not matched: %s' % (
+                len(self.deferred), ', '.join(sorted(self.deferred))))
+            self.stats.incr('trials.deferred', len(self.deferred))
+            if run is not None:
+                run.set_deferred(self.deferred)
+
+        # matches of a checkpointed run, including those of an earlier attempt
+        if run is not None:
+            run.set_status('publishing')
+            with self.stats.timer('checkpoint'):
+                trial_matches = run.staged()
+
+        self.current_protocol_no = None
+        logging.info('Compiled trial plans: %d reused, %d compiled' % (self.cache.hits, self.cache.misses))
+        self.stats.incr('trials', len(all_trials))
+        self.stats.incr('trial_matches', len(trial_matches))
+
+        with self.stats.timer('dataframe'):
+            trial_match_df = pd.DataFrame.from_dict(trial_matches)
+
+            # force garbage collector to remove unused object after conversion to df
+            del trial_matches
+            gc.collect()
+
+        # incremental runs sort and write only what they matched; deferred trials keep their matches
+        if protocol_nos is not None or self.sample_condition() is not None:
+            with self.stats.timer('write'):
+                self.replace_matches(trial_match_df, protocol_nos, keep=self.deferred)
+            return
+
+        # deferred trials keep the matches of the last run, which are sorted together with the new ones
+        if self.deferred:
+            with self.stats.timer('write'):
+                self.replace_matches(trial_match_df, keep=self.deferred)
+        else:
+            # sort
+            logging.info('Sorting trial matches.')
+            with self.stats.timer('sort'):
+                trial_matches_df = add_sort_order(trial_match_df)
+            logging.info('Number of trial matches: %s' % str(trial_match_df.shape[0]))
+
+            # add to db
+            logging.info('Adding trial matches to database')
+            with self.stats.timer('write'):
+                add_matches(trial_matches_df, self.db, stats=self.stats)
+
+        if run is not None:
+            run.finish()
+
+    def _match_or_defer(self, trial, mrn_map, trial_matches, run=None):
+        """
+        Matches a trial, appending its matches to trial_matches or staging them in the run. A trial that runs
+        over its time budget adds no matches and is recorded in self.deferred.
+
+        :return: False if the trial was deferred
+        """
+
+        n_matches = len(trial_matches)
+        try:
+            if run is None:
+                self.match_trial(trial, mrn_map, trial_matches)
+            elif trial['protocol_no'] not in run.completed:
+                with self.stats.timer('checkpoint'):
+                    run.stage(trial['protocol_no'], self.match_trial(trial, mrn_map, []))
+        except TrialDeferred as e:
+            del trial_matches[n_matches:]
+            self.deferred[trial['protocol_no']] = str(e)
+            logging.warning('Deferred trial %s: %s' % (trial['protocol_no'], e))
+            return False
+
+        self.deferred.pop(trial['protocol_no'], None)
+        return True
+
+    def retry_deferred(self, trials, mrn_map, trial_matches, run=None):
+        """
+        Matches the trials a run deferred again, with time limits retry_factor times larger. Trials still over
+        budget stay in self.deferred.
+
+        :param trials: Trial documents
+        :param mrn_map: Dictionary mapping patient sample ids to MRNs
+        :param trial_matches: List of matches the matches of these trials are appended to
+        :param run: MatchRun the matches are staged in instead, if given
+        """
+
+        if not self.retry_factor:
+            return
+
+        limits = self.max_time_ms, self.trial_budget
+        if self.max_time_ms:
+            self.max_time_ms = int(self.max_time_ms * self.retry_factor)
+        if self.trial_budget:
+            self.trial_budget = self.trial_budget * self.retry_factor
+
+        logging.info('Retrying %d deferred trials with %sx larger time limits' % (len(trials), self.retry_factor))
+        try:
+            for trial in trials:
+                self._match_or_defer(trial, mrn_map, trial_matches, run)
+        finally:
+            self.max_time_ms, self.trial_budget = limits
+
+    def find_partitioned_matches(self, partition_size):
+        """
+        Matches every trial to the cohort one range of at most partition_size samples at a time. The sort order of
+        a match only depends on the other matches of its sample, so every range is sorted and written on its own,
+        and the memory used is bounded by the partition size rather than the size of the cohort.
+
+        :param partition_size: Maximum number of samples per partition
+        """
+
+        # trials deferred in any partition
+        deferred = {}
+
+        # every partition computes ages as of the start of the run
+        self.ages.refresh()
+        fixed, self.ages.fixed = self.ages.fixed, True
+        try:
+            partitions = sample_partitions(self.db, partition_size)
+            for i, sample_range in enumerate(partitions):
+                self.restrict_range(sample_range)
+                logging.info('Matching partition %d of %d: %d samples' % (i + 1, len(partitions), len(self.cohort)))
+                self.find_trial_matches()
+                deferred.update(self.deferred)
+        finally:
+            self.ages.fixed = fixed
+        self.restrict_range(None)
+
+        self.deferred = deferred
+        if deferred:
+            logging.warning('%d trials were deferred in at least one partition: %s' % (
+                len(deferred), ', '.join(sorted(deferred))))
+
+    @staticmethod
+    def trial_context(trial, trial_status=None):
+        """
+        Returns the trial level fields copied into every match of a trial. If the trial is not open to accrual,
+        all matches to all match trees in this trial will be marked closed.
+
+        :param trial: Trial document
+        :param trial_status: Overall trial status, either open or closed. Read from the trial if not given.
+        :return: Dictionary of match fields
+        """
+
+        context = {
+            'trial_accrual_status': trial_status or get_trial_status(trial),
+            'cancer_type_match': get_cancer_type_match(trial),
+            'coordinating_center': get_coordinating_center(trial)
+        }
+        for trial_key in ['protocol_no', 'nct_id']:
+            if trial_key in trial:
+                context[trial_key] = trial[trial_key]
+        return context
+
+    @staticmethod
+    def segment_context(context, trial_segment, match_segment):
+        """
+        Returns the fields copied into every match of a step, arm, or dose level: the trial level fields plus
+        the segment level, internal id, and code. Suspended arms and dose levels are marked closed.
+
+        :param context: Trial level fields returned by trial_context
+        :param trial_segment: Either the step, arm, or dose segment of the trial document
+        :param match_segment: Marker indicating if segment is step, arm, or dose
+        :return: Dictionary of match fields
+        """
+
+        fields = dict(context)
+        fields['match_level'] = match_segment
+
+        # add internal id
+        if match_segment == 'dose':
+            fields['internal_id'] = str(trial_segment['level_internal_id'])
+            fields['code'] = trial_segment['level_code']
+            if 'level_suspended' in trial_segment and trial_segment['level_suspended'].lower() == 'y':
+                fields['trial_accrual_status'] = 'closed'
+        elif match_segment == 'arm':
+            fields['internal_id'] = str(trial_segment['arm_internal_id'])
+            fields['code'] = str(trial_segment['arm_code'])
+            if 'arm_suspended' in trial_segment and trial_segment['arm_suspended'].lower() == 'y':
+                fields['trial_accrual_status'] = 'closed'
+        elif match_segment == 'step':
+            fields['internal_id'] = str(trial_segment['step_internal_id'])
+            fields['code'] = trial_segment['step_code']
+
+        return fields
+
+    def count_trial_matches(self, collection=COUNTS_COLLECTION):
+        """
+        Counts the samples and patients every step, arm, and dose level of every trial matches, and how many of
+        them matched each gene of the trial criteria. Match trees are evaluated on sample ids only: no genomic
+        or clinical detail is fetched, no match is sorted, and trial_match is left untouched.
+
+        :param collection: Collection the counts replace
+        :return: List of count documents, one per segment
+        """
+
+        with self.stats.timer('load_trials'):
+            all_trials = list(self.db.trial.find({}, TRIAL_PROJECTION))
+
+        with self.stats.timer('mrn_map'):
+            mrn_map = samples_from_mrns(self.db, self.db.clinical.distinct('MRN'))
+
+        counts = []
         for trial in all_trials:
+            logging.info('Counting trial %s' % trial['protocol_no'])
+            trial_start = self.stats.start()
+            self.current_protocol_no = trial['protocol_no']
+            context = self.trial_context(trial)
+
+            with self.stats.timer('compile'):
+                segments = self.cache.load(trial, self.compile_trial)
+
+            n = 0
+            for segment in segments:
+                tree = segment['match_tree']
+                with self.stats.timer('match_tree'):
+                    matched, leaves = self.evaluate_match_tree(tree)
+                sample_ids = set(materialize(matched[1]))
+                n += len(sample_ids)
+
+                # samples matched per gene of the positive genomic criteria
+                genes = {}
+                for node_id in leaves:
+                    leaf = tree.node[node_id].get('compiled')
+                    if leaf is None or leaf['collection'] != 'genomic' or leaf['neg']:
+                        continue
+                    g = leaf['query']['$and'][0] if '$and' in leaf['query'] else leaf['query']
+                    gene = self._leaf_gene(g.get('TRUE_HUGO_SYMBOL'))
+                    if gene is not None:
+                        genes.setdefault(gene, set()).update(intersect(sample_ids, matched[node_id]))
+
+                item = self.segment_context(context, segment['trial_segment'], segment['match_segment'])
+                item.update({
+                    'n_samples': len(sample_ids),
+                    'n_patients': len(set(mrn_map[i] for i in sample_ids if i in mrn_map)),
+                    'genes': [{'gene': gene_name, 'n_samples': len(genes[gene_name])} for gene_name in sorted(genes)]
+                })
+                counts.append(item)
+
+            self.stats.record_trial(trial['protocol_no'], trial_start, n)
+
+        self.current_protocol_no = None
+        self.stats.incr('trials', len(all_trials))
+
+        with self.stats.timer('write'):
+            self.db.drop_collection(collection)
+            if counts:
+                self.db[collection].insert_many(counts)
+        logging.info('Counted matches of %d trial segments' % len(counts))
+        return counts
 
-            logging.info('Matching trial %s' % trial['protocol_no'])
+    @staticmethod
+    def _leaf_gene(condition):
+        """
+        Returns the gene a genomic leaf matches from its TRUE_HUGO_SYMBOL condition, e.g. "EGFR" or
+        {'$eq': 'EGFR'}, or None if the leaf matches no gene or several
+        """
 
-            # If the trial is not open to accrual, all matches to all match trees in this trial will be marked closed
-            trial_status = 'open'
-            if '_summary' in trial:
-                if 'status' in trial['_summary'] and isinstance(trial['_summary']['status'], list):
-                    if 'value' in trial['_summary']['status'][0]:
-                        if trial['_summary']['status'][0]['value'].lower() != 'open to accrual':
-                            trial_status = 'closed'
+        if isinstance(condition, dict):
+            if '$eq' in condition:
+                condition = condition['$eq']
+            elif len(condition.get('$in', [])) == 1:
+                condition = condition['$in'][0]
+        return condition if isinstance(condition, basestring) else None
 
-            # STEP #
-            for step in trial['treatment_list']['step']:
-                if 'match' in step:
-                    trial_matches = self._assess_match(mrn_map, trial_matches, trial, step, 'step', trial_status)
+    def match_trial(self, trial, mrn_map, trial_matches, segments=None):
+        """
+        Matches every step, arm, and dose level of a trial
 
-                # ARM #
-                for arm in step['arm']:
-                    if 'match' in arm:
-                        trial_matches = self._assess_match(mrn_map, trial_matches, trial, arm, 'arm', trial_status)
+        :param trial: Trial document
+        :param mrn_map: Dictionary mapping patient sample ids to MRNs
+        :param trial_matches: List of matches the matches of this trial are appended to
+        :param segments: Compiled segments of the trial. Loaded from the trial cache if not given.
+        :return: List of matches
+        :raises TrialDeferred: if the trial runs over its time budget or a leaf query over the query time limit.
+            The matches appended to trial_matches before then are incomplete.
+        """
+
+        logging.info('Matching trial %s' % trial['protocol_no'])
+        trial_start = self.stats.start()
+        n_matches = len(trial_matches)
+        self.current_protocol_no = trial['protocol_no']
 
-                    # DOSE #
-                    for dose in arm['dose_level']:
-                        if 'match' in dose:
-                            trial_matches = self._assess_match(mrn_map, trial_matches, trial, dose, 'dose', trial_status)
+        # trial level fields of every match, computed once per trial
+        context = self.trial_context(trial)
 
-        trial_match_df = pd.DataFrame.from_dict(trial_matches)
+        # compiled step, arm, and dose level match trees
+        if segments is None:
+            with self.stats.timer('compile'):
+                segments = self.cache.load(trial, self.compile_trial)
 
-        # force garbage collector to remove unused object after conversion to df
-        del trial_matches
-        gc.collect()
+        # the budget counts from the first leaf query
+        self._deadline = time.time() + self.trial_budget if self.trial_budget else None
+        try:
+            for segment in segments:
+                trial_matches = self._assess_match(mrn_map, trial_matches, trial, segment['trial_segment'],
+                                                   segment['match_segment'], context['trial_accrual_status'],
+                                                   match_tree=segment['match_tree'], context=context)
+        except ExecutionTimeout:
+            self.stats.incr('queries.timed_out')
+            raise TrialDeferred('a leaf query ran over its time limit')
+        finally:
+            self._deadline = None
+
+        self.stats.record_trial(trial['protocol_no'], trial_start, len(trial_matches) - n_matches)
+        return trial_matches
+
+    def simulate_trial(self, doc):
+        """
+        Matches a draft trial without storing the trial, its compiled plan, or its matches. Only sample ids are
+        read, so this is much cheaper than a match run.
+
+        :param doc: Trial document, or its yaml
+        :return: Dictionary with the protocol number, the schema errors if the draft is invalid, and per step,
+            arm, and dose level the segment fields and the number and list of samples and patients matched
+        """
+
+        status, data = self.validate_yaml_format(doc)
+        if status != 0:
+            return {'protocol_no': None, 'errors': str(data), 'segments': []}
+
+        result = {'protocol_no': data.get('protocol_no'), 'errors': self.validate_yaml_data(data), 'segments': []}
+        if result['errors']:
+            return result
+
+        self.ages.refresh()
+        self.current_protocol_no = result['protocol_no']
+        context = self.trial_context(data)
+        all_samples = set()
+        for segment in self.compile_trial(data):
+            sample_ids = self.match_tree_samples(segment['match_tree'])
+            all_samples.update(sample_ids)
+
+            item = self.segment_context(context, segment['trial_segment'], segment['match_segment'])
+            item.update(self._count_patients(sample_ids))
+            result['segments'].append(item)
+
+        self.current_protocol_no = None
+        result.update(self._count_patients(all_samples))
+        return result
+
+    def _count_patients(self, sample_ids):
+        """Returns the number and sorted list of samples and of their patients"""
+
+        mrns = []
+        if sample_ids:
+            mrns = self.db.clinical.find({'SAMPLE_ID': {'$in': list(sample_ids)}}, {'MRN': 1}).distinct('MRN')
+        return {
+            'n_samples': len(sample_ids),
+            'n_patients': len(mrns),
+            'sample_ids': sorted(sample_ids),
+            'mrns': sorted(mrns)
+        }
+
+    def replace_matches(self, trial_match_df, protocol_nos=None, keep=()):
+        """
+        Replaces the matches of an incremental run in the trial_match collection. The sort order of a match
+        depends on every match of its sample, so when only some trials were matched the sort order of the
+        other matches of the affected samples is recomputed too.
+
+        :param trial_match_df: Unsorted matches of the run
+        :param protocol_nos: Protocol numbers of the trials that were matched. Every trial if not given.
+        :param keep: Protocol numbers of trials that could not be matched, e.g. deferred ones. Their matches are
+            kept as they are.
+        """
+
+        keep = sorted(keep)
+        if protocol_nos is not None:
+            protocol_nos = [protocol_no for protocol_no in protocol_nos if protocol_no not in keep]
+
+        scope = {}
+        if protocol_nos is not None:
+            scope['protocol_no'] = {'$in': protocol_nos}
+        elif keep:
+            scope['protocol_no'] = {'$nin': keep}
+        condition = self.sample_condition()
+        if condition is not None:
+            scope['sample_id'] = condition
+
+        # matches of the affected samples to trials that were not matched
+        others = []
+        if protocol_nos is not None:
+            affected = set(self.db.trial_match.find(scope).distinct('sample_id'))
+            if len(trial_match_df.index) > 0:
+                affected.update(trial_match_df['sample_id'].unique())
+            query = {'sample_id': {'$in': sorted(affected)}, 'protocol_no': {'$nin': protocol_nos}}
+            others = list(self.db.trial_match.find(query, SORT_FIELDS))
+        elif keep:
+            query = {'protocol_no': {'$in': keep}}
+            if condition is not None:
+                query['sample_id'] = condition
+            others = list(self.db.trial_match.find(query, SORT_FIELDS))
+
+        n = len(trial_match_df.index)
+        columns = list(trial_match_df.columns)
+        if others:
+            trial_match_df = pd.concat([trial_match_df, pd.DataFrame(others)], ignore_index=True)
 
-        # sort
         logging.info('Sorting trial matches.')
-        trial_matches_df = add_sort_order(trial_match_df)
-        logging.info('Number of trial matches: %s' % str(trial_match_df.shape[0]))
+        trial_match_df = add_sort_order(trial_match_df)
+
+        # update the sort order of the other matches where it changed
+        for i, item in enumerate(others):
+            sort_order = int(trial_match_df['sort_order'].iat[n + i])
+            if item.get('sort_order') != sort_order:
+                self.db.trial_match.update_one({'_id': item['_id']}, {'$set': {'sort_order': sort_order}})
 
-        # add to db
-        logging.info('Adding trial matches to database')
-        add_matches(trial_matches_df, self.db)
+        logging.info('Replacing %d trial matches' % n)
+        self.db.trial_match.delete_many(scope)
+        if n > 0:
+            insert_matches(trial_match_df[:n][columns + ['sort_order']], self.db, stats=self.stats)
 
-    def _assess_match(self, mrn_map, trial_matches, trial, trial_segment, match_segment, trial_status):
+    def _assess_match(self, mrn_map, trial_matches, trial, trial_segment, match_segment, trial_status,
+                      match_tree=None, context=None):
         """
         Given a trial's match tree, finds all patients that matches to it and records the step, arm, or dose
         internal id that it matched to along with the genomic alteration that matched.
@@ -558,14 +1352,19 @@ class MatchEngine(object):
         :param trial_segment: Either the step, arm, or dose segment of the trial document
         :param match_segment: Marker indicating if segment is step, arm, or dose
         :param trial_status: Overall trial status. either open or closed.
+        :param match_tree: Compiled match tree of the segment. Built from the segment if not given.
+        :param context: Trial level fields returned by trial_context. Computed from the trial if not given.
         :return: Dictionary containing the matches
         """
 
         # get all matches
-        match_tree = self.create_match_tree(trial_segment['match'][0])
-        sample_ids, ginfos = self.traverse_match_tree(match_tree)
+        if match_tree is None:
+            match_tree = self.create_match_tree(trial_segment['match'][0])
+        with self.stats.timer('match_tree'):
+            sample_ids, ginfos = self.traverse_match_tree(match_tree)
 
-        clinical = []
+        # clinical fields by sample id
+        clinical = {}
         if sample_ids:
             cproj = {
                     'SAMPLE_ID': 1,
@@ -578,7 +1377,19 @@ class MatchEngine(object):
                     'GENDER': 1,
                     '_id': 1
                 }
-            clinical = list(self.db.clinical.find({'SAMPLE_ID': {'$in': list(sample_ids)}}, cproj))
+            with self.stats.timer('clinical'):
+                for citem in self.db.clinical.find({'SAMPLE_ID': {'$in': list(sample_ids)}}, cproj):
+                    fields = clinical.setdefault(citem['SAMPLE_ID'], {})
+                    for field in citem:
+                        if field == '_id':
+                            fields['clinical_id'] = citem[field]
+                        else:
+                            fields[field.lower()] = citem[field]
+
+        # trial and segment fields shared by every match of this segment
+        if context is None:
+            context = self.trial_context(trial, trial_status)
+        segment_fields = self.segment_context(context, trial_segment, match_segment)
 
         # add to master list if any sample ids matched
         for sample in ginfos:
@@ -587,40 +1398,11 @@ class MatchEngine(object):
                 # add match document
                 match = alteration
                 match['mrn'] = mrn_map[alteration['sample_id']]
-                match['match_level'] = match_segment
-                match['trial_accrual_status'] = trial_status
-                match['cancer_type_match'] = get_cancer_type_match(trial)
-                match['coordinating_center'] = get_coordinating_center(trial)
-
-                trial_keys = ['protocol_no', 'nct_id']
-                for trial_key in trial_keys:
-                    if trial_key in trial.keys():
-                        match[trial_key] = trial[trial_key]
+                match.update(segment_fields)
 
                 # copy clinical document
-                if clinical:
-                    for citem in clinical:
-                        if citem['SAMPLE_ID'] == alteration['sample_id']:
-                            for field in citem:
-                                if field == '_id':
-                                    match['clinical_id'] = citem[field]
-                                else:
-                                    match[field.lower()] = citem[field]
-
-                # add internal id
-                if match_segment == 'dose':
-                    match['internal_id'] = str(trial_segment['level_internal_id'])
-                    match['code'] = trial_segment['level_code']
-                    if 'level_suspended' in trial_segment and trial_segment['level_suspended'].lower() == 'y':
-                        match['trial_accrual_status'] = 'closed'
-                elif match_segment == 'arm':
-                    match['internal_id'] = str(trial_segment['arm_internal_id'])
-                    match['code'] = str(trial_segment['arm_code'])
-                    if 'arm_suspended' in trial_segment and trial_segment['arm_suspended'].lower() == 'y':
-                        match['trial_accrual_status'] = 'closed'
-                elif match_segment == 'step':
-                    match['internal_id'] = str(trial_segment['step_internal_id'])
-                    match['code'] = trial_segment['step_code']
+                if alteration['sample_id'] in clinical:
+                    match.update(clinical[alteration['sample_id']])
 
                 # add to trial_matches
                 trial_matches.append(match)
@@ -692,6 +1474,62 @@ class MatchEngine(object):
 
         return tmpc['ONCOTREE_PRIMARY_DIAGNOSIS_NAME']
 
+    @staticmethod
+    def _search_oncotree_ancestry(onco_tree, c):
+        """
+        Translates the diagnosis criterium of a clinical query into conditions on the oncotree ancestry the loader
+        stores on clinical documents. A diagnosis matches itself and every diagnosis below it, which is one
+        equality on an indexed ancestor code however large its subtree, and _SOLID_ and _LIQUID_ match on flags.
+
+        :param onco_tree: Oncotree
+        :param c: Clinical query with the diagnosis criterium as written in the trial
+        :return: Clinical query on ONCOTREE_ANCESTORS, IS_SOLID, and IS_LIQUID instead of the diagnosis name
+        """
+
+        c = dict(c)
+        included = {'codes': [], 'flags': [], 'any': False}
+        excluded = {'codes': [], 'flags': []}
+        for key, diagnoses in c.pop('ONCOTREE_PRIMARY_DIAGNOSIS_NAME').iteritems():
+            if not isinstance(diagnoses, list):
+                diagnoses = [diagnoses]
+
+            target = included if key in ['$eq', '$in'] else excluded
+            included['any'] = included['any'] or key in ['$eq', '$in']
+            for txt in diagnoses:
+                if txt == '_SOLID_':
+                    target['flags'].append('IS_SOLID')
+                elif txt.endswith('_LIQUID_') or txt.endswith('_SOLID_'):
+                    target['flags'].append('IS_LIQUID')
+                else:
+                    node = oncotreenx.lookup_text(onco_tree, txt)
+                    if onco_tree.has_node(node):
+                        target['codes'].append(node)
+
+        conditions = []
+        if included['any']:
+
+            # diagnoses missing from the oncotree match no sample
+            clauses = [{flag: True} for flag in sorted(set(included['flags']))]
+            codes = sorted(set(included['codes']))
+            if len(codes) == 1:
+                clauses.append({'ONCOTREE_ANCESTORS': codes[0]})
+            elif codes or not clauses:
+                clauses.append({'ONCOTREE_ANCESTORS': {'$in': codes}})
+            conditions.append(clauses[0] if len(clauses) == 1 else {'$or': clauses})
+
+        for flag in sorted(set(excluded['flags'])):
+            conditions.append({flag: {'$ne': True}})
+
+        # diagnoses missing from the oncotree exclude no sample, as with the diagnosis names
+        if excluded['codes'] or not conditions:
+            conditions.append({'ONCOTREE_ANCESTORS': {'$nin': sorted(set(excluded['codes']))}})
+
+        if len(conditions) == 1:
+            c.update(conditions[0])
+        elif conditions:
+            c['$and'] = conditions
+        return c
+
     def _recursive_create(self, parent_id, data, G):
         child_id_set = ['protocol_id', 'arm_internal_id', 'level_internal_id', 'step_internal_id']
         key_set = set(['treatment_list', 'step', 'arm', 'dose_level'])
@@ -740,7 +1578,7 @@ class MatchEngine(object):
 
             # create the match-tree.
             content = {'match': G.node[n]['match']}
-            match_tree = self.create_match_tree(content)
+            match_tree = self.compile_match_tree(content)
 
             # embed it in trial tree.
             G.node[n]['match_tree'] = match_tree
\ No newline at end of file
@@ -0,0 +1,119 @@
+"""Copyright 2016 Dana-Farber Cancer Institute"""
+
+import json
+from bson import json_util
+
+from matchengine.indexes import explain_summary
+
+
+def explain_trial(me, trial):
+    """
+    Compiles a trial and explains the Mongo query of every leaf of every step, arm, and dose level match tree.
+
+    :param me: MatchEngine
+    :param trial: Trial document
+    :return: List of segments, each with the nodes of its match tree in depth first order. Leaves carry their
+        collection, query, projection, and explain summary.
+    """
+
+    segments = []
+    for segment in me.cache.load(trial, me.compile_trial):
+        tree = segment['match_tree']
+        nodes = []
+
+        stack = [(1, 0)]
+        while stack:
+            node_id, depth = stack.pop()
+            node = tree.node[node_id]
+            item = {'node': node_id, 'depth': depth, 'type': node['type'], 'value': node.get('value')}
+
+            leaf = node.get('compiled')
+            if leaf is not None:
+                collection, query, proj = me.leaf_query(leaf)
+                item.update({'collection': collection, 'query': query, 'projection': proj, 'neg': leaf['neg']})
+                if query:
+                    cursor = me.db[collection].find(query, proj)
+                    item['explain'] = explain_summary(cursor.explain())
+
+            nodes.append(item)
+            for child in sorted(tree.successors(node_id), reverse=True):
+                stack.append((child, depth + 1))
+
+        segments.append({
+            'match_segment': segment['match_segment'],
+            'trial_segment': segment['trial_segment'],
+            'nodes': nodes
+        })
+
+    return segments
+
+
+def _plan(e):
+    """Index used by an explained query, or its plan stages if it used none"""
+    return e['index'] or ' > '.join(str(stage) for stage in e['stages'])
+
+
+def collscans(segments):
+    """Returns the leaves of explained segments that scanned a whole collection"""
+    return [node for segment in segments for node in segment['nodes']
+            if node.get('explain') and node['explain']['collscan']]
+
+
+def format_trial(protocol_no, segments):
+    """Returns the match trees of an explained trial with the query and execution of every leaf"""
+
+    lines = ['Trial %s' % protocol_no]
+    for segment in segments:
+        ids = ', '.join('%s=%s' % (k, v) for k, v in sorted(segment['trial_segment'].iteritems()))
+        lines.append('  %s (%s)' % (segment['match_segment'], ids))
+
+        for node in segment['nodes']:
+            indent = '    ' + '  ' * node['depth']
+            if 'collection' not in node:
+                lines.append('%s%s' % (indent, node['type']))
+                continue
+
+            lines.append('%s%s%s %s' % (indent, node['type'], ' (negative)' if node['neg'] else '',
+                                        json.dumps(node['value'], default=str)))
+            lines.append('%s  query: db.%s.find(%s, %s)' % (
+                indent, node['collection'], json.dumps(node['query'], default=json_util.default, sort_keys=True),
+                json.dumps(node['projection'], sort_keys=True)))
+
+            e = node.get('explain')
+            if e is None:
+                lines.append('%s  not executed: empty query' % indent)
+                continue
+
+            lines.append('%s  %s%s: %s keys, %s docs examined, %s returned, %s ms' % (
+                indent, '*** COLLSCAN *** ' if e['collscan'] else '', _plan(e), e['keys_examined'],
+                e['docs_examined'], e['returned'], e['millis']))
+
+    return '\n'.join(lines)
+
+
+def format_run(explained):
+    """
+    Returns a table of every leaf of a run ordered by documents examined, collection scans first.
+
+    :param explained: List of (protocol_no, segments)
+    """
+
+    rows = []
+    for protocol_no, segments in explained:
+        for segment in segments:
+            for node in segment['nodes']:
+                e = node.get('explain')
+                if e is not None:
+                    rows.append((protocol_no, segment['match_segment'], node, e))
+
+    rows.sort(key=lambda r: (not r[3]['collscan'], -(r[3]['docs_examined'] or 0)))
+
+    lines = ['%-12s %-6s %-8s %10s %10s %8s  %s' % ('protocol_no', 'level', 'type', 'keys', 'docs', 'ms', 'plan')]
+    for protocol_no, level, node, e in rows:
+        lines.append('%-12s %-6s %-8s %10s %10s %8s  %s%s' % (
+            protocol_no, level, node['type'], e['keys_examined'], e['docs_examined'], e['millis'],
+            '*** COLLSCAN *** ' if e['collscan'] else '', _plan(e)))
+
+    n = sum(1 for r in rows if r[3]['collscan'])
+    lines.append('%d leaves, %d scanned a whole collection' % (len(rows), n))
+    return '\n'.join(lines)
@@ -0,0 +1,126 @@
+"""Copyright 2016 Dana-Farber Cancer Institute"""
+
+import json
+import numpy as np
+import pandas as pd
+
+# Dense column types for patient files.
+#
+# Repeated strings are read as categoricals, which store every distinct value once plus an integer code per
+# row; sample ids are interned the same way. Integer columns with missing values cannot be integer arrays in
+# pandas, so they are kept as float32 when that is exact and converted back to integers when the documents are
+# built. Allele fractions are float32.
+
+CLINICAL_CATEGORIES = ['ONCOTREE_PRIMARY_DIAGNOSIS_NAME', 'GENDER', 'VITAL_STATUS', 'ORD_PHYSICIAN_NAME',
+                       'ORD_PHYSICIAN_EMAIL']
+
+GENOMIC_CATEGORIES = ['SAMPLE_ID', 'TRUE_HUGO_SYMBOL', 'TRUE_VARIANT_CLASSIFICATION', 'VARIANT_CATEGORY',
+                      'CNV_CALL', 'CHROMOSOME', 'CANONICAL_STRAND']
+
+# integer columns, stored as integers in the database
+INTEGER_COLUMNS = ['TRUE_TRANSCRIPT_EXON', 'POSITION', 'TIER']
+
+FLOAT32_COLUMNS = ['ALLELE_FRACTION']
+
+# float32 holds 7 significant digits; values are rounded to this many decimals when documents are built, so a
+# value read as 0.22 is stored as 0.22 rather than 0.2199999988
+FLOAT32_DECIMALS = 6
+
+# largest integer a float32 holds exactly
+_FLOAT32_MAX_INT = 2 ** 24
+
+
+def read_patient_csv(path, categories):
+    """
+    Reads a clinical or genomic CSV file with dense column types
+
+    :param path: Path to the CSV file
+    :param categories: Columns to read as categoricals, e.g. GENOMIC_CATEGORIES. Columns missing from the file
+        are ignored.
+    :return: DataFrame
+    """
+
+    columns = pd.read_csv(path, nrows=0).columns
+    dtype = dict((column, 'category') for column in categories if column in columns)
+    df = pd.read_csv(path, dtype=dtype, low_memory=False)
+    return densify(df, categories)
+
+
+def densify(df, categories=()):
+    """
+    Converts the columns of a DataFrame to dense types in place, see read_patient_csv. Columns whose values are
+    not of the expected kind, e.g. an exon column holding text, are left as they are.
+
+    :param df: DataFrame
+    :param categories: Columns to convert to categoricals
+    :return: DataFrame
+    """
+
+    for column in categories:
+        if column in df.columns:
+            df[column] = _category(df[column])
+
+    for column in INTEGER_COLUMNS:
+        if column in df.columns and df[column].dtype.kind in 'iuf':
+            df[column] = _integer(df[column])
+
+    for column in FLOAT32_COLUMNS:
+        if column in df.columns and df[column].dtype.kind in 'iuf':
+            df[column] = df[column].astype(np.float32)
+
+    return df
+
+
+def _category(series):
+    """Categorical of a column, with numeric categories if every value is a number, as read_csv would infer"""
+
+    if not hasattr(series, 'cat'):
+        series = series.astype('category')
+
+    categories = series.cat.categories
+    if categories.dtype == object and len(categories):
+        numeric = pd.to_numeric(categories, errors='coerce')
+        if not pd.isnull(numeric).any() and len(set(numeric)) == len(categories):
+            series = series.cat.rename_categories(numeric)
+    return series
+
+
+def _integer(series):
+    """Smallest exact type of an integer column: an integer type without missing values, float32 or float64 with"""
+
+    if series.isnull().any():
+        present = series.dropna()
+        if len(present) and present.abs().max() < _FLOAT32_MAX_INT:
+            return series.astype(np.float32)
+        return series
+    return pd.to_numeric(series, downcast='integer')
+
+
+def frame_records(df, chunk_size=10000):
+    """
+    Yields the rows of a DataFrame as JSON-compatible documents, chunk_size rows at a time, so the documents of
+    a large file never exist at once. Missing values are None, categoricals their values, integer columns
+    integers, and float32 columns rounded to FLOAT32_DECIMALS.
+
+    :param df: DataFrame
+    :param chunk_size: Number of rows per chunk
+    :return: Generator of lists of dictionaries
+    """
+
+    integers = [column for column in INTEGER_COLUMNS if column in df.columns and df[column].dtype.kind == 'f']
+
+    for start in range(0, len(df.index), chunk_size):
+        chunk = df.iloc[start:start + chunk_size]
+
+        float32s = [column for column in chunk.columns if chunk[column].dtype == np.float32]
+        if float32s:
+            chunk = chunk.copy()
+            for column in float32s:
+                chunk[column] = chunk[column].astype(np.float64).round(FLOAT32_DECIMALS)
+
+        records = json.loads(chunk.to_json(orient='records'))
+        for record in records:
+            for column in integers:
+                if record.get(column) is not None:
+                    record[column] = int(record[column])
+        yield records
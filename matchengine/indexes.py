@@ -0,0 +1,273 @@
+"""Copyright 2016 Dana-Farber Cancer Institute"""
+
+import logging
+from pymongo import ASCENDING
+
+from matchengine.engine import MatchEngine, SAMPLE_ID_PROJECTION
+from matchengine.monitor import query_shape
+
+# indexes every run relies on regardless of the trial criteria
+BASE_INDEXES = {
+    'clinical': [[('SAMPLE_ID', ASCENDING)], [('MRN', ASCENDING)]],
+    'genomic': [[('SAMPLE_ID', ASCENDING)]],
+    'trial': [[('protocol_no', ASCENDING)]]
+}
+
+# fields stored as arrays cannot be part of a covering index
+ARRAY_FIELDS = ['SV_GENES']
+
+# conjunctive branches considered per query before giving up on expanding $or clauses
+MAX_BRANCHES = 32
+
+EQUALITY_OPS = ['$eq', '$in']
+RANGE_OPS = ['$lt', '$lte', '$gt', '$gte', '$regex']
+
+
+def _kind(spec):
+    """Classifies the condition on a field as an equality, a range, or a condition an index barely narrows"""
+
+    if isinstance(spec, dict) and spec and all(k.startswith('$') for k in spec):
+        if any(op in spec for op in EQUALITY_OPS):
+            return 'eq'
+        if any(op in spec for op in RANGE_OPS):
+            return 'range'
+        return 'other'
+    elif hasattr(spec, 'pattern'):
+        return 'range'
+    return 'eq'
+
+
+def _merge(a, b):
+    out = dict(a)
+    for field, kind in b.iteritems():
+        if field not in out or kind == 'eq' or (kind == 'range' and out[field] == 'other'):
+            out[field] = kind
+    return out
+
+
+def query_branches(query):
+    """
+    Expands a query into the conjunctive branches an index has to serve, one per combination of $or clauses.
+
+    :param query: Mongo query
+    :return: List of dictionaries mapping each field to "eq", "range", or "other"
+    """
+
+    branches = [{}]
+    for key, spec in query.iteritems():
+        if key == '$and':
+            for q in spec:
+                branches = [_merge(b, x) for b in branches for x in query_branches(q)]
+        elif key == '$or':
+            clauses = []
+            for q in spec:
+                clauses.extend(query_branches(q))
+            branches = [_merge(b, x) for b in branches for x in clauses]
+        elif not key.startswith('$'):
+            branches = [_merge(b, {key: _kind(spec)}) for b in branches]
+        branches = branches[:MAX_BRANCHES]
+    return branches
+
+
+def explain_summary(explain):
+    """
+    Summarizes the output of cursor.explain() for both the executionStats format of MongoDB 3.0 and later
+    and the legacy format.
+
+    :param explain: Explain document
+    :return: Dictionary with the plan stages, the index used, keys and documents examined, documents returned,
+        execution time, and whether the whole collection was scanned
+    """
+
+    if 'queryPlanner' in explain:
+        stages = []
+        indexes = []
+
+        def _walk(plan):
+            stages.append(plan.get('stage'))
+            if 'indexName' in plan:
+                indexes.append(plan['indexName'])
+            if 'inputStage' in plan:
+                _walk(plan['inputStage'])
+            for stage in plan.get('inputStages', []):
+                _walk(stage)
+
+        _walk(explain['queryPlanner'].get('winningPlan', {}))
+        stats = explain.get('executionStats', {})
+        return {
+            'stages': stages,
+            'index': ', '.join(indexes) or None,
+            'keys_examined': stats.get('totalKeysExamined'),
+            'docs_examined': stats.get('totalDocsExamined'),
+            'returned': stats.get('nReturned'),
+            'millis': stats.get('executionTimeMillis'),
+            'collscan': 'COLLSCAN' in stages
+        }
+
+    cursor = explain.get('cursor', '')
+    return {
+        'stages': [cursor],
+        'index': cursor.split(' ', 1)[1] if cursor.startswith('BtreeCursor') else None,
+        'keys_examined': explain.get('nscanned'),
+        'docs_examined': explain.get('nscannedObjects'),
+        'returned': explain.get('n'),
+        'millis': explain.get('millis'),
+        'collscan': cursor.startswith('BasicCursor')
+    }
+
+
+def _covers(existing, keys):
+    """True if an existing index serves the same queries as the keys, i.e. the keys are a prefix of it"""
+    return [k for k, _ in existing[:len(keys)]] == [k for k, _ in keys]
+
+
+class IndexAdvisor(object):
+    """
+    Derives the compound indexes that serve the leaf queries of every trial in the database.
+
+    Each leaf query is expanded into its conjunctive branches. Equality fields come first in an index, ordered by
+    how many leaves use them so indexes share prefixes, followed by range and regex fields. Leaves are evaluated on
+    sample ids only, so their indexes also include SAMPLE_ID, the query is covered, and Mongo never fetches the
+    documents.
+    """
+
+    def __init__(self, db, max_indexes=8):
+        self.db = db
+        self.max_indexes = max_indexes
+        self.me = MatchEngine(db)
+        self.queries = []
+
+    def collect(self):
+        """Compiles every trial and records how each of its leaves is queried, without storing the compiled plans"""
+
+        self.queries = []
+        for trial in self.db.trial.find({}, {'protocol_no': 1, 'treatment_list': 1}):
+            for segment in self.me.cache.load(trial, self.me.compile_trial, persist=False):
+                tree = segment['match_tree']
+                for node_id in tree.nodes():
+                    leaf = tree.node[node_id].get('compiled')
+                    if leaf is None:
+                        continue
+
+                    collection, query, proj = self.me.leaf_query(leaf)
+                    if query:
+                        self.queries.append({
+                            'protocol_no': trial['protocol_no'],
+                            'collection': collection,
+                            'query': query,
+                            'projection': proj,
+                            'covered': proj == SAMPLE_ID_PROJECTION
+                        })
+
+        logging.info('Collected %d leaf queries' % len(self.queries))
+        return self.queries
+
+    def propose(self):
+        """
+        Proposes indexes for the collected queries. Indexes that are a prefix of another proposal or of an
+        existing index are left out.
+
+        :return: Dictionary of collection to a list of (keys, number of leaves served)
+        """
+
+        # how often each field is used, to order equality fields
+        usage = {}
+        for q in self.queries:
+            for branch in query_branches(q['query']):
+                for field in branch:
+                    usage[(q['collection'], field)] = usage.get((q['collection'], field), 0) + 1
+
+        candidates = {}
+        for q in self.queries:
+            collection = q['collection']
+            seen = set()
+            for branch in query_branches(q['query']):
+                rank = lambda f: (-usage[(collection, f)], f)
+                keys = sorted([f for f, k in branch.iteritems() if k == 'eq'], key=rank)
+                keys += sorted([f for f, k in branch.iteritems() if k == 'range'], key=rank)
+
+                if q['covered'] and not any(f in ARRAY_FIELDS for f in branch):
+                    keys += sorted([f for f, k in branch.iteritems() if k == 'other'], key=rank)
+                    if 'SAMPLE_ID' not in keys:
+                        keys.append('SAMPLE_ID')
+
+                keys = tuple((f, ASCENDING) for f in keys)
+                if keys and keys not in seen:
+                    seen.add(keys)
+                    candidates[(collection, keys)] = candidates.get((collection, keys), 0) + 1
+
+        for collection, indexes in BASE_INDEXES.iteritems():
+            for keys in indexes:
+                candidates.setdefault((collection, tuple(keys)), 0)
+
+        existing = {}
+        for collection in set(c for c, _ in candidates):
+            existing[collection] = [list(info['key']) for info in self.db[collection].index_information().values()]
+
+        proposals = {}
+        for (collection, keys), n in sorted(candidates.items(), key=lambda x: (-x[1], x[0])):
+            keys = list(keys)
+            others = [list(k) for (c, k) in candidates if c == collection and len(k) > len(keys)]
+            if any(_covers(index, keys) for index in existing[collection] + others):
+                continue
+
+            proposals.setdefault(collection, [])
+            if len(proposals[collection]) < self.max_indexes:
+                proposals[collection].append((keys, n))
+
+        return proposals
+
+    def explain(self):
+        """
+        Explains one query of every distinct query shape.
+
+        :return: List of dictionaries with the collection, shape, number of leaves, and explain summary
+        """
+
+        shapes = {}
+        for q in self.queries:
+            key = (q['collection'], query_shape(q['query']), q['covered'])
+            if key not in shapes:
+                shapes[key] = dict(q, shape=key[1], leaves=0)
+            shapes[key]['leaves'] += 1
+
+        results = []
+        for key in sorted(shapes):
+            q = shapes[key]
+            cursor = self.db[q['collection']].find(q['query'], q['projection'])
+            results.append({
+                'collection': q['collection'],
+                'shape': q['shape'],
+                'leaves': q['leaves'],
+                'explain': explain_summary(cursor.explain())
+            })
+        return results
+
+    def create(self, proposals):
+        """Creates the proposed indexes"""
+        for collection, indexes in proposals.iteritems():
+            for keys, _ in indexes:
+                logging.info('Creating index on %s: %s' % (collection, keys))
+                self.db[collection].create_index(keys)
+
+
+def format_proposals(proposals):
+    """Returns a table of the proposed indexes"""
+
+    lines = ['%-12s %8s  %s' % ('collection', 'leaves', 'index')]
+    for collection in sorted(proposals):
+        for keys, n in proposals[collection]:
+            lines.append('%-12s %8d  %s' % (collection, n, ', '.join('%s: %d' % k for k in keys)))
+    return '\n'.join(lines)
+
+
+def format_explains(before, after=None):
+    """Returns a table of the documents examined per query shape, before and after creating indexes"""
+
+    lines = ['%-10s %7s %12s %12s  %-30s %s' % ('collection', 'leaves', 'docs before', 'docs after', 'index', 'shape')]
+    for i, b in enumerate(before):
+        a = after[i]['explain'] if after else b['explain']
+        lines.append('%-10s %7d %12s %12s  %-30s %s' % (
+            b['collection'], b['leaves'], b['explain']['docs_examined'], a['docs_examined'],
+            a['index'] or 'COLLSCAN', b['shape']))
+    return '\n'.join(lines)
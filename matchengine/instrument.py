@@ -0,0 +1,180 @@
+"""Copyright 2016 Dana-Farber Cancer Institute"""
+
+import json
+import time
+import heapq
+import logging
+import resource
+
+
+class _NullTimer(object):
+    """Timer handed out when instrumentation is disabled"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class _Timer(object):
+    """Adds the time spent inside a with-block to a stage"""
+
+    def __init__(self, stats, stage):
+        self.stats = stats
+        self.stage = stage
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        self.stats.add_time(self.stage, time.time() - self.start)
+        self.stats.stages[self.stage]['peak_rss_mb'] = self.stats.peak_rss_mb()
+        return False
+
+
+class Instrumentation(object):
+    """
+    Collects timers and counters for the stages of a matching run, the slowest trials and leaf queries,
+    and the number of documents returned per leaf.
+
+    When disabled, every method returns immediately and timers are a shared no-op context manager,
+    so an instrumented engine costs next to nothing when nobody is looking.
+    """
+
+    def __init__(self, enabled=True, top_n=10):
+        self.enabled = enabled
+        self.top_n = top_n
+        self.stages = {}
+        self.counters = {}
+        self.trials = []
+        self.leaves = []
+        self.leaf_docs = []
+        self.started = time.time()
+
+    def timer(self, stage):
+        """
+        Returns a context manager timing a stage.
+
+        :param stage: Name of the stage, e.g. "sort"
+        """
+        if not self.enabled:
+            return _NULL_TIMER
+        return _Timer(self, stage)
+
+    def start(self):
+        """Returns a start time to pass to the record methods, or None when disabled"""
+        if not self.enabled:
+            return None
+        return time.time()
+
+    def add_time(self, stage, seconds):
+        """Adds a measurement to a stage"""
+        if not self.enabled:
+            return
+
+        if stage not in self.stages:
+            self.stages[stage] = {'calls': 0, 'seconds': 0.0, 'max_seconds': 0.0}
+        s = self.stages[stage]
+        s['calls'] += 1
+        s['seconds'] += seconds
+        if seconds > s['max_seconds']:
+            s['max_seconds'] = seconds
+
+    def incr(self, counter, n=1):
+        """Increments a counter"""
+        if not self.enabled:
+            return
+        self.counters[counter] = self.counters.get(counter, 0) + n
+
+    def record_trial(self, protocol_no, start, n_matches):
+        """
+        Records the time spent matching a single trial
+
+        :param protocol_no: Trial protocol number
+        :param start: Value returned by start()
+        :param n_matches: Number of trial matches found for the trial
+        """
+        if not self.enabled:
+            return
+
+        seconds = time.time() - start
+        self.add_time('trial', seconds)
+        self._push(self.trials, (seconds, {'protocol_no': protocol_no, 'seconds': seconds, 'matches': n_matches}))
+
+    def record_leaf(self, protocol_no, node, start, n_docs):
+        """
+        Records the time spent running a single leaf query of a match tree
+
+        :param protocol_no: Trial protocol number the leaf belongs to
+        :param node: Leaf node of the match tree
+        :param start: Value returned by start()
+        :param n_docs: Number of documents the query returned
+        """
+        if not self.enabled:
+            return
+
+        seconds = time.time() - start
+        self.add_time('leaf.%s' % node['type'], seconds)
+        self.incr('documents.%s' % node['type'], n_docs)
+
+        leaf = {
+            'protocol_no': protocol_no,
+            'type': node['type'],
+            'criteria': node.get('value'),
+            'seconds': seconds,
+            'documents': n_docs
+        }
+        self._push(self.leaves, (seconds, leaf))
+        self._push(self.leaf_docs, (n_docs, leaf))
+
+    def _push(self, heap, item):
+        """Keeps the top N items of a heap"""
+        if len(heap) < self.top_n:
+            heapq.heappush(heap, item)
+        else:
+            heapq.heappushpop(heap, item)
+
+    @staticmethod
+    def peak_rss_mb():
+        """Peak resident set size of this process in megabytes"""
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+    def report(self):
+        """Returns the collected measurements as a dictionary"""
+        return {
+            'wall_seconds': time.time() - self.started,
+            'peak_rss_mb': self.peak_rss_mb(),
+            'stages': self.stages,
+            'counters': self.counters,
+            'slowest_trials': [t for _, t in sorted(self.trials, reverse=True)],
+            'slowest_leaves': [l for _, l in sorted(self.leaves, reverse=True)],
+            'largest_leaves': [l for _, l in sorted(self.leaf_docs, reverse=True)]
+        }
+
+    def summary(self):
+        """Returns a table of time spent per stage"""
+
+        lines = ['%-24s %8s %12s %12s' % ('stage', 'calls', 'seconds', 'max')]
+        for stage, s in sorted(self.stages.items(), key=lambda x: -x[1]['seconds']):
+            lines.append('%-24s %8d %12.3f %12.3f' % (stage, s['calls'], s['seconds'], s['max_seconds']))
+
+        for counter, n in sorted(self.counters.items()):
+            lines.append('%-24s %8d' % (counter, n))
+
+        lines.append('%-24s %21.1f' % ('peak rss (MB)', self.peak_rss_mb()))
+        return '\n'.join(lines)
+
+    def write(self, path):
+        """Logs the summary table and writes the full report as JSON"""
+        if not self.enabled:
+            return
+
+        logging.info('Match run profile:\n%s' % self.summary())
+        with open(path, 'w') as f:
+            json.dump(self.report(), f, indent=2, default=str)
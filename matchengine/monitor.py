@@ -0,0 +1,242 @@
+"""Copyright 2016 Dana-Farber Cancer Institute"""
+
+import json
+import heapq
+import random
+import logging
+import threading
+from collections import OrderedDict
+from bson import BSON
+
+# command monitoring was added in pymongo 3.1
+try:
+    from pymongo import monitoring
+    _CommandListener = monitoring.CommandListener
+except ImportError:
+    monitoring = None
+    _CommandListener = object
+
+# commands whose first field names the collection they run against
+COLLECTION_COMMANDS = ['find', 'distinct', 'count', 'aggregate', 'insert', 'update', 'delete',
+                       'findAndModify', 'createIndexes', 'drop']
+
+# bounds on what a monitor keeps, so it can run for the lifetime of a daemon: latencies sampled per collection
+# and operation for the percentiles, query shapes tracked before the rest are grouped together, and open
+# cursors remembered, the oldest being forgotten first
+MAX_LATENCIES = 10000
+MAX_SHAPES = 1000
+MAX_CURSORS = 1000
+
+# shape of the queries beyond MAX_SHAPES
+OTHER_SHAPE = 'other'
+
+
+def query_shape(query):
+    """
+    Returns the shape of a query: its fields and operators with every value replaced by "?".
+    Queries that only differ by their values share a shape.
+
+    :param query: Mongo query
+    :return: Shape as a json string
+    """
+
+    def _shape(q):
+        if isinstance(q, dict):
+            return dict((k, _shape(v) if k in ['$and', '$or', '$nor', '$not', '$elemMatch'] or isinstance(v, dict)
+                         else '?') for k, v in q.iteritems())
+        elif isinstance(q, list):
+            return [_shape(v) for v in q]
+        return '?'
+
+    if query is None:
+        return '{}'
+    return json.dumps(_shape(query), sort_keys=True)
+
+
+def percentile(values, pct):
+    """Returns the percentile of a sorted list of values"""
+    if not values:
+        return 0.0
+    idx = int(round((len(values) - 1) * pct / 100.0))
+    return values[idx]
+
+
+class CommandMonitor(_CommandListener):
+    """
+    Listens to every command pymongo sends and aggregates the count, latency, documents returned, and reply
+    size per collection and operation, along with the time spent per query shape. Memory is bounded: the
+    percentiles are computed from a uniform sample of at most MAX_LATENCIES latencies per operation.
+    """
+
+    def __init__(self, top_n=10):
+        self.top_n = top_n
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.cursors = OrderedDict()
+        self.operations = {}
+        self.shapes = {}
+        self.random = random.Random(0)
+
+    def started(self, event):
+        cmd = event.command
+        name = event.command_name
+
+        # cursors closed before they were exhausted
+        if name == 'killCursors':
+            with self.lock:
+                for cursor_id in cmd.get('cursors', []):
+                    self.cursors.pop(cursor_id, None)
+            return
+
+        cursor_id = None
+        if name == 'getMore':
+            collection = cmd.get('collection')
+            cursor_id = cmd.get(name)
+            shape = self.cursors.get(cursor_id)
+        elif name in COLLECTION_COMMANDS:
+            collection = cmd.get(name)
+            shape = query_shape(cmd.get('filter', cmd.get('query')))
+        else:
+            return
+
+        with self.lock:
+            self.pending[event.request_id] = (collection, name, shape, cursor_id)
+
+    def succeeded(self, event):
+        with self.lock:
+            pending = self.pending.pop(event.request_id, None)
+        if pending is None:
+            return
+
+        collection, name, shape, cursor_id = pending
+        reply = event.reply
+
+        # documents returned
+        n_docs = 0
+        if 'cursor' in reply:
+            cursor = reply['cursor']
+            n_docs = len(cursor.get('firstBatch', cursor.get('nextBatch', [])))
+
+            # attribute the remaining batches to the query that opened the cursor
+            with self.lock:
+                if cursor.get('id'):
+                    self.cursors[cursor['id']] = shape
+                    if len(self.cursors) > MAX_CURSORS:
+                        self.cursors.popitem(last=False)
+                elif cursor_id is not None:
+                    self.cursors.pop(cursor_id, None)
+        elif 'values' in reply:
+            n_docs = len(reply['values'])
+        elif 'n' in reply:
+            n_docs = reply['n']
+
+        self._record(collection, name, shape, event.duration_micros / 1000.0, n_docs, len(BSON.encode(reply)))
+
+    def failed(self, event):
+        with self.lock:
+            pending = self.pending.pop(event.request_id, None)
+        if pending is None:
+            return
+
+        collection, name, shape, cursor_id = pending
+        self._record(collection, name, shape, event.duration_micros / 1000.0, 0, 0, failed=True)
+
+    def _record(self, collection, name, shape, ms, n_docs, n_bytes, failed=False):
+        """Adds a finished command to the aggregates"""
+
+        with self.lock:
+            key = (collection, name)
+            if key not in self.operations:
+                self.operations[key] = {'count': 0, 'total_ms': 0.0, 'max_ms': 0.0, 'latencies': [], 'documents': 0,
+                                        'bytes': 0, 'failures': 0}
+            op = self.operations[key]
+            op['count'] += 1
+            op['total_ms'] += ms
+            op['max_ms'] = max(op['max_ms'], ms)
+            op['documents'] += n_docs
+            op['bytes'] += n_bytes
+            if failed:
+                op['failures'] += 1
+
+            # reservoir sample of the latencies
+            if len(op['latencies']) < MAX_LATENCIES:
+                op['latencies'].append(ms)
+            else:
+                i = self.random.randint(0, op['count'] - 1)
+                if i < MAX_LATENCIES:
+                    op['latencies'][i] = ms
+
+            if shape is not None:
+                skey = (collection, name if name != 'getMore' else 'find', shape)
+                if skey not in self.shapes and len(self.shapes) >= MAX_SHAPES:
+                    skey = (collection, skey[1], OTHER_SHAPE)
+                if skey not in self.shapes:
+                    self.shapes[skey] = {'count': 0, 'total_ms': 0.0, 'max_ms': 0.0, 'documents': 0}
+                s = self.shapes[skey]
+                s['count'] += 1
+                s['total_ms'] += ms
+                s['documents'] += n_docs
+                if ms > s['max_ms']:
+                    s['max_ms'] = ms
+
+    def report(self):
+        """Returns the aggregates per collection and operation and the slowest query shapes"""
+
+        operations = []
+        with self.lock:
+            for (collection, name), op in sorted(self.operations.items()):
+                latencies = sorted(op['latencies'])
+                operations.append({
+                    'collection': collection,
+                    'operation': name,
+                    'count': op['count'],
+                    'failures': op['failures'],
+                    'documents': op['documents'],
+                    'bytes': op['bytes'],
+                    'total_ms': op['total_ms'],
+                    'p50_ms': percentile(latencies, 50),
+                    'p90_ms': percentile(latencies, 90),
+                    'p99_ms': percentile(latencies, 99),
+                    'max_ms': op['max_ms']
+                })
+
+            shapes = [dict(s, collection=c, operation=n, shape=shape)
+                      for (c, n, shape), s in self.shapes.iteritems()]
+
+        return {
+            'operations': operations,
+            'slowest_shapes': heapq.nlargest(self.top_n, shapes, key=lambda s: s['total_ms'])
+        }
+
+    def summary(self):
+        """Returns a table of the aggregates per collection and operation"""
+
+        lines = ['%-16s %-12s %8s %10s %10s %10s %12s %12s' % (
+            'collection', 'operation', 'count', 'p50 ms', 'p99 ms', 'max ms', 'documents', 'bytes')]
+        for op in self.report()['operations']:
+            lines.append('%-16s %-12s %8d %10.2f %10.2f %10.2f %12d %12d' % (
+                op['collection'], op['operation'], op['count'], op['p50_ms'], op['p99_ms'], op['max_ms'],
+                op['documents'], op['bytes']))
+        return '\n'.join(lines)
+
+    def write(self, path):
+        """Logs the summary table and writes the full report as JSON"""
+        logging.info('Mongo commands:\n%s' % self.summary())
+        with open(path, 'w') as f:
+            json.dump(self.report(), f, indent=2, default=str)
+
+
+def register_monitor(top_n=10):
+    """
+    Registers a CommandMonitor with pymongo. Must be called before the Mongo connection is opened.
+
+    :return: The monitor, or None if this pymongo does not support command monitoring
+    """
+
+    if monitoring is None:
+        logging.error('Mongo command monitoring requires pymongo 3.1 or later, see requirements.txt')
+        return None
+
+    monitor = CommandMonitor(top_n=top_n)
+    monitoring.register(monitor)
+    return monitor
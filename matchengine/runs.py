@@ -0,0 +1,145 @@
+"""Copyright 2016 Dana-Farber Cancer Institute"""
+
+import logging
+import datetime as dt
+from bson.objectid import ObjectId
+
+RUN_COLLECTION = 'match_run'
+STAGING_COLLECTION = 'trial_match_staging'
+QUEUE_COLLECTION = 'match_queue'
+
+# runs that did not finish this long after they started are expired and their staged matches removed
+RUN_EXPIRY = dt.timedelta(days=7)
+
+
+class MatchRun(object):
+    """
+    Checkpoints a match run. The matches of every trial are written to a staging collection as soon as the
+    trial is matched, and a manifest records which trials are done. A run that died can be resumed by its id:
+    the trials already matched are skipped and their matches are read back from the staging collection.
+
+    :param db: Database connection
+    :param run_id: Id of the run to resume. A new run is started if not given.
+    """
+
+    def __init__(self, db, run_id=None):
+        self.db = db
+
+        if run_id is None:
+            self.run_id = str(ObjectId())
+            self.manifest = {'_id': self.run_id, 'status': 'matching', 'started': dt.datetime.utcnow(),
+                             'completed': []}
+            self.db[RUN_COLLECTION].insert_one(self.manifest)
+            self.db[STAGING_COLLECTION].create_index([('run_id', 1), ('protocol_no', 1)])
+            self.db[STAGING_COLLECTION].create_index([('run_id', 1), ('shard', 1)])
+            logging.info('Started match run %s' % self.run_id)
+        else:
+            self.run_id = run_id
+            self.manifest = self.db[RUN_COLLECTION].find_one({'_id': run_id})
+            if self.manifest is None:
+                raise ValueError('Unknown match run %s' % run_id)
+            if self.manifest['status'] == 'done':
+                raise ValueError('Match run %s already finished' % run_id)
+            if self.manifest['status'] == 'expired':
+                raise ValueError('Match run %s expired and its staged matches were removed' % run_id)
+            logging.info('Resuming match run %s: %d trials already matched' % (run_id, len(self.completed)))
+
+    @property
+    def completed(self):
+        """Protocol numbers of the trials whose matches are staged"""
+        return set(self.manifest['completed'])
+
+    def stage(self, protocol_no, matches):
+        """
+        Stores the matches of a trial and marks the trial done. Matches staged earlier for the trial, e.g. by an
+        attempt that died before marking it done, are replaced.
+
+        :param protocol_no: Protocol number
+        :param matches: List of matches of the trial
+        """
+
+        staging = self.db[STAGING_COLLECTION]
+        staging.delete_many({'run_id': self.run_id, 'protocol_no': protocol_no})
+        if matches:
+            staging.insert_many([dict(match, run_id=self.run_id) for match in matches])
+
+        self.db[RUN_COLLECTION].update_one({'_id': self.run_id}, {'$addToSet': {'completed': protocol_no}})
+        self.manifest['completed'].append(protocol_no)
+
+    def stage_shard(self, shard, matches):
+        """
+        Stores the matches of a shard of the run, e.g. a range of samples matched to every trial. Matches staged
+        earlier for the shard are replaced.
+
+        :param shard: Shard id
+        :param matches: List of matches of the shard
+        """
+
+        staging = self.db[STAGING_COLLECTION]
+        staging.delete_many({'run_id': self.run_id, 'shard': shard})
+        if matches:
+            staging.insert_many([dict(match, run_id=self.run_id, shard=shard) for match in matches])
+
+    def staged(self):
+        """Returns the matches of every trial matched by the run"""
+
+        matches = []
+        for match in self.db[STAGING_COLLECTION].find({'run_id': self.run_id}):
+            del match['_id']
+            del match['run_id']
+            match.pop('shard', None)
+            matches.append(match)
+        return matches
+
+    def set_deferred(self, deferred):
+        """
+        Records the trials the run deferred because they ran over their time budget in the manifest
+
+        :param deferred: Dictionary with the reason every trial was deferred, by protocol number
+        """
+
+        self.manifest['deferred'] = [{'protocol_no': protocol_no, 'reason': reason}
+                                     for protocol_no, reason in sorted(deferred.iteritems())]
+        self.db[RUN_COLLECTION].update_one({'_id': self.run_id}, {'$set': {'deferred': self.manifest['deferred']}})
+
+    def set_status(self, status):
+        self.manifest['status'] = status
+        self.db[RUN_COLLECTION].update_one({'_id': self.run_id}, {'$set': {'status': status}})
+
+    def finish(self):
+        """Marks the run done and removes its staged matches"""
+
+        self.db[RUN_COLLECTION].update_one({'_id': self.run_id}, {'$set': {
+            'status': 'done', 'finished': dt.datetime.utcnow()}})
+        self.manifest['status'] = 'done'
+        self.db[STAGING_COLLECTION].delete_many({'run_id': self.run_id})
+        logging.info('Finished match run %s' % self.run_id)
+
+
+def unfinished_runs(db):
+    """Returns the manifests of the runs that did not finish and can be resumed, most recent first"""
+    return list(db[RUN_COLLECTION].find({'status': {'$nin': ['done', 'expired']}}).sort('_id', -1))
+
+
+def expire_runs(db, max_age=RUN_EXPIRY):
+    """
+    Expires the runs that did not finish and were started more than max_age ago: their staged matches and
+    queued shards are removed, and they can no longer be resumed.
+
+    :param db: Database connection
+    :param max_age: Timedelta after which an unfinished run is expired
+    :return: Ids of the expired runs
+    """
+
+    cutoff = dt.datetime.utcnow() - max_age
+    query = {'status': {'$nin': ['done', 'expired']}, 'started': {'$lt': cutoff}}
+    run_ids = [manifest['_id'] for manifest in db[RUN_COLLECTION].find(query, {'_id': 1})]
+    if not run_ids:
+        return []
+
+    db[STAGING_COLLECTION].delete_many({'run_id': {'$in': run_ids}})
+    db[QUEUE_COLLECTION].delete_many({'run_id': {'$in': run_ids}})
+    db[RUN_COLLECTION].update_many({'_id': {'$in': run_ids}}, {'$set': {
+        'status': 'expired', 'finished': dt.datetime.utcnow()}})
+    logging.info('Expired %d match runs started before %s: %s' % (len(run_ids), cutoff, ', '.join(run_ids)))
+    return run_ids
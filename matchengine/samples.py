@@ -0,0 +1,115 @@
+"""Copyright 2016 Dana-Farber Cancer Institute"""
+
+from bisect import bisect_left
+
+
+class Complement(object):
+    """
+    Samples matched by a negative criterium: every sample of the cohort except the excluded ones, plus samples
+    outside the cohort picked up by OR clauses. Kept in this form so a negative leaf costs the size of what it
+    excludes rather than the size of the cohort.
+
+    :param universe: Set of all sample ids of the cohort. Shared, never modified.
+    :param excluded: Set of excluded sample ids
+    :param extra: Set of matched sample ids outside the cohort
+    """
+
+    __slots__ = ['universe', 'excluded', 'extra']
+
+    def __init__(self, universe, excluded, extra=frozenset()):
+        self.universe = universe
+        self.excluded = excluded
+        self.extra = extra
+
+    def materialize(self):
+        """Returns the matched sample ids as a set"""
+        return (self.universe - self.excluded) | self.extra
+
+    def __contains__(self, sample_id):
+        return sample_id in self.extra or (sample_id in self.universe and sample_id not in self.excluded)
+
+    def __len__(self):
+        return len(self.materialize())
+
+
+def materialize(samples):
+    """Returns a set of sample ids for a set or a Complement"""
+    if isinstance(samples, Complement):
+        return samples.materialize()
+    return samples
+
+
+def intersect(a, b):
+    """Intersection of two sets of sample ids, either of which may be a Complement"""
+
+    if isinstance(a, Complement) and isinstance(b, Complement):
+        return Complement(a.universe, a.excluded | b.excluded, a.extra & b.extra)
+    elif isinstance(a, Complement):
+        a, b = b, a
+
+    if isinstance(b, Complement):
+        return ((a & b.universe) - b.excluded) | (a & b.extra)
+    return a & b
+
+
+def union(a, b):
+    """Union of two sets of sample ids, either of which may be a Complement"""
+
+    if isinstance(a, Complement) and isinstance(b, Complement):
+        return Complement(a.universe, a.excluded & b.excluded, a.extra | b.extra)
+    elif isinstance(a, Complement):
+        a, b = b, a
+
+    if isinstance(b, Complement):
+        return Complement(b.universe, b.excluded - a, b.extra | (a - b.universe))
+    return a | b
+
+
+def sample_range_condition(sample_range):
+    """
+    Returns the query condition on sample ids for a half open range of sample ids
+
+    :param sample_range: Dictionary with the first sample id of the range, "min", and the first sample id after
+        it, "max". Either may be None for a range unbounded on that side.
+    :return: Query condition, empty for an unbounded range
+    """
+
+    condition = {}
+    if sample_range.get('min') is not None:
+        condition['$gte'] = sample_range['min']
+    if sample_range.get('max') is not None:
+        condition['$lt'] = sample_range['max']
+    return condition
+
+
+def sample_range_query(sample_range):
+    """Returns the clinical or genomic query for the sample ids of a range, see sample_range_condition"""
+
+    condition = sample_range_condition(sample_range)
+    return {'SAMPLE_ID': condition} if condition else {}
+
+
+def in_range(sample_id, sample_range):
+    """Whether a sample id falls in a range, see sample_range_condition"""
+
+    if sample_range.get('min') is not None and sample_id < sample_range['min']:
+        return False
+    if sample_range.get('max') is not None and sample_id >= sample_range['max']:
+        return False
+    return True
+
+
+def range_slice(sample_ids, sample_range):
+    """
+    Returns the sample ids of a sorted list that fall in a range, see sample_range_condition
+
+    :param sample_ids: Sorted list of sample ids
+    :param sample_range: Range of sample ids, or None for every sample
+    :return: Slice of the list
+    """
+
+    if sample_range is None:
+        return sample_ids
+    lo = bisect_left(sample_ids, sample_range['min']) if sample_range.get('min') is not None else 0
+    hi = bisect_left(sample_ids, sample_range['max']) if sample_range.get('max') is not None else len(sample_ids)
+    return sample_ids[lo:hi]
@@ -0,0 +1,248 @@
+"""Copyright 2016 Dana-Farber Cancer Institute"""
+
+import time
+import logging
+import datetime as dt
+
+from matchengine.settings import TRIAL_UPDATED
+
+# change stream operations that remove a document, whose sample id is no longer known
+REMOVALS = ['delete', 'replace', 'drop', 'rename', 'dropDatabase', 'invalidate']
+
+
+class Changes(object):
+    """
+    Trials and samples changed since the last match run.
+
+    :param trials: Protocol numbers of trials that were added, edited, or removed
+    :param samples: Sample ids whose clinical or genomic documents were added or edited
+    :param full: True if changes were seen that can only be accounted for by matching everything
+    """
+
+    def __init__(self, trials=None, samples=None, full=False):
+        self.trials = set(trials or [])
+        self.samples = set(samples or [])
+        self.full = full
+
+    def update(self, other):
+        self.trials.update(other.trials)
+        self.samples.update(other.samples)
+        self.full = self.full or other.full
+
+    def __nonzero__(self):
+        return bool(self.trials or self.samples or self.full)
+
+    def __repr__(self):
+        return '%d trials, %d samples%s' % (len(self.trials), len(self.samples), ', full' if self.full else '')
+
+
+class ChangeWatcher(object):
+    """
+    Detects changes to the trial, clinical, and genomic collections.
+
+    Change streams are used when the server supports them (MongoDB 3.6 replica sets, pymongo 3.8). Otherwise,
+    e.g. for a standalone server or the in-memory backend, the collections are polled: trials are compared by
+    their _id and the time of their last edit in "_updated", which the MatchMiner API and the trial loaders set,
+    so only those two fields are read. Clinical and genomic documents inserted since the last poll are found
+    through their ObjectId watermark, and removed ones through the change in count, which requires a full run.
+
+    When polling, edits made in place without setting "_updated" are not seen: set it when editing a trial, and
+    run a full match after editing clinical or genomic documents in place.
+
+    :param db: Database connection
+    :param change_streams: Set to False to always poll
+    """
+
+    def __init__(self, db, change_streams=True):
+        self.db = db
+        self.streams = {}
+        self.trials = {}
+        self.watermarks = {}
+        self.counts = {}
+
+        if change_streams:
+            self._open_streams()
+        self._snapshot()
+
+    def _open_streams(self):
+        for name in ['trial', 'clinical', 'genomic']:
+            collection = self.db[name]
+            if not hasattr(collection, 'watch'):
+                return
+            try:
+                stream = collection.watch(full_document='updateLookup')
+                if not hasattr(stream, 'try_next'):
+                    stream.close()
+                    return
+                self.streams[name] = stream
+            except Exception as e:
+                logging.info('Change streams are unavailable, polling instead: %s' % e)
+                for stream in self.streams.values():
+                    stream.close()
+                self.streams = {}
+                return
+
+    def _snapshot(self):
+        """Records the current state of the polled collections"""
+
+        if self.streams:
+            return
+        self.trials = self._trial_versions()
+        for name in ['clinical', 'genomic']:
+            last = list(self.db[name].find({}, {'_id': 1}).sort('_id', -1).limit(1))
+            self.watermarks[name] = last[0]['_id'] if last else None
+            self.counts[name] = self.db[name].count()
+
+    def _trial_versions(self):
+        versions = {}
+        for trial in self.db.trial.find({}, {'_id': 1, 'protocol_no': 1, TRIAL_UPDATED: 1}):
+            versions[trial.get('protocol_no')] = (trial['_id'], trial.get(TRIAL_UPDATED))
+        return versions
+
+    def poll(self):
+        """
+        Returns the changes since the last poll
+
+        :return: Changes
+        """
+
+        if self.streams:
+            return self._poll_streams()
+        return self._poll_collections()
+
+    def _poll_streams(self):
+        changes = Changes()
+        for name, stream in self.streams.iteritems():
+            while True:
+                change = stream.try_next()
+                if change is None:
+                    break
+
+                doc = change.get('fullDocument') or {}
+                key = doc.get('protocol_no') if name == 'trial' else doc.get('SAMPLE_ID')
+                if change['operationType'] in REMOVALS or key is None:
+                    changes.full = True
+                elif name == 'trial':
+                    changes.trials.add(key)
+                else:
+                    changes.samples.add(key)
+        return changes
+
+    def _poll_collections(self):
+        changes = Changes()
+
+        trials = self._trial_versions()
+        for protocol_no in set(trials) | set(self.trials):
+            if trials.get(protocol_no) != self.trials.get(protocol_no):
+                changes.trials.add(protocol_no)
+        self.trials = trials
+
+        for name in ['clinical', 'genomic']:
+            query = {'_id': {'$gt': self.watermarks[name]}} if self.watermarks[name] is not None else {}
+            new = list(self.db[name].find(query, {'_id': 1, 'SAMPLE_ID': 1}))
+            count = self.db[name].count()
+
+            if new:
+                self.watermarks[name] = max(item['_id'] for item in new)
+                changes.samples.update(item['SAMPLE_ID'] for item in new if 'SAMPLE_ID' in item)
+            if count != self.counts[name] + len(new):
+                changes.full = True
+            self.counts[name] = count
+
+        return changes
+
+
+class MatchScheduler(object):
+    """
+    Runs the match engine when trials or patients change rather than on a fixed schedule.
+
+    Changes are collected until none arrived for the debounce period, or until the oldest pending change is
+    as old as the maximum staleness, and then matched incrementally: changed trials against every sample, and
+    changed samples against every trial. A full run happens once a day within the quiet hours, and whenever
+    changes cannot be matched incrementally.
+
+    :param watcher: ChangeWatcher
+    :param run: Callable running the match engine, called with the protocol numbers and the sample ids to
+        match, or with neither for a full run
+    :param debounce: Seconds without changes before pending changes are matched
+    :param max_staleness: Maximum seconds a change waits to be matched
+    :param quiet_hours: Tuple of the first and last hour of the day in which the daily full run happens, or None
+    :param poll_interval: Seconds between polls
+    :param clock: Returns the current time in seconds
+    """
+
+    def __init__(self, watcher, run, debounce=60, max_staleness=900, quiet_hours=(2, 5), poll_interval=10,
+                 clock=time.time):
+        self.watcher = watcher
+        self.run = run
+        self.debounce = debounce
+        self.max_staleness = max_staleness
+        self.quiet_hours = quiet_hours
+        self.poll_interval = poll_interval
+        self.clock = clock
+
+        self.pending = Changes()
+        self.first_change = None
+        self.last_change = None
+        self.last_full = None
+
+    def in_quiet_hours(self, now):
+        if self.quiet_hours is None:
+            return False
+        first, last = self.quiet_hours
+        hour = dt.datetime.fromtimestamp(now).hour
+        if first <= last:
+            return first <= hour <= last
+        return hour >= first or hour <= last
+
+    def step(self):
+        """
+        Polls for changes once and runs the match engine if it is due
+
+        :return: "full", "incremental", or None if nothing ran
+        """
+
+        now = self.clock()
+        changes = self.watcher.poll()
+        if changes:
+            logging.info('Changes detected: %s' % changes)
+            self.pending.update(changes)
+            self.last_change = now
+            if self.first_change is None:
+                self.first_change = now
+
+        today = dt.datetime.fromtimestamp(now).date()
+        if self.pending.full or (self.in_quiet_hours(now) and self.last_full != today):
+            logging.info('Running a full match')
+            self.run()
+            self.last_full = today
+            self._clear()
+            return 'full'
+
+        if not self.pending:
+            return
+
+        if now - self.last_change < self.debounce and now - self.first_change < self.max_staleness:
+            return
+
+        logging.info('Matching %s' % self.pending)
+        if self.pending.trials:
+            self.run(protocol_nos=sorted(self.pending.trials))
+        if self.pending.samples:
+            self.run(sample_ids=sorted(self.pending.samples))
+        self._clear()
+        return 'incremental'
+
+    def _clear(self):
+        self.pending = Changes()
+        self.first_change = None
+        self.last_change = None
+
+    def run_forever(self):
+        """Runs a full match, then matches changes as they arrive"""
+
+        self.run()
+        self.last_full = dt.datetime.fromtimestamp(self.clock()).date()
+        while True:
+            self.step()
+            time.sleep(self.poll_interval)
@@ -0,0 +1,272 @@
+"""Copyright 2016 Dana-Farber Cancer Institute"""
+
+import json
+import time
+import logging
+import urlparse
+import pandas as pd
+import BaseHTTPServer
+from bson import json_util
+
+from matchengine.engine import MatchEngine, TRIAL_PROJECTION
+from matchengine.sort import add_sort_order
+from matchengine.utilities import samples_from_mrns
+
+
+class MatchError(Exception):
+    """Request the service cannot answer, with the HTTP status to answer it with"""
+
+    def __init__(self, status, message):
+        super(MatchError, self).__init__(message)
+        self.status = status
+
+
+def sort_matches(matches):
+    """
+    Adds the sort order to matches and sorts them. Matches to closed trials or deceased patients come last.
+
+    :param matches: List of matches
+    :return: Sorted list of matches
+    """
+
+    if not matches:
+        return matches
+
+    df = add_sort_order(pd.DataFrame.from_dict(matches))
+    for match, sort_order in zip(matches, df['sort_order']):
+        match['sort_order'] = int(sort_order)
+    return sorted(matches, key=lambda m: (m['sort_order'] < 0, m['sample_id'], m['sort_order']))
+
+
+class MatchService(object):
+    """
+    Keeps a match engine warm between requests: the sample ids and MRNs of the cohort, the oncotree, and the
+    compiled plans of every trial are loaded once, so a request only runs the leaf queries it needs.
+
+    Matches are not written to the trial_match collection, except by rematch, which replaces the matches of
+    one trial.
+
+    :param db: Database connection
+    """
+
+    def __init__(self, db):
+        self.db = db
+        self.me = None
+        self.trials = {}
+        self.segments = {}
+        self.mrn_map = {}
+        self.refresh()
+
+    def refresh(self):
+        """Reloads the cohort and the trials, e.g. after patients or trials were loaded"""
+
+        start = time.time()
+        self.me = MatchEngine(self.db)
+        self.mrn_map = samples_from_mrns(self.db, self.db.clinical.distinct('MRN'))
+        self.trials = {}
+        self.segments = {}
+        for trial in self.db.trial.find({}, TRIAL_PROJECTION):
+            self._load_trial(trial)
+        logging.info('Loaded %d samples and %d trials in %.1f s' % (
+            len(self.me.cohort), len(self.trials), time.time() - start))
+
+    def _load_trial(self, trial):
+        self.trials[trial['protocol_no']] = trial
+        self.segments[trial['protocol_no']] = self.me.cache.load(trial, self.me.compile_trial)
+
+    def match_sample(self, sample_id):
+        """
+        Matches one sample to every trial
+
+        :param sample_id: Sample id
+        :return: Sorted list of matches
+        """
+
+        if sample_id not in self.me.cohort:
+            raise MatchError(404, 'Unknown sample %s' % sample_id)
+
+        self.me.ages.refresh()
+        self.me.restrict_samples([sample_id])
+        try:
+            matches = []
+            for protocol_no in sorted(self.trials):
+                matches = self.me.match_trial(self.trials[protocol_no], self.mrn_map, matches,
+                                              segments=self.segments[protocol_no])
+        finally:
+            self.me.restrict_samples(None)
+
+        return sort_matches(matches)
+
+    def match_trial(self, trial):
+        """
+        Matches a trial that is not in the database, e.g. a draft, to every sample
+
+        :param trial: Trial document
+        :return: Sorted list of matches
+        """
+
+        if 'protocol_no' not in trial:
+            raise MatchError(400, 'Missing "protocol_no"')
+
+        status, errors = self.me.create_trial_tree(trial)
+        if status != 0:
+            raise MatchError(400, 'Invalid trial: %s' % errors)
+
+        self.me.ages.refresh()
+        segments = self.me.compile_trial(trial)
+        return sort_matches(self.me.match_trial(trial, self.mrn_map, [], segments=segments))
+
+    def rematch(self, protocol_no):
+        """
+        Reloads one trial from the database and replaces its matches
+
+        :param protocol_no: Protocol number
+        :return: Number of matches
+        """
+
+        trial = self.db.trial.find_one({'protocol_no': protocol_no}, TRIAL_PROJECTION)
+        if trial is None:
+            self.trials.pop(protocol_no, None)
+            self.segments.pop(protocol_no, None)
+            matches = []
+        else:
+            self._load_trial(trial)
+            self.me.ages.refresh()
+            matches = self.me.match_trial(trial, self.mrn_map, [], segments=self.segments[protocol_no])
+
+        self.me.replace_matches(pd.DataFrame.from_dict(matches), [protocol_no])
+        return len(matches)
+
+    def matches(self, sample_id=None, protocol_no=None):
+        """
+        Returns the matches in the trial_match collection in sort order
+
+        :param sample_id: Only return the matches of this sample
+        :param protocol_no: Only return the matches to this trial
+        :return: List of matches
+        """
+
+        query = {}
+        if sample_id is not None:
+            query['sample_id'] = sample_id
+        if protocol_no is not None:
+            query['protocol_no'] = protocol_no
+        matches = list(self.db.trial_match.find(query))
+        return sorted(matches, key=lambda m: (m.get('sort_order', -1) < 0, m.get('sample_id'),
+                                              m.get('sort_order')))
+
+
+class MatchHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    JSON API of a MatchService:
+
+    - GET /health
+    - GET /matches?sample_id=...&protocol_no=...
+    - POST /match/sample {"sample_id": ...}
+    - POST /match/trial {trial document}
+    - POST /simulate {trial document}
+    - POST /rematch {"protocol_no": ...}
+    - POST /refresh
+    """
+
+    service = None
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        params = dict((k, v[0]) for k, v in urlparse.parse_qs(url.query).iteritems())
+
+        if url.path == '/health':
+            self._answer(lambda: {'samples': len(self.service.me.cohort), 'trials': len(self.service.trials)})
+        elif url.path == '/matches':
+            self._answer(lambda: {'matches': self.service.matches(params.get('sample_id'),
+                                                                  params.get('protocol_no'))})
+        else:
+            self._reply(404, {'error': 'Unknown path %s' % url.path})
+
+    def do_POST(self):
+        path = urlparse.urlparse(self.path).path
+        try:
+            length = int(self.headers.getheader('content-length') or 0)
+            body = json.loads(self.rfile.read(length), object_hook=json_util.object_hook) if length else {}
+        except ValueError as e:
+            self._reply(400, {'error': 'Invalid JSON: %s' % e})
+            return
+
+        if path == '/match/sample':
+            self._answer(lambda: {'matches': self.service.match_sample(_required(body, 'sample_id'))})
+        elif path == '/match/trial':
+            self._answer(lambda: {'matches': self.service.match_trial(body)})
+        elif path == '/simulate':
+            self._answer(lambda: self.service.me.simulate_trial(body))
+        elif path == '/rematch':
+            self._answer(lambda: {'n_matches': self.service.rematch(_required(body, 'protocol_no'))})
+        elif path == '/refresh':
+            self._answer(lambda: self.service.refresh() or {'samples': len(self.service.me.cohort),
+                                                              'trials': len(self.service.trials)})
+        else:
+            self._reply(404, {'error': 'Unknown path %s' % path})
+
+    def _answer(self, func):
+        start = time.time()
+        try:
+            result = func()
+        except MatchError as e:
+            self._reply(e.status, {'error': str(e)})
+            return
+        except Exception as e:
+            logging.exception('Error answering %s %s' % (self.command, self.path))
+            self._reply(500, {'error': '%s: %s' % (type(e).__name__, e)})
+            return
+        result['ms'] = round((time.time() - start) * 1000, 1)
+        self._reply(200, result)
+
+    def _reply(self, status, result):
+        body = json.dumps(result, default=json_util.default)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, fmt, *args):
+        logging.info('%s %s' % (self.address_string(), fmt % args))
+
+
+def _required(body, key):
+    if key not in body:
+        raise MatchError(400, 'Missing "%s"' % key)
+    return body[key]
+
+
+def make_server(service, host='127.0.0.1', port=8765):
+    """
+    Returns an HTTP server answering requests to a MatchService
+
+    :param service: MatchService
+    :param host: Interface to listen on. Only local connections are accepted by default.
+    :param port: Port to listen on; 0 picks a free port
+    :return: BaseHTTPServer.HTTPServer
+    """
+
+    # the request handlers of BaseHTTPServer are classic classes
+    handler = type('Handler', (MatchHandler, object), {'service': service})
+    return BaseHTTPServer.HTTPServer((host, port), handler)
+
+
+def serve(service, host='127.0.0.1', port=8765):
+    """
+    Answers requests to a MatchService until interrupted. Requests are handled one at a time.
+
+    :param service: MatchService
+    :param host: Interface to listen on. Only local connections are accepted by default.
+    :param port: Port to listen on
+    """
+
+    server = make_server(service, host, port)
+    logging.info('Serving matches on http://%s:%d' % (host, port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
@@ -10,6 +10,9 @@ logging.basicConfig(level=logging.DEBUG, format='[%(levelname)s] %(message)s', )
 
 TUMOR_TREE = os.path.abspath(os.path.join(os.path.dirname(__file__), 'data/tumor_tree.txt'))
 
+# time a trial document was last edited, set by the MatchMiner API and by the trial loaders
+TRIAL_UPDATED = '_updated'
+
 months = [
     'January', 'February', 'March', 'April', 'May', 'June',
     'July', 'August', 'September', 'October', 'November', 'December'
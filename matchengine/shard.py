@@ -0,0 +1,279 @@
+"""Copyright 2016 Dana-Farber Cancer Institute"""
+
+import os
+import time
+import socket
+import logging
+import datetime as dt
+
+from matchengine.runs import MatchRun, QUEUE_COLLECTION
+from matchengine.samples import sample_range_query
+from matchengine.utilities import add_matches, samples_from_mrns
+
+# a shard that failed this many times fails the run
+MAX_ATTEMPTS = 3
+
+
+class LeaseLost(Exception):
+    """Raised when a worker no longer holds the lease of the shard it is matching"""
+    pass
+
+
+def plan_shards(db, by='trial', n_shards=8):
+    """
+    Splits a match run into shards
+
+    :param db: Database connection
+    :param by: "trial" to give each shard some trials matched against every sample, or "sample" to give each
+        shard a range of sample ids matched against every trial
+    :param n_shards: Number of shards
+    :return: List of shard specifications
+    """
+
+    if by == 'trial':
+        keys = sorted(db.trial.distinct('protocol_no'))
+    elif by == 'sample':
+        keys = sorted(db.clinical.distinct('SAMPLE_ID'))
+    else:
+        raise ValueError('Unknown shard key %s' % by)
+
+    size = max(1, -(-len(keys) // max(1, n_shards)))
+    chunks = [keys[i:i + size] for i in range(0, len(keys), size)]
+
+    if by == 'trial':
+        return [{'protocol_nos': chunk} for chunk in chunks]
+
+    # half open sample id ranges that together cover every possible sample id, including samples loaded later
+    specs = []
+    for i, chunk in enumerate(chunks):
+        specs.append({
+            'min': chunk[0] if i > 0 else None,
+            'max': chunks[i + 1][0] if i + 1 < len(chunks) else None
+        })
+    return specs or [{'min': None, 'max': None}]
+
+
+class Worker(object):
+    """
+    Claims shards of match runs from the queue collection and matches them. Workers keep no state between
+    shards, so any number of them can run on any number of hosts against the same database.
+
+    :param db: Database connection
+    :param worker_id: Name of the worker. Defaults to the host name and process id.
+    :param lease: Seconds a claimed shard is reserved for the worker. The lease is renewed after every trial;
+        shards whose lease expired are handed to another worker. A worker that lost its lease stops matching
+        the shard without staging its matches or changing the queue document.
+    """
+
+    def __init__(self, db, worker_id=None, lease=600):
+        self.db = db
+        self.worker_id = worker_id or '%s:%d' % (socket.gethostname(), os.getpid())
+        self.lease = lease
+
+    def claim(self):
+        """Reserves the oldest pending shard of any run, or returns None if there is none"""
+
+        return self.db[QUEUE_COLLECTION].find_one_and_update(
+            {'status': 'pending'},
+            {'$set': {'status': 'running', 'worker': self.worker_id, 'lease_until': self._lease_until()},
+             '$inc': {'attempts': 1}},
+            sort=[('_id', 1)],
+            return_document=True)
+
+    def _lease_until(self):
+        return dt.datetime.utcnow() + dt.timedelta(seconds=self.lease)
+
+    def _owned(self, shard):
+        """Query of the queue document of a shard while this claim of it holds the lease"""
+        return {'_id': shard['_id'], 'worker': self.worker_id, 'attempts': shard['attempts'], 'status': 'running'}
+
+    def _renew(self, shard):
+        """Extends the lease of a shard, or raises LeaseLost if the shard was requeued or claimed again"""
+
+        result = self.db[QUEUE_COLLECTION].update_one(self._owned(shard),
+                                                      {'$set': {'lease_until': self._lease_until()}})
+        if not result.matched_count:
+            raise LeaseLost('Worker %s lost the lease of shard %s of run %s' % (
+                self.worker_id, shard['shard'], shard['run_id']))
+
+    def process(self, shard):
+        """
+        Matches a shard and stages its matches in its run
+
+        :param shard: Queue document
+        """
+
+        # the engine is imported with the first shard, so an idle worker starts quickly
+        from matchengine.engine import MatchEngine, TRIAL_PROJECTION
+
+        logging.info('Worker %s matching shard %s of run %s' % (self.worker_id, shard['shard'], shard['run_id']))
+        run = MatchRun(self.db, run_id=shard['run_id'])
+        spec = shard['spec']
+
+        # ages are computed as of the date the run was queued in every shard
+        if shard['by'] == 'trial':
+            me = MatchEngine(self.db, as_of=shard.get('as_of'))
+            query = {'protocol_no': {'$in': spec['protocol_nos']}}
+            mrns = self.db.clinical.distinct('MRN')
+        else:
+            me = MatchEngine(self.db, sample_range=spec, as_of=shard.get('as_of'))
+            query = {}
+            mrns = self.db.clinical.find(sample_range_query(spec)).distinct('MRN')
+
+        mrn_map = samples_from_mrns(self.db, mrns)
+
+        # matches are only staged while the lease is held
+        matches = []
+        for trial in self.db.trial.find(query, TRIAL_PROJECTION):
+            if shard['by'] == 'trial':
+                if trial['protocol_no'] not in run.completed:
+                    trial_matches = me.match_trial(trial, mrn_map, [])
+                    self._renew(shard)
+                    run.stage(trial['protocol_no'], trial_matches)
+            else:
+                matches = me.match_trial(trial, mrn_map, matches)
+                self._renew(shard)
+
+        if shard['by'] == 'sample':
+            self._renew(shard)
+            run.stage_shard(shard['shard'], matches)
+
+        result = self.db[QUEUE_COLLECTION].update_one(self._owned(shard), {'$set': {'status': 'done'}})
+        if not result.matched_count:
+            raise LeaseLost('Worker %s lost the lease of shard %s of run %s before it was done' % (
+                self.worker_id, shard['shard'], shard['run_id']))
+
+    def fail(self, shard, error):
+        """Returns a shard to the queue, or fails it after MAX_ATTEMPTS"""
+
+        status = 'failed' if shard['attempts'] >= MAX_ATTEMPTS else 'pending'
+        logging.error('Shard %s of run %s failed on attempt %d: %s' % (
+            shard['shard'], shard['run_id'], shard['attempts'], error))
+        self.db[QUEUE_COLLECTION].update_one(self._owned(shard), {'$set': {'status': status, 'error': error}})
+
+    def work_once(self):
+        """
+        Claims and matches one shard
+
+        :return: True if a shard was claimed
+        """
+
+        shard = self.claim()
+        if shard is None:
+            return False
+
+        try:
+            self.process(shard)
+        except LeaseLost as e:
+            logging.warning(str(e))
+        except Exception as e:
+            self.fail(shard, str(e))
+        return True
+
+    def run(self, poll=5, exit_when_idle=False):
+        """
+        Matches shards as they are queued
+
+        :param poll: Seconds to wait when the queue is empty
+        :param exit_when_idle: Return once no shard is pending or running
+        """
+
+        while True:
+            if self.work_once():
+                continue
+            if exit_when_idle and not self.db[QUEUE_COLLECTION].find_one({'status': {'$in': ['pending', 'running']}}):
+                return
+            time.sleep(poll)
+
+
+class Coordinator(object):
+    """
+    Splits a match run into shards, queues them for workers, requeues shards whose worker died, and merges
+    and publishes their matches. The merged matches are sorted globally, so the result is the same as a single
+    process run. A coordinator that died can be restarted with the id of its run.
+
+    :param db: Database connection
+    :param by: "trial" or "sample", see plan_shards
+    :param n_shards: Number of shards
+    :param run_id: Id of a sharded run to resume
+    """
+
+    def __init__(self, db, by='trial', n_shards=8, run_id=None):
+        self.db = db
+        self.by = by
+        self.n_shards = n_shards
+        self.run = MatchRun(db, run_id=run_id)
+        self.queue = db[QUEUE_COLLECTION]
+
+    def enqueue(self):
+        """Queues the shards of the run, unless a previous coordinator of the run already did"""
+
+        if self.queue.find_one({'run_id': self.run.run_id}):
+            return
+
+        shards = plan_shards(self.db, self.by, self.n_shards)
+        as_of = dt.datetime.today()
+        self.queue.insert_many([{
+            'run_id': self.run.run_id,
+            'shard': i,
+            'by': self.by,
+            'spec': spec,
+            'status': 'pending',
+            'attempts': 0,
+            'as_of': as_of
+        } for i, spec in enumerate(shards)])
+        logging.info('Queued %d shards by %s for run %s' % (len(shards), self.by, self.run.run_id))
+
+    def progress(self):
+        """Returns the number of shards of the run by status"""
+
+        counts = {}
+        for shard in self.queue.find({'run_id': self.run.run_id}, {'status': 1}):
+            counts[shard['status']] = counts.get(shard['status'], 0) + 1
+        return counts
+
+    def requeue_expired(self):
+        """Returns shards whose worker stopped renewing its lease to the queue"""
+
+        result = self.queue.update_many(
+            {'run_id': self.run.run_id, 'status': 'running', 'lease_until': {'$lt': dt.datetime.utcnow()}},
+            {'$set': {'status': 'pending'}})
+        if result.modified_count:
+            logging.info('Requeued %d shards with an expired lease' % result.modified_count)
+
+    def wait(self, poll=5, worker=None):
+        """
+        Waits until every shard of the run is done
+
+        :param poll: Seconds between checks
+        :param worker: Worker matching shards in this process while waiting, if any
+        """
+
+        while True:
+            self.requeue_expired()
+            counts = self.progress()
+            if counts.get('failed'):
+                raise RuntimeError('%d shards of run %s failed' % (counts['failed'], self.run.run_id))
+            if not counts.get('pending') and not counts.get('running'):
+                return
+
+            logging.info('Run %s: %s' % (self.run.run_id, ', '.join(
+                '%d %s' % (n, status) for status, n in sorted(counts.iteritems()))))
+            if worker is None or not worker.work_once():
+                time.sleep(poll)
+
+    def publish(self):
+        """Sorts the matches of every shard together and replaces the trial_match collection with them"""
+
+        import pandas as pd
+        from matchengine.sort import add_sort_order
+
+        self.run.set_status('publishing')
+        trial_match_df = pd.DataFrame.from_dict(self.run.staged())
+
+        logging.info('Sorting %d trial matches' % len(trial_match_df.index))
+        trial_match_df = add_sort_order(trial_match_df)
+        add_matches(trial_match_df, self.db)
+
+        self.run.finish()
+        self.queue.delete_many({'run_id': self.run.run_id})
@@ -5,6 +5,11 @@ import logging
 
 logging.basicConfig(level=logging.DEBUG, format='[%(levelname)s] %(message)s', )
 
+# match fields the sort order depends on
+SORT_FIELDS = ['sample_id', 'protocol_no', 'vital_status', 'trial_accrual_status', 'genomic_alteration', 'tier',
+               'match_type', 'variant_category', 'wildtype', 'mmr_status', 'cancer_type_match',
+               'coordinating_center', 'sort_order']
+
 
 def add_sort_order(trial_match_df):
     """
@@ -192,10 +197,11 @@ def sort_by_coordinating_center(match, sort_order):
 
 def sort_by_reverse_protocol_no(matches, sort_order):
     """
-    Lowest priority sorting
+    Lowest priority sorting. Protocol numbers with the same year are ordered by the full protocol number, so
+    the order does not depend on the order of the matches, e.g. of matches staged by the shards of a run.
     """
 
-    rev_prot_no_sort = sorted(matches, key=lambda k: int(k['protocol_no'].split('-')[0]))
+    rev_prot_no_sort = sorted(matches, key=lambda k: (int(k['protocol_no'].split('-')[0]), k['protocol_no']))
     i = 0
 
     for match in rev_prot_no_sort[::-1]:
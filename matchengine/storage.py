@@ -0,0 +1,723 @@
+"""Copyright 2016 Dana-Farber Cancer Institute"""
+
+import os
+import re
+import copy
+import json
+import time
+import atexit
+import logging
+import datetime as dt
+from bson import json_util
+from bson.objectid import ObjectId
+
+# pymongo's errors and results are imported where they are raised or returned, so that commands run on an
+# in-memory database, e.g. an idle worker, do not load pymongo
+
+# Storage backends.
+#
+# The engine, loader, and utilities talk to storage through the subset of the pymongo Database and Collection
+# API they use: find (with projection, sort, limit, max_time_ms, and distinct on the cursor), find_one, distinct,
+# count, insert/insert_one/insert_many, replace_one, update_one/update_many, find_one_and_update, delete_many,
+# drop, and create_index. A pymongo Database is the Mongo implementation of that interface.
+#
+# MemoryDatabase is a second implementation that keeps every collection in process and evaluates the same
+# query dialect prepare_genomic_criteria and prepare_clinical_criteria emit, so matching can run without a
+# Mongo server. It is selected with a "memory://" URI. "memory:///some/dir" additionally loads the collections
+# from, and saves modified collections back to, one JSON file per collection in that directory when the
+# process exits, so data loaded with one command can be matched by the next.
+
+_RE_TYPE = type(re.compile(''))
+_NUMBER_TYPES = (int, long, float)
+
+# documents scanned between checks of a query's time limit
+_TIME_CHECK_DOCS = 128
+
+# mongo's order of types when sorting values of different types
+_TYPE_ORDER = [
+    (type(None), 0),
+    (_NUMBER_TYPES, 1),
+    (basestring, 2),
+    (dict, 3),
+    (list, 4),
+    (ObjectId, 5),
+    (bool, 6),
+    (dt.datetime, 7)
+]
+
+
+def _type_rank(value):
+    if isinstance(value, bool):
+        return 6
+    for types, rank in _TYPE_ORDER:
+        if isinstance(value, types):
+            return rank
+    return 8
+
+
+def _resolve(doc, path):
+    """
+    Returns every value found at a dotted path, descending into arrays the way mongo does.
+
+    :param doc: Document
+    :param path: Field name, e.g. "TRUE_HUGO_SYMBOL" or "treatment_list.step"
+    :return: List of values, empty if the path does not exist
+    """
+
+    values = [doc]
+    for part in path.split('.'):
+        found = []
+        for value in values:
+            if isinstance(value, dict):
+                if part in value:
+                    found.append(value[part])
+            elif isinstance(value, list):
+                if part.isdigit() and int(part) < len(value):
+                    found.append(value[int(part)])
+                for item in value:
+                    if isinstance(item, dict) and part in item:
+                        found.append(item[part])
+        values = found
+    return values
+
+
+def _candidates(values):
+    """Values a condition is tested against: every value and, for arrays, each of their elements"""
+    out = []
+    for value in values:
+        out.append(value)
+        if isinstance(value, list):
+            out.extend(value)
+    return out
+
+
+def _equals(a, b):
+    if isinstance(a, bool) != isinstance(b, bool):
+        return False
+    if isinstance(b, _RE_TYPE):
+        return isinstance(a, basestring) and b.search(a) is not None
+    return a == b
+
+
+def _comparable(a, b):
+    if isinstance(a, bool) or isinstance(b, bool):
+        return isinstance(a, bool) and isinstance(b, bool)
+    if isinstance(a, _NUMBER_TYPES) and isinstance(b, _NUMBER_TYPES):
+        return True
+    if isinstance(a, basestring) and isinstance(b, basestring):
+        return True
+    return type(a) == type(b)
+
+
+def _regex(pattern, options=''):
+    if isinstance(pattern, _RE_TYPE):
+        return pattern
+
+    flags = 0
+    for option in options or '':
+        flags |= {'i': re.IGNORECASE, 'm': re.MULTILINE, 's': re.DOTALL, 'x': re.VERBOSE}.get(option, 0)
+    return re.compile(pattern, flags)
+
+
+def _match_operator(values, op, arg, spec):
+    """Tests the values found at a path against a single operator"""
+
+    candidates = _candidates(values)
+
+    if op == '$eq':
+        if arg is None:
+            return not values or any(v is None for v in candidates)
+        return any(_equals(v, arg) for v in candidates)
+
+    elif op == '$ne':
+        return not _match_operator(values, '$eq', arg, spec)
+
+    elif op == '$in':
+        for item in arg:
+            if _match_operator(values, '$eq', item, spec):
+                return True
+        return False
+
+    elif op == '$nin':
+        return not _match_operator(values, '$in', arg, spec)
+
+    elif op in ('$lt', '$lte', '$gt', '$gte'):
+        for v in candidates:
+            if not _comparable(v, arg):
+                continue
+            if op == '$lt' and v < arg or op == '$lte' and v <= arg or \
+                    op == '$gt' and v > arg or op == '$gte' and v >= arg:
+                return True
+        return False
+
+    elif op == '$exists':
+        return bool(values) == bool(arg)
+
+    elif op == '$regex':
+        regex = _regex(arg, spec.get('$options'))
+        return any(isinstance(v, basestring) and regex.search(v) is not None for v in candidates)
+
+    elif op == '$options':
+        return True
+
+    elif op == '$not':
+        return not _match_value(values, arg)
+
+    elif op == '$elemMatch':
+        for value in values:
+            if isinstance(value, list):
+                for item in value:
+                    if isinstance(item, dict) and not any(k.startswith('$') for k in arg):
+                        if match_query(item, arg):
+                            return True
+                    elif _match_value([item], arg):
+                        return True
+        return False
+
+    elif op == '$size':
+        return any(isinstance(v, list) and len(v) == arg for v in values)
+
+    raise ValueError('Unsupported query operator %s' % op)
+
+
+def _match_value(values, spec):
+    """Tests the values found at a path against a condition: a literal, a regex, or a document of operators"""
+
+    if isinstance(spec, dict) and spec and all(k.startswith('$') for k in spec):
+        return all(_match_operator(values, op, arg, spec) for op, arg in spec.iteritems())
+    elif isinstance(spec, _RE_TYPE):
+        return _match_operator(values, '$regex', spec, {})
+    return _match_operator(values, '$eq', spec, {})
+
+
+def match_query(doc, query):
+    """
+    Returns True if a document matches a mongo query.
+
+    :param doc: Document
+    :param query: Mongo query
+    """
+
+    for key, spec in query.iteritems():
+        if key == '$and':
+            if not all(match_query(doc, q) for q in spec):
+                return False
+        elif key == '$or':
+            if not any(match_query(doc, q) for q in spec):
+                return False
+        elif key == '$nor':
+            if any(match_query(doc, q) for q in spec):
+                return False
+        elif key.startswith('$'):
+            raise ValueError('Unsupported query operator %s' % key)
+        elif not _match_value(_resolve(doc, key), spec):
+            return False
+    return True
+
+
+def _project(doc, projection):
+    """Applies an inclusion or exclusion projection to a document"""
+
+    if not projection:
+        return copy.deepcopy(doc)
+
+    if isinstance(projection, list):
+        projection = dict((field, 1) for field in projection)
+
+    include = [k for k, v in projection.iteritems() if v and k != '_id']
+    if include:
+        out = {}
+        if projection.get('_id', 1) and '_id' in doc:
+            out['_id'] = doc['_id']
+        for field in include:
+            src, dst = doc, out
+            parts = field.split('.')
+            for part in parts[:-1]:
+                if not isinstance(src, dict) or part not in src:
+                    src = None
+                    break
+                src = src[part]
+                dst = dst.setdefault(part, {})
+            if isinstance(src, dict) and parts[-1] in src:
+                dst[parts[-1]] = copy.deepcopy(src[parts[-1]])
+        return out
+
+    out = copy.deepcopy(doc)
+    for field, value in projection.iteritems():
+        if not value:
+            parts = field.split('.')
+            target = out
+            for part in parts[:-1]:
+                target = target.get(part, {}) if isinstance(target, dict) else {}
+            if isinstance(target, dict):
+                target.pop(parts[-1], None)
+    return out
+
+
+def _sort_key(field):
+    def key(doc):
+        values = _resolve(doc, field)
+        value = values[0] if values else None
+        return _type_rank(value), value
+    return key
+
+
+def _distinct(docs, field):
+    """Returns the distinct values of a field, unwinding arrays"""
+    out = []
+    seen = set()
+    for doc in docs:
+        for value in _candidates(_resolve(doc, field)):
+            if isinstance(value, list):
+                continue
+            try:
+                if value in seen:
+                    continue
+                seen.add(value)
+            except TypeError:
+                if value in out:
+                    continue
+            out.append(value)
+    return out
+
+
+def _set_path(doc, path, value):
+    parts = path.split('.')
+    for part in parts[:-1]:
+        doc = doc.setdefault(part, {})
+    doc[parts[-1]] = value
+
+
+def _get_path(doc, path, default=None):
+    for part in path.split('.'):
+        if not isinstance(doc, dict) or part not in doc:
+            return default
+        doc = doc[part]
+    return doc
+
+
+def _unset_path(doc, path):
+    parts = path.split('.')
+    for part in parts[:-1]:
+        doc = doc.get(part)
+        if not isinstance(doc, dict):
+            return
+    doc.pop(parts[-1], None)
+
+
+def _apply_update(doc, update, inserting=False):
+    """Applies the update operators of an update document in place"""
+
+    for op, fields in update.iteritems():
+        for path, value in fields.iteritems():
+            if op == '$set':
+                _set_path(doc, path, copy.deepcopy(value))
+            elif op == '$setOnInsert':
+                if inserting:
+                    _set_path(doc, path, copy.deepcopy(value))
+            elif op == '$unset':
+                _unset_path(doc, path)
+            elif op == '$inc':
+                _set_path(doc, path, _get_path(doc, path, 0) + value)
+            elif op in ('$push', '$addToSet'):
+                current = _get_path(doc, path)
+                if current is None:
+                    current = []
+                    _set_path(doc, path, current)
+                items = value['$each'] if isinstance(value, dict) and '$each' in value else [value]
+                for item in items:
+                    if op == '$push' or item not in current:
+                        current.append(copy.deepcopy(item))
+            elif op == '$pull':
+                current = _get_path(doc, path)
+                if isinstance(current, list):
+                    if isinstance(value, dict):
+                        current[:] = [v for v in current if not _match_value([v], value)]
+                    else:
+                        current[:] = [v for v in current if v != value]
+            else:
+                raise ValueError('Unsupported update operator %s' % op)
+
+
+class MemoryCursor(object):
+    """Lazily filtered, sorted, and projected view of a MemoryCollection"""
+
+    def __init__(self, collection, query=None, projection=None):
+        self.collection = collection
+        self.query = query or {}
+        self.projection = projection
+        self._sort = []
+        self._skip = 0
+        self._limit = 0
+        self._max_time_ms = None
+        self._results = None
+
+    def _matches(self):
+        """Matching documents before projection"""
+        if self._max_time_ms:
+            docs = self._scan(time.time() + self._max_time_ms / 1000.0)
+        else:
+            docs = [doc for doc in self.collection.documents() if match_query(doc, self.query)]
+        for field, direction in reversed(self._sort):
+            docs.sort(key=_sort_key(field), reverse=direction < 0)
+        docs = docs[self._skip:]
+        if self._limit:
+            docs = docs[:self._limit]
+        return docs
+
+    def _scan(self, deadline):
+        """Matching documents, checking the time limit every _TIME_CHECK_DOCS documents as Mongo does"""
+        docs = []
+        for i, doc in enumerate(self.collection.documents()):
+            if not i % _TIME_CHECK_DOCS and time.time() > deadline:
+                from pymongo.errors import ExecutionTimeout
+                raise ExecutionTimeout('operation exceeded time limit', 50)
+            if match_query(doc, self.query):
+                docs.append(doc)
+        return docs
+
+    def __iter__(self):
+        if self._results is None:
+            self._results = [_project(doc, self.projection) for doc in self._matches()]
+        return iter(self._results)
+
+    def next(self):
+        if not hasattr(self, '_iter'):
+            self._iter = iter(self)
+        return next(self._iter)
+
+    def sort(self, key_or_list, direction=1):
+        if isinstance(key_or_list, basestring):
+            self._sort = [(key_or_list, direction)]
+        else:
+            self._sort = list(key_or_list)
+        return self
+
+    def skip(self, n):
+        self._skip = n
+        return self
+
+    def limit(self, n):
+        self._limit = n
+        return self
+
+    def max_time_ms(self, ms):
+        self._max_time_ms = ms
+        return self
+
+    def batch_size(self, n):
+        return self
+
+    def count(self, with_limit_and_skip=False):
+        if with_limit_and_skip:
+            return len(self._matches())
+        return sum(1 for doc in self.collection.documents() if match_query(doc, self.query))
+
+    def distinct(self, field):
+        return _distinct(self._matches(), field)
+
+    def explain(self):
+        """Every in-memory query scans the whole collection"""
+        n = len(self.collection.docs)
+        return {
+            'queryPlanner': {'winningPlan': {'stage': 'COLLSCAN', 'filter': self.query}},
+            'executionStats': {'nReturned': self.count(), 'totalDocsExamined': n, 'totalKeysExamined': 0}
+        }
+
+
+class MemoryCollection(object):
+    """In-memory collection implementing the subset of the pymongo Collection API the engine uses"""
+
+    def __init__(self, database, name):
+        self.database = database
+        self.name = name
+        self.docs = []
+        self.ids = {}
+        self.indexes = {}
+        self.dirty = False
+
+    def documents(self):
+        return self.docs
+
+    def _modified(self):
+        self.dirty = True
+
+    def _insert(self, doc):
+        if '_id' not in doc:
+            doc['_id'] = ObjectId()
+
+        key = _hashable(doc['_id'])
+        if key in self.ids:
+            from pymongo.errors import DuplicateKeyError
+            raise DuplicateKeyError('E11000 duplicate key error collection: %s index: _id_ dup key: %s' % (
+                self.name, doc['_id']))
+
+        stored = copy.deepcopy(doc)
+        self.ids[key] = stored
+        self.docs.append(stored)
+        self._modified()
+        return doc['_id']
+
+    def _remove(self, docs):
+        removed = set(id(doc) for doc in docs)
+        self.docs = [doc for doc in self.docs if id(doc) not in removed]
+        for doc in docs:
+            self.ids.pop(_hashable(doc['_id']), None)
+        self._modified()
+
+    def find(self, filter=None, projection=None, **kwargs):
+        cursor = MemoryCursor(self, filter, kwargs.get('fields', projection))
+        if 'sort' in kwargs:
+            cursor.sort(kwargs['sort'])
+        if 'limit' in kwargs:
+            cursor.limit(kwargs['limit'])
+        return cursor
+
+    def find_one(self, filter=None, projection=None, **kwargs):
+        if filter is not None and not isinstance(filter, dict):
+            filter = {'_id': filter}
+        for doc in self.find(filter, projection, **kwargs).limit(1):
+            return doc
+        return None
+
+    def distinct(self, key, filter=None):
+        return self.find(filter).distinct(key)
+
+    def count(self, filter=None):
+        return self.find(filter).count()
+
+    def insert(self, doc_or_docs, **kwargs):
+        if isinstance(doc_or_docs, dict):
+            return self._insert(doc_or_docs)
+        return [self._insert(doc) for doc in doc_or_docs]
+
+    def insert_one(self, document, **kwargs):
+        from pymongo.results import InsertOneResult
+        return InsertOneResult(self._insert(document), True)
+
+    def insert_many(self, documents, **kwargs):
+        from pymongo.results import InsertManyResult
+        return InsertManyResult([self._insert(doc) for doc in documents], True)
+
+    def _update(self, filter, update, upsert, multi, replace=False):
+        docs = [doc for doc in self.docs if match_query(doc, filter)]
+        if not multi:
+            docs = docs[:1]
+
+        for doc in docs:
+            if replace:
+                _id = doc['_id']
+                doc.clear()
+                doc.update(copy.deepcopy(update))
+                doc['_id'] = _id
+            else:
+                _apply_update(doc, update)
+
+        upserted_id = None
+        if not docs and upsert:
+            new = dict((k, v) for k, v in filter.iteritems() if not k.startswith('$') and not isinstance(v, dict))
+            if replace:
+                new.update(copy.deepcopy(update))
+            else:
+                _apply_update(new, update, inserting=True)
+            upserted_id = self._insert(new)
+
+        if docs:
+            self._modified()
+
+        raw = {'n': len(docs) or int(upserted_id is not None), 'nModified': len(docs), 'ok': 1.0}
+        if upserted_id is not None:
+            raw['upserted'] = upserted_id
+
+        from pymongo.results import UpdateResult
+        return UpdateResult(raw, True)
+
+    def replace_one(self, filter, replacement, upsert=False):
+        return self._update(filter, replacement, upsert, False, replace=True)
+
+    def update_one(self, filter, update, upsert=False):
+        return self._update(filter, update, upsert, False)
+
+    def update_many(self, filter, update, upsert=False):
+        return self._update(filter, update, upsert, True)
+
+    def update(self, spec, document, upsert=False, multi=False, **kwargs):
+        replace = not any(k.startswith('$') for k in document)
+        return self._update(spec, document, upsert, multi, replace=replace).raw_result
+
+    def find_one_and_update(self, filter, update, projection=None, sort=None, upsert=False,
+                            return_document=False, **kwargs):
+        cursor = self.find(filter)
+        if sort:
+            cursor.sort(sort)
+        docs = cursor.limit(1)._matches()
+
+        if not docs:
+            if upsert:
+                result = self._update(filter, update, True, False)
+                if return_document:
+                    return self.find_one({'_id': result.upserted_id}, projection)
+            return None
+
+        doc = docs[0]
+        before = _project(doc, projection)
+        _apply_update(doc, update)
+        self._modified()
+        return _project(doc, projection) if return_document else before
+
+    def delete_one(self, filter):
+        docs = [doc for doc in self.docs if match_query(doc, filter)][:1]
+        self._remove(docs)
+        from pymongo.results import DeleteResult
+        return DeleteResult({'n': len(docs), 'ok': 1.0}, True)
+
+    def delete_many(self, filter):
+        docs = [doc for doc in self.docs if match_query(doc, filter)]
+        self._remove(docs)
+        from pymongo.results import DeleteResult
+        return DeleteResult({'n': len(docs), 'ok': 1.0}, True)
+
+    def remove(self, spec_or_id=None, multi=True, **kwargs):
+        if spec_or_id is not None and not isinstance(spec_or_id, dict):
+            spec_or_id = {'_id': spec_or_id}
+        if multi:
+            return self.delete_many(spec_or_id or {}).raw_result
+        return self.delete_one(spec_or_id or {}).raw_result
+
+    def drop(self):
+        self.database.drop_collection(self.name)
+
+    def create_index(self, keys, **kwargs):
+        """Indexes are recorded but in-memory queries always scan the collection"""
+        if isinstance(keys, basestring):
+            keys = [(keys, 1)]
+        name = kwargs.get('name') or '_'.join('%s_%s' % (k, d) for k, d in keys)
+        self.indexes[name] = {'key': list(keys)}
+        return name
+
+    ensure_index = create_index
+
+    def index_information(self):
+        info = {'_id_': {'key': [('_id', 1)]}}
+        info.update(self.indexes)
+        return info
+
+    def drop_index(self, name):
+        self.indexes.pop(name, None)
+
+
+def _hashable(value):
+    try:
+        hash(value)
+        return value
+    except TypeError:
+        return json.dumps(value, sort_keys=True, default=json_util.default)
+
+
+def _object_hook(dct):
+    """Decodes extended JSON into naive UTC datetimes, as pymongo returns them by default"""
+    value = json_util.object_hook(dct)
+    if isinstance(value, dt.datetime) and value.tzinfo is not None:
+        value = value.replace(tzinfo=None) - value.utcoffset()
+    return value
+
+
+class MemoryDatabase(object):
+    """
+    In-memory database implementing the subset of the pymongo Database API the engine uses.
+
+    :param name: Database name
+    :param path: Optional directory holding one JSON file per collection
+    """
+
+    def __init__(self, name='matchminer', path=None):
+        self.name = name
+        self.path = path
+        self.collections = {}
+
+    def __getitem__(self, name):
+        if name not in self.collections:
+            collection = MemoryCollection(self, name)
+            if self.path:
+                self._load(collection)
+            self.collections[name] = collection
+        return self.collections[name]
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return self[name]
+
+    def get_collection(self, name):
+        return self[name]
+
+    def collection_names(self, include_system_collections=True):
+        names = set(name for name, c in self.collections.iteritems() if c.docs)
+        if self.path and os.path.isdir(self.path):
+            names.update(f[:-len('.json')] for f in os.listdir(self.path) if f.endswith('.json'))
+        return sorted(names)
+
+    def drop_collection(self, name):
+        if not isinstance(name, basestring):
+            name = name.name
+        collection = self[name]
+        collection.docs = []
+        collection.ids = {}
+        collection.indexes = {}
+        collection.dirty = True
+
+    def _file(self, name):
+        return os.path.join(self.path, '%s.json' % name)
+
+    def _load(self, collection):
+        """Reads a collection from its JSON file"""
+        path = self._file(collection.name)
+        if not os.path.exists(path):
+            return
+
+        with open(path) as f:
+            docs = json.load(f, object_hook=_object_hook)
+        for doc in docs:
+            collection._insert(doc)
+        collection.dirty = False
+
+    def save(self):
+        """Writes every modified collection to its JSON file"""
+        if not self.path:
+            return
+
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+
+        for name, collection in self.collections.iteritems():
+            if not collection.dirty:
+                continue
+
+            if collection.docs:
+                with open(self._file(name), 'w') as f:
+                    json.dump(collection.docs, f, default=json_util.default)
+            elif os.path.exists(self._file(name)):
+                os.remove(self._file(name))
+            collection.dirty = False
+
+
+# databases are shared within a process like connections to the same Mongo server
+_DATABASES = {}
+
+
+def memory_db(uri):
+    """
+    Returns the in-memory database for a "memory://" URI. A path after the scheme, e.g. "memory:///tmp/mm",
+    persists the database to that directory.
+
+    :param uri: memory:// URI
+    """
+
+    path = uri[len('memory://'):] or None
+    if path not in _DATABASES:
+        db = MemoryDatabase(path=path)
+        if path:
+            logging.info('Using in-memory database persisted to %s' % path)
+            atexit.register(db.save)
+        _DATABASES[path] = db
+    return _DATABASES[path]
@@ -0,0 +1,152 @@
+"""Copyright 2016 Dana-Farber Cancer Institute"""
+
+import json
+import logging
+
+from matchengine.samples import range_slice
+
+# genomic fields a summary document is keyed by
+SUMMARY_FIELDS = ['TRUE_HUGO_SYMBOL', 'VARIANT_CATEGORY', 'CNV_CALL', 'TRUE_VARIANT_CLASSIFICATION', 'WILDTYPE']
+
+SUMMARY_COLLECTION = 'genomic_summary'
+
+
+def summary_key(doc):
+    """
+    Returns the summary key of a genomic document: the value of every summary field it has.
+    Fields that are missing are left out so they are told apart from fields that are null.
+
+    :param doc: Genomic document
+    :return: Tuple of (field, value) pairs
+    """
+    return tuple((field, doc[field]) for field in SUMMARY_FIELDS if field in doc)
+
+
+def _key_query(key):
+    """Returns the query for the genomic documents of a summary key"""
+
+    present = dict(key)
+    query = {}
+    for field in SUMMARY_FIELDS:
+        if field not in present:
+            query[field] = {'$exists': False}
+        elif present[field] is None:
+            query[field] = {'$in': [None], '$exists': True}
+        else:
+            query[field] = present[field]
+    return query
+
+
+def _query_fields(query):
+    """Returns every field name a query references"""
+
+    fields = set()
+    if isinstance(query, dict):
+        for key, spec in query.iteritems():
+            if key in ['$and', '$or', '$nor']:
+                for q in spec:
+                    fields.update(_query_fields(q))
+            elif not key.startswith('$'):
+                fields.add(key)
+    return fields
+
+
+def summarizable(query):
+    """
+    True if a genomic query only references summary fields. Such a query matches a summary document exactly
+    when it matches the genomic documents the summary document was built from, so it can run against the
+    summary collection instead.
+
+    :param query: Genomic query
+    """
+    fields = _query_fields(query)
+    return bool(fields) and fields <= set(SUMMARY_FIELDS)
+
+
+def refresh_summary(db, keys):
+    """
+    Rebuilds the summary documents of the given keys from the genomic collection. Keys without genomic documents
+    left are removed.
+
+    :param db: Database connection
+    :param keys: Summary keys
+    """
+
+    collection = db[SUMMARY_COLLECTION]
+    for key in keys:
+        _id = json.dumps(key, default=str)
+        query = _key_query(key)
+
+        sample_ids = sorted(db.genomic.find(query).distinct('SAMPLE_ID'))
+        if not sample_ids:
+            collection.delete_many({'_id': _id})
+            continue
+
+        doc = dict(key)
+        doc.update({
+            '_id': _id,
+            'SAMPLE_IDS': sample_ids,
+            'n_samples': len(sample_ids),
+            'n_documents': db.genomic.count(query)
+        })
+        collection.replace_one({'_id': _id}, doc, upsert=True)
+
+
+def update_summary(db, docs):
+    """
+    Updates the summary for genomic documents that were just inserted into, or removed from, the genomic
+    collection.
+
+    :param db: Database connection
+    :param docs: Genomic documents
+    """
+
+    keys = set(summary_key(doc) for doc in docs)
+    logging.info('Updating %d genomic summary documents' % len(keys))
+    refresh_summary(db, keys)
+
+
+def rebuild_summary(db):
+    """Rebuilds the summary of the whole genomic collection"""
+
+    db.drop_collection(SUMMARY_COLLECTION)
+    update_summary(db, db.genomic.find({}, SUMMARY_FIELDS))
+
+
+def summary_is_current(db):
+    """
+    True if the summary matches the genomic collection: every summary key has the genomic documents and samples
+    the summary records for it. Data loaded, edited or removed without maintaining the summary, e.g. restored
+    from BSON, makes it out of date. This reads the summary fields of the whole genomic collection.
+
+    :param db: Database connection
+    """
+
+    expected = {}
+    for doc in db.genomic.find({}, SUMMARY_FIELDS + ['SAMPLE_ID']):
+        counts = expected.setdefault(json.dumps(summary_key(doc), default=str), [0, set()])
+        counts[0] += 1
+        counts[1].add(doc.get('SAMPLE_ID'))
+
+    actual = {}
+    for doc in db[SUMMARY_COLLECTION].find({}, {'n_documents': 1, 'SAMPLE_IDS': 1}):
+        actual[doc['_id']] = [doc.get('n_documents', 0), set(doc.get('SAMPLE_IDS', []))]
+    return actual == expected
+
+
+def summary_sample_ids(db, query, sample_range=None):
+    """
+    Answers a summarizable genomic query from the summary collection. The sample ids of a summary document are
+    sorted, so those of a range are sliced out without going through the others.
+
+    :param db: Database connection
+    :param query: Genomic query that only references summary fields
+    :param sample_range: Range of sample ids to return, see sample_range_condition. Every sample if not given.
+    :return: Set of sample ids with a matching genomic document
+    """
+
+    sample_ids = set()
+    for doc in db[SUMMARY_COLLECTION].find(query, {'SAMPLE_IDS': 1}):
+        sample_ids.update(range_slice(doc['SAMPLE_IDS'], sample_range))
+    return sample_ids
+
@@ -0,0 +1,361 @@
+"""Copyright 2016 Dana-Farber Cancer Institute"""
+
+import os
+import csv
+import yaml
+import random
+import datetime as dt
+from bson.objectid import ObjectId
+
+# leaf diagnoses patients are drawn from, with their relative frequency
+DIAGNOSES = [
+    ('Breast Invasive Ductal Carcinoma', 14),
+    ('Lung Adenocarcinoma', 12),
+    ('Colon Adenocarcinoma', 9),
+    ('Prostate Adenocarcinoma', 7),
+    ('Cutaneous Melanoma', 5),
+    ('Pancreatic Adenocarcinoma', 5),
+    ('High-Grade Serous Ovarian Cancer', 5),
+    ('Glioblastoma Multiforme', 4),
+    ('Bladder Urothelial Carcinoma', 4),
+    ('Lung Squamous Cell Carcinoma', 4),
+    ('Renal Clear Cell Carcinoma', 3),
+    ('Hepatocellular Carcinoma', 2),
+    ('Uterine Endometrioid Carcinoma', 3),
+    ('Acute Myeloid Leukemia', 4),
+    ('Diffuse Large B-Cell Lymphoma', 3),
+    ('Multiple Myeloma', 2),
+    ('Chronic Lymphocytic Leukemia', 2)
+]
+
+# diagnoses trials are curated against; inner nodes of the oncotree expand to their descendants
+TRIAL_DIAGNOSES = ['Breast', 'Non-Small Cell Lung Cancer', 'Colorectal Adenocarcinoma', 'Melanoma',
+                   'Diffuse Glioma', 'Invasive Breast Carcinoma', 'Prostate Adenocarcinoma',
+                   'Acute Myeloid Leukemia', 'Cholangiocarcinoma', 'Myelodysplasia']
+
+# genes with the fraction of samples carrying a mutation in them and their hotspot protein changes
+MUTATED_GENES = [
+    ('TP53', 0.35, []),
+    ('PIK3CA', 0.12, ['p.H1047R', 'p.E545K', 'p.E542K']),
+    ('KRAS', 0.12, ['p.G12D', 'p.G12V', 'p.G12C', 'p.G13D']),
+    ('APC', 0.08, []),
+    ('EGFR', 0.07, ['p.L858R', 'p.T790M', 'p.G719S', 'p.G719A']),
+    ('BRAF', 0.06, ['p.V600E', 'p.V600K']),
+    ('PTEN', 0.06, []),
+    ('ARID1A', 0.06, []),
+    ('IDH1', 0.03, ['p.R132H', 'p.R132C']),
+    ('NRAS', 0.03, ['p.Q61K', 'p.Q61R']),
+    ('ERBB2', 0.03, ['p.S310F', 'p.V777L']),
+    ('BRCA2', 0.03, []),
+    ('BRCA1', 0.02, []),
+    ('MET', 0.02, []),
+    ('ALK', 0.01, ['p.F1174L'])
+]
+
+# genes with the fraction of samples carrying a copy number change in them
+CNV_GENES = [('CDKN2A', 0.08), ('MYC', 0.06), ('ERBB2', 0.04), ('EGFR', 0.04), ('MDM2', 0.03), ('PTEN', 0.03)]
+
+# fusion partners with the fraction of samples carrying the fusion
+SV_GENES = [(('EML4', 'ALK'), 0.01), (('ETV6', 'NTRK3'), 0.005), (('TMPRSS2', 'ERG'), 0.02),
+            (('BCR', 'ABL1'), 0.005)]
+
+VARIANT_CLASSIFICATIONS = ['Missense_Mutation'] * 6 + ['Nonsense_Mutation', 'Frame_Shift_Del', 'In_Frame_Del',
+                                                       'Splice_Site']
+CNV_CALLS = ['Heterozygous deletion', 'Homozygous deletion', 'Gain', 'High level amplification']
+AMINO_ACIDS = 'ACDEFGHIKLMNPQRSTVWY'
+
+CLINICAL_FIELDS = ['MRN', 'SAMPLE_ID', 'ONCOTREE_PRIMARY_DIAGNOSIS_NAME', 'BIRTH_DATE', 'REPORT_DATE', 'VITAL_STATUS',
+                   'GENDER', 'FIRST_LAST', 'ORD_PHYSICIAN_NAME', 'ORD_PHYSICIAN_EMAIL']
+GENOMIC_FIELDS = ['SAMPLE_ID', 'TRUE_HUGO_SYMBOL', 'TRUE_PROTEIN_CHANGE', 'TRUE_VARIANT_CLASSIFICATION',
+                  'VARIANT_CATEGORY', 'TRUE_TRANSCRIPT_EXON', 'CNV_CALL', 'WILDTYPE', 'CHROMOSOME', 'POSITION',
+                  'TRUE_CDNA_CHANGE', 'REFERENCE_ALLELE', 'CANONICAL_STRAND', 'ALLELE_FRACTION', 'TIER',
+                  'STRUCTURAL_VARIANT_COMMENT']
+
+
+def _weighted(rng, choices):
+    """Picks from a list of (value, weight) pairs"""
+    total = sum(w for _, w in choices)
+    r = rng.uniform(0, total)
+    upto = 0
+    for value, weight in choices:
+        upto += weight
+        if r <= upto:
+            return value
+    return choices[-1][0]
+
+
+def _protein_change(rng, hotspots):
+    """Returns a hotspot protein change half of the time, otherwise a random missense change"""
+    if hotspots and rng.random() < 0.5:
+        return rng.choice(hotspots)
+    return 'p.%s%d%s' % (rng.choice(AMINO_ACIDS), rng.randint(1, 1200), rng.choice(AMINO_ACIDS))
+
+
+def generate_cohort(n_patients, seed=0, samples_per_patient=1, today=None):
+    """
+    Generates clinical and genomic documents for a synthetic cohort. The same arguments always give the
+    same cohort.
+
+    :param n_patients: Number of patients
+    :param seed: Random seed
+    :param samples_per_patient: Number of sequenced samples per patient
+    :param today: Date ages are computed against. Defaults to today.
+    :return: clinical documents, genomic documents
+    """
+
+    rng = random.Random(seed)
+    today = today or dt.datetime.today().replace(hour=0, minute=0, second=0, microsecond=0)
+
+    clinical = []
+    genomic = []
+    for p in xrange(n_patients):
+        mrn = 'MRN-%07d' % p
+        diagnosis = _weighted(rng, DIAGNOSES)
+        gender = rng.choice(['Male', 'Female'])
+        birth_date = today - dt.timedelta(days=rng.randint(365 * 1, 365 * 90))
+
+        for s in xrange(samples_per_patient):
+            sample_id = 'SAMPLE-%07d-%d' % (p, s)
+            clinical_id = ObjectId('%024x' % (p * samples_per_patient + s + 1))
+            clinical.append({
+                '_id': clinical_id,
+                'MRN': mrn,
+                'SAMPLE_ID': sample_id,
+                'ONCOTREE_PRIMARY_DIAGNOSIS_NAME': diagnosis,
+                'BIRTH_DATE': birth_date,
+                'REPORT_DATE': today - dt.timedelta(days=rng.randint(0, 365 * 5)),
+                'VITAL_STATUS': 'alive' if rng.random() < 0.85 else 'deceased',
+                'GENDER': gender,
+                'FIRST_LAST': 'FIRST%d LAST%d' % (p, p),
+                'ORD_PHYSICIAN_NAME': 'PHYSICIAN %d' % rng.randint(0, 200),
+                'ORD_PHYSICIAN_EMAIL': 'physician%d@example.org' % rng.randint(0, 200)
+            })
+            genomic.extend(_sample_variants(rng, sample_id, clinical_id))
+
+    return clinical, genomic
+
+
+def _sample_variants(rng, sample_id, clinical_id):
+    """Returns the genomic documents of one sample"""
+
+    variants = []
+    base = {'SAMPLE_ID': sample_id, 'CLINICAL_ID': clinical_id, 'WILDTYPE': False}
+
+    for gene, freq, hotspots in MUTATED_GENES:
+        if rng.random() < freq:
+            doc = dict(base)
+            doc.update({
+                'TRUE_HUGO_SYMBOL': gene,
+                'TRUE_PROTEIN_CHANGE': _protein_change(rng, hotspots),
+                'TRUE_VARIANT_CLASSIFICATION': rng.choice(VARIANT_CLASSIFICATIONS),
+                'VARIANT_CATEGORY': 'MUTATION',
+                'TRUE_TRANSCRIPT_EXON': rng.randint(1, 30),
+                'CNV_CALL': None,
+                'CHROMOSOME': 'chr%02d' % rng.randint(1, 22),
+                'POSITION': rng.randint(1000000, 200000000),
+                'TRUE_CDNA_CHANGE': 'c.%d%s>%s' % (rng.randint(1, 4000), rng.choice('ACGT'), rng.choice('ACGT')),
+                'REFERENCE_ALLELE': rng.choice('ACGT'),
+                'CANONICAL_STRAND': rng.choice('+-'),
+                'ALLELE_FRACTION': round(rng.uniform(0.02, 0.9), 2),
+                'TIER': rng.randint(1, 4)
+            })
+            variants.append(doc)
+
+    for gene, freq in CNV_GENES:
+        if rng.random() < freq:
+            doc = dict(base)
+            doc.update({
+                'TRUE_HUGO_SYMBOL': gene,
+                'TRUE_PROTEIN_CHANGE': None,
+                'TRUE_VARIANT_CLASSIFICATION': None,
+                'VARIANT_CATEGORY': 'CNV',
+                'CNV_CALL': rng.choice(CNV_CALLS),
+                'TIER': rng.randint(1, 4)
+            })
+            variants.append(doc)
+
+    for (gene1, gene2), freq in SV_GENES:
+        if rng.random() < freq:
+            doc = dict(base)
+            doc.update({
+                'TRUE_HUGO_SYMBOL': None,
+                'VARIANT_CATEGORY': 'SV',
+                'STRUCTURAL_VARIANT_COMMENT': 'An %s-%s fusion is identified (chr%d:%d to chr%d:%d).' % (
+                    gene1, gene2, rng.randint(1, 22), rng.randint(1000000, 90000000),
+                    rng.randint(1, 22), rng.randint(1000000, 90000000))
+            })
+            variants.append(doc)
+
+    # some wildtype calls
+    if rng.random() < 0.05:
+        doc = dict(base)
+        doc.update({'TRUE_HUGO_SYMBOL': rng.choice(['KRAS', 'NRAS', 'BRAF']), 'VARIANT_CATEGORY': 'MUTATION',
+                    'WILDTYPE': True})
+        variants.append(doc)
+
+    return variants
+
+
+def _genomic_criteria(rng):
+    """Returns a random genomic criterium in yaml format"""
+
+    kind = rng.random()
+    gene, _, hotspots = _weighted(rng, [(g, g[1]) for g in MUTATED_GENES])
+
+    if kind < 0.35:
+        criteria = {'hugo_symbol': gene, 'variant_category': 'Mutation'}
+    elif kind < 0.55 and hotspots:
+        criteria = {'hugo_symbol': gene, 'variant_category': 'Mutation', 'protein_change': rng.choice(hotspots)}
+    elif kind < 0.65 and hotspots:
+        criteria = {'hugo_symbol': gene, 'variant_category': 'Mutation',
+                    'wildcard_protein_change': rng.choice(hotspots)[:-1]}
+    elif kind < 0.8:
+        cnv_gene, _ = rng.choice(CNV_GENES)
+        criteria = {'hugo_symbol': cnv_gene, 'variant_category': 'Copy Number Variation',
+                    'cnv_call': rng.choice(['High Amplification', 'Homozygous Deletion'])}
+    elif kind < 0.88:
+        (_, partner), _ = rng.choice(SV_GENES)
+        criteria = {'hugo_symbol': partner, 'variant_category': 'Structural Variation'}
+    elif kind < 0.93:
+        criteria = {'hugo_symbol': gene, 'variant_category': 'Mutation', 'exon': rng.randint(1, 30)}
+    else:
+        criteria = {'hugo_symbol': gene, 'variant_category': 'Mutation', 'wildtype': 'true'}
+
+    # negations
+    if rng.random() < 0.1:
+        criteria['hugo_symbol'] = '!' + criteria['hugo_symbol']
+
+    return {'genomic': criteria}
+
+
+def _clinical_criteria(rng):
+    """Returns a random clinical criterium in yaml format"""
+
+    r = rng.random()
+    if r < 0.3:
+        diagnosis = '_SOLID_'
+    elif r < 0.35:
+        diagnosis = '_LIQUID_'
+    elif r < 0.4:
+        diagnosis = '!' + rng.choice(TRIAL_DIAGNOSES)
+    else:
+        diagnosis = rng.choice(TRIAL_DIAGNOSES)
+
+    return {'clinical': {'age_numerical': rng.choice(['>=18', '>=18', '>=18', '>=12', '<18', '>=.5']),
+                         'oncotree_primary_diagnosis': diagnosis}}
+
+
+def _match_clause(rng, depth, max_depth):
+    """Returns a random match clause nested up to max_depth levels"""
+
+    if depth >= max_depth or rng.random() < 0.4:
+        return _genomic_criteria(rng)
+
+    n = rng.randint(2, 3)
+    return {rng.choice(['and', 'or', 'or']): [_match_clause(rng, depth + 1, max_depth) for _ in range(n)]}
+
+
+def generate_trial(rng, i, max_depth=3):
+    """
+    Generates a single trial document
+
+    :param rng: random.Random
+    :param i: Trial number, used for its protocol and internal ids
+    :param max_depth: Maximum nesting depth of the genomic part of match clauses
+    :return: Trial document
+    """
+
+    protocol_no = '%d-%03d' % (17 + i // 1000, i % 1000)
+
+    def _match():
+        return [{'and': [_match_clause(rng, 1, max_depth), _clinical_criteria(rng)]}]
+
+    arms = []
+    for a in range(rng.randint(1, 3)):
+        arm = {
+            'arm_code': 'ARM %s' % chr(ord('A') + a),
+            'arm_description': 'Arm %s' % chr(ord('A') + a),
+            'arm_internal_id': i * 100 + a,
+            'arm_suspended': 'Y' if rng.random() < 0.1 else 'N',
+            'dose_level': []
+        }
+
+        # either the arm or its dose levels carry the match clause
+        if rng.random() < 0.75:
+            arm['match'] = _match()
+        else:
+            for d in range(rng.randint(1, 2)):
+                arm['dose_level'].append({
+                    'level_code': str(d + 1),
+                    'level_description': 'Dose level %d' % (d + 1),
+                    'level_internal_id': i * 100 + a * 10 + d,
+                    'level_suspended': 'N',
+                    'match': _match()
+                })
+        arms.append(arm)
+
+    return {
+        'protocol_no': protocol_no,
+        'protocol_id': i,
+        'nct_id': 'NCT%08d' % i,
+        'long_title': 'Synthetic trial %d' % i,
+        'short_title': 'Synthetic %d' % i,
+        'phase': rng.choice(['I', 'II', 'III']),
+        '_summary': {
+            'status': [{'value': 'Open to Accrual' if rng.random() < 0.8 else 'Closed to Accrual'}],
+            'coordinating_center': rng.choice(['Dana-Farber Cancer Institute', 'Massachusetts General Hospital']),
+            'tumor_types': [rng.choice(['_SOLID_', '_LIQUID_', 'Breast', 'Lung'])]
+        },
+        'treatment_list': {
+            'step': [{
+                'step_code': '1',
+                'step_internal_id': i * 100,
+                'step_type': 'Registration',
+                'arm': arms
+            }]
+        }
+    }
+
+
+def generate_trials(n_trials, seed=0, max_depth=3):
+    """
+    Generates trial documents. The same arguments always give the same trials.
+
+    :param n_trials: Number of trials
+    :param seed: Random seed
+    :param max_depth: Maximum nesting depth of the genomic part of match clauses
+    :return: List of trial documents
+    """
+
+    rng = random.Random(seed)
+    return [generate_trial(rng, i, max_depth=max_depth) for i in xrange(n_trials)]
+
+
+def write_trials(trials, directory):
+    """Writes one YML file per trial into a directory, ready for "matchengine.py load -t" """
+
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    for trial in trials:
+        with open(os.path.join(directory, '%s.yml' % trial['protocol_no']), 'w') as f:
+            yaml.safe_dump(trial, f, default_flow_style=False)
+
+
+def write_cohort(clinical, genomic, clinical_path, genomic_path):
+    """Writes a cohort to clinical and genomic CSV files, ready for "matchengine.py load -c -g" """
+
+    with open(clinical_path, 'wb') as f:
+        writer = csv.DictWriter(f, fieldnames=CLINICAL_FIELDS, extrasaction='ignore')
+        writer.writeheader()
+        for doc in clinical:
+            row = dict(doc)
+            for col in ['BIRTH_DATE', 'REPORT_DATE']:
+                row[col] = row[col].strftime('%Y-%m-%d')
+            writer.writerow(row)
+
+    with open(genomic_path, 'wb') as f:
+        writer = csv.DictWriter(f, fieldnames=GENOMIC_FIELDS, extrasaction='ignore')
+        writer.writeheader()
+        for doc in genomic:
+            writer.writerow(dict((k, '' if v is None else v) for k, v in doc.iteritems()))
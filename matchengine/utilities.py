@@ -3,15 +3,26 @@
 import re
 import os
 import sys
-import yaml
 import json
+import time
 import logging
-import pandas as pd
 import datetime as dt
-from pymongo import MongoClient
 
-import oncotreenx
-from matchengine.settings import months, TUMOR_TREE, mmr_map, mmr_map_rev
+from matchengine.settings import months, TUMOR_TREE, TRIAL_UPDATED, mmr_map, mmr_map_rev
+from matchengine.storage import memory_db
+
+# pymongo, pandas, yaml, networkx and oncotreenx are imported by the functions that use them, so commands that only
+# need an in-memory database or the query builders do not load them
+
+# indexes created when patient data is loaded, which the leaf queries of every run rely on
+LOAD_INDEXES = [
+    ('genomic', [('TRUE_HUGO_SYMBOL', 1), ('WILDTYPE', 1)]),
+    ('genomic', [('SV_GENES', 1)]),
+    ('genomic', [('TRUE_HUGO_SYMBOL', 1), ('TRUE_PROTEIN_CODON', 1)]),
+    ('genomic', [('SAMPLE_ID', 1)]),
+    ('clinical', [('SAMPLE_ID', 1)]),
+    ('clinical', [('ONCOTREE_ANCESTORS', 1)])
+]
 
 
 def build_gquery(field, txt):
@@ -100,9 +111,98 @@ def build_cquery(c, norm_field, txt):
 
 def build_oncotree():
     """Builds oncotree"""
+    import oncotreenx
     return oncotreenx.build_oncotree(file_path=TUMOR_TREE)
 
 
+# oncotree nodes whose subtrees are the liquid tumors; every other diagnosis in the oncotree is solid
+LIQUID_NODES = ['Lymph', 'Blood']
+
+
+def oncotree_ancestry(onco_tree, diagnosis):
+    """
+    Returns the oncotree fields stored on a clinical document by the loader, so that a trial diagnosis matches
+    with one equality on an indexed ancestor code instead of a list of every diagnosis below it.
+
+    :param onco_tree: Oncotree
+    :param diagnosis: ONCOTREE_PRIMARY_DIAGNOSIS_NAME
+    :return: Dictionary with ONCOTREE_ANCESTORS, the codes of the diagnosis node and all of its ancestors, and
+        the IS_SOLID and IS_LIQUID flags. A diagnosis that is not in the oncotree has no ancestors and is neither
+        solid nor liquid.
+    """
+
+    import networkx as nx
+    import oncotreenx
+
+    node = oncotreenx.lookup_text(onco_tree, diagnosis) if diagnosis else None
+    if node is None or not onco_tree.has_node(node):
+        return {'ONCOTREE_ANCESTORS': [], 'IS_SOLID': False, 'IS_LIQUID': False}
+
+    ancestors = set(nx.ancestors(onco_tree, node)) | set([node])
+    is_liquid = any(oncotreenx.lookup_text(onco_tree, txt) in ancestors for txt in LIQUID_NODES)
+    return {'ONCOTREE_ANCESTORS': sorted(ancestors), 'IS_SOLID': not is_liquid, 'IS_LIQUID': is_liquid}
+
+
+def update_ancestry(db, onco_tree=None):
+    """
+    Stores the oncotree ancestry on the clinical documents that do not have it yet, see oncotree_ancestry.
+    Documents are updated once per distinct diagnosis.
+
+    :param db: Database connection
+    :param onco_tree: Oncotree. Built if not given.
+    :return: Number of clinical documents updated
+    """
+
+    missing = {'ONCOTREE_ANCESTORS': {'$exists': False}}
+    diagnoses = db.clinical.find(missing).distinct('ONCOTREE_PRIMARY_DIAGNOSIS_NAME')
+    if not diagnoses and db.clinical.find_one(missing) is None:
+        return 0
+
+    if onco_tree is None:
+        onco_tree = build_oncotree()
+
+    n = 0
+    for diagnosis in diagnoses:
+        query = {'ONCOTREE_PRIMARY_DIAGNOSIS_NAME': diagnosis, 'ONCOTREE_ANCESTORS': {'$exists': False}}
+        n += db.clinical.update_many(query, {'$set': oncotree_ancestry(onco_tree, diagnosis)}).modified_count
+
+    # documents without a diagnosis
+    n += db.clinical.update_many(missing, {'$set': oncotree_ancestry(onco_tree, None)}).modified_count
+    return n
+
+
+def ancestry_is_current(db):
+    """True if every clinical document has its oncotree ancestry"""
+    return db.clinical.find_one({'ONCOTREE_ANCESTORS': {'$exists': False}}, {'_id': 1}) is None
+
+
+def sv_genes_is_current(db):
+    """True if every genomic document has the gene tokens of its structural variant comment"""
+    return db.genomic.find_one({'SV_GENES': {'$exists': False}}, {'_id': 1}) is None
+
+
+def update_sv_genes(db):
+    """
+    Stores the gene tokens of the structural variant comment on the genomic documents that do not have them yet,
+    e.g. documents loaded before the tokens were added, see sv_gene_tokens. Documents without a comment get an
+    empty list.
+
+    :param db: Database connection
+    :return: Number of genomic documents updated
+    """
+
+    missing = {'SV_GENES': {'$exists': False}}
+    n = 0
+    for item in db.genomic.find(dict(missing, STRUCTURAL_VARIANT_COMMENT={'$nin': [None, '']}),
+                                {'STRUCTURAL_VARIANT_COMMENT': 1}):
+        tokens = sv_gene_tokens(item['STRUCTURAL_VARIANT_COMMENT'])
+        n += db.genomic.update_one({'_id': item['_id']}, {'$set': {'SV_GENES': tokens}}).modified_count
+
+    # documents without a comment
+    n += db.genomic.update_many(missing, {'$set': {'SV_GENES': []}}).modified_count
+    return n
+
+
 def normalize_fields(mapping, field):
     """Translates yaml field name into the database field name."""
 
@@ -159,8 +259,43 @@ def samples_from_mrns(db, mrns):
     return mrn_map
 
 
-def search_birth_date(c):
-    """Converts query to filter by birth date based on the given age"""
+def sample_partitions(db, partition_size):
+    """
+    Splits the sample ids of the clinical collection into consecutive ranges of at most partition_size samples.
+    Sample ids are streamed in order, so only the bounds of the ranges are held in memory.
+
+    :param db: Database connection
+    :param partition_size: Maximum number of samples per range
+    :return: List of dictionaries with the first sample id of a range, "min", and the first sample id of the next
+        range, "max". The first range has no lower bound and the last no upper bound, so samples loaded later
+        fall into a range too.
+    """
+
+    bounds = [None]
+    n = 0
+    last = None
+    for doc in db.clinical.find({}, {'SAMPLE_ID': 1, '_id': 0}).sort('SAMPLE_ID', 1):
+        sample_id = doc.get('SAMPLE_ID')
+        if sample_id is None or sample_id == last:
+            continue
+        if n == partition_size:
+            bounds.append(sample_id)
+            n = 0
+        n += 1
+        last = sample_id
+    bounds.append(None)
+
+    return [{'min': low, 'max': high} for low, high in zip(bounds[:-1], bounds[1:])]
+
+
+def search_birth_date(c, today=None):
+    """
+    Converts query to filter by birth date based on the given age
+
+    :param c: Clinical query with the yaml age restriction under BIRTH_DATE, e.g. {'$eq': '>=18'}
+    :param today: Date the age is computed at. Defaults to now.
+    :return: Mongo condition on BIRTH_DATE
+    """
     txt = c['BIRTH_DATE']['$eq']
 
     # translate to mongo query
@@ -182,7 +317,8 @@ def search_birth_date(c):
     abs_age = str(txt[idx:])
 
     # date today
-    today = dt.datetime.today()
+    if today is None:
+        today = dt.datetime.today()
 
     # calculate date to query
     if '.' in abs_age:
@@ -228,6 +364,8 @@ def get_months(abs_age, today):
 def add_trials(trial_path, db):
     """Adds all ymls in the "trial_path" to the db"""
 
+    import yaml
+
     inserted_ids = 0
 
     # search directory for ymls
@@ -241,6 +379,7 @@ def add_trials(trial_path, db):
         # convert yml to json format
         with open(ymlpath) as f:
             t = yaml.load(f.read())
+            t.setdefault(TRIAL_UPDATED, dt.datetime.utcnow())
 
             # add trial to db
             result = db.trial.insert_one(t)
@@ -373,9 +512,19 @@ def format_query(g, gene=False):
     return alteration
 
 
-def add_matches(trial_matches_df, db):
+def add_matches(trial_matches_df, db, stats=None):
     """Add the match table to the database or update what already exists theres"""
 
+    if len(trial_matches_df.index) > 0:
+        db.trial_match.drop()
+        insert_matches(trial_matches_df, db, stats=stats)
+
+
+def insert_matches(trial_matches_df, db, stats=None):
+    """Inserts a match table into the trial_match collection, 1000 matches at a time"""
+
+    import pandas as pd
+
     if 'clinical_id' in trial_matches_df.columns:
         trial_matches_df['clinical_id'] = trial_matches_df['clinical_id'].apply(lambda x: str(x))
 
@@ -386,15 +535,27 @@ def add_matches(trial_matches_df, db):
         trial_matches_df['report_date'] = trial_matches_df['report_date'].apply(
             lambda x: dt.datetime.strftime(x, '%Y-%m-%d %X') if pd.notnull(x) else x)
 
-    if len(trial_matches_df.index) > 0:
-        db.trial_match.drop()
-        for i in range(0, trial_matches_df.shape[0], 1000):
-            records = json.loads(trial_matches_df[i:i + 1000].T.to_json()).values()
-            db.trial_match.insert_many(records)
+    for i in range(0, trial_matches_df.shape[0], 1000):
+        start = stats.start() if stats else None
+        records = json.loads(trial_matches_df[i:i + 1000].T.to_json()).values()
+        db.trial_match.insert_many(records)
+        if start is not None:
+            stats.add_time('write_batch', time.time() - start)
+
 
+def create_load_indexes(db):
+    """Creates the indexes of LOAD_INDEXES"""
+    for collection, keys in LOAD_INDEXES:
+        db[collection].create_index(keys)
 
-def get_db(uri):
-    """Returns a Mongo connection"""
+
+def get_db(uri, name='matchminer'):
+    """
+    Returns a Mongo connection, or an in-memory database for "memory://" URIs
+
+    :param uri: Mongo URI. Read from $SECRETS_JSON or $MONGO_URI if not given.
+    :param name: Name of the Mongo database
+    """
 
     if uri:
         MONGO_URI = uri
@@ -423,15 +584,112 @@ def get_db(uri):
         logging.error("MONGO_URI not set in SECRETS_JSON")
     else:
         os.environ["MONGO_URI"] = MONGO_URI
+        if MONGO_URI.startswith('memory://'):
+            return memory_db(MONGO_URI)
+
+        from pymongo import MongoClient
         connection = MongoClient(MONGO_URI)
-        return connection["matchminer"]
+        return connection[name]
+
+
+def sv_gene_tokens(comment):
+    """
+    Tokenizes a pathologist's structural variant comment into the gene symbols it could mention.
+    A gene matches a comment token for token exactly when the regexes of get_structural_variants would match it.
+
+    :param comment: STRUCTURAL_VARIANT_COMMENT
+    :return: Sorted list of upper case tokens
+    """
+
+    if not isinstance(comment, basestring):
+        return []
+
+    # gene symbols never consist of digits only
+    return sorted(set(t.upper() for t in re.split(r'\W+', comment) if t and not t.isdigit()))
+
+
+def annotate_genomic(item):
+    """
+    Adds the fields derived at load time to a genomic document
+
+    :param item: Genomic document
+    :return: Genomic document
+    """
+
+    # every document has the field, so structural variant queries never fall back to the comment
+    item['SV_GENES'] = sv_gene_tokens(item.get('STRUCTURAL_VARIANT_COMMENT'))
+
+    item['TRUE_PROTEIN_CODON'], item['TRUE_PROTEIN_POSITION'] = protein_codon(item.get('TRUE_PROTEIN_CHANGE'))
+
+    return item
+
+
+# p.G719A -> reference residue G at codon 719 followed by a variant residue, as "^p.G719[A-Z]" matches it
+PROTEIN_CODON_RE = re.compile(r'^p\.([A-Z*]?)(\d+)[A-Z]')
+
+# regex built by build_gquery for a wildcard protein change with a single letter residue
+WILDCARD_RE = re.compile(r'^\^p\.([A-Z]?\d+)\[A-Z\]$')
+
+
+def protein_codon(protein_change):
+    """
+    Parses the reference residue and codon position of a protein change.
+
+    :param protein_change: TRUE_PROTEIN_CHANGE, e.g. "p.G719A"
+    :return: Tuple of the codon, e.g. "G719", and the position, e.g. 719. (None, None) if it cannot be parsed
+    """
+
+    if not isinstance(protein_change, basestring):
+        return None, None
 
+    m = PROTEIN_CODON_RE.match(protein_change)
+    if not m:
+        return None, None
+    return m.group(1) + m.group(2), int(m.group(2))
+
+
+def indexed_genomic_query(g):
+    """
+    Rewrites the wildcard protein change regexes of a genomic query into equality on TRUE_PROTEIN_CODON.
+    Documents loaded before the field existed are still searched by regex.
 
-def get_structural_variants(g):
+    :param g: Genomic query as built by prepare_genomic_criteria
+    :return: Equivalent query that can use an index
     """
-    Performs a string search for the structural variant.
+
+    if '$and' in g:
+        q = dict(g)
+        q['$and'] = [indexed_genomic_query(item) for item in g['$and']]
+        return q
+
+    mut = g.get('TRUE_PROTEIN_CHANGE')
+    if not isinstance(mut, dict) or mut.keys() != ['$regex']:
+        return g
+
+    m = WILDCARD_RE.match(mut['$regex'])
+    if not m:
+        return g
+
+    q = dict((k, v) for k, v in g.iteritems() if k != 'TRUE_PROTEIN_CHANGE')
+    codon = {'$or': [
+        {'TRUE_PROTEIN_CODON': m.group(1)},
+        {'TRUE_PROTEIN_CODON': {'$exists': False}, 'TRUE_PROTEIN_CHANGE': mut}
+    ]}
+
+    if '$or' in q:
+        return {'$and': [q, codon]}
+    q.update(codon)
+    return q
+
+
+def get_structural_variants(g, tokens=True):
+    """
+    Searches for the structural variant in the gene tokens of the pathologist's comment, which annotate_genomic
+    and update_sv_genes store on genomic documents. Symbols with punctuation, e.g. NKX2-1, span several tokens:
+    documents with any of their tokens are found through the index, then the comment is matched by regex.
 
     :param g: Genomic query in
+    :param tokens: Set to False to search the comment by regex only, for documents without gene tokens
     :return: Genomic query out
     """
 
@@ -453,7 +711,11 @@ def get_structural_variants(g):
 
     # add it to filter and remove gene criteria.
     del g['TRUE_HUGO_SYMBOL']
-    g['STRUCTURAL_VARIANT_COMMENT'] = {"$in": sv_clauses}
+
+    if tokens:
+        g['SV_GENES'] = {'$in': sorted(set(token for gene in genes for token in sv_gene_tokens(gene)))}
+    if not tokens or not all(re.match(r'^\w+$', gene) for gene in genes):
+        g['STRUCTURAL_VARIANT_COMMENT'] = {"$in": sv_clauses}
 
     return g
 
@@ -483,6 +745,21 @@ def get_cancer_type_match(trial):
         return 'specific'
 
 
+def get_trial_status(trial):
+    """
+    Returns "open" if the trial is open to accrual and "closed" otherwise. Trials without a status are open.
+
+    :param trial: Entire trial object
+    """
+
+    if '_summary' in trial:
+        if 'status' in trial['_summary'] and isinstance(trial['_summary']['status'], list):
+            if 'value' in trial['_summary']['status'][0]:
+                if trial['_summary']['status'][0]['value'].lower() != 'open to accrual':
+                    return 'closed'
+    return 'open'
+
+
 def get_coordinating_center(trial):
     """
     Returns the trials' coordinating center
@@ -43,7 +43,9 @@ class TestSetUp(unittest.TestCase):
 
         self.db = get_db(None)
         for res in ["clinical", "dashboard", "filter", "genomic", "hipaa", "match", "normalize", "oplog"
-                    "response", "statistics", "status", "team", "trial", "trial_match", "user"]:
+                    "response", "statistics", "status", "team", "trial", "trial_match", "trial_cache",
+                    "genomic_summary", "trial_match_counts", "match_run", "trial_match_staging", "match_queue",
+                    "user"]:
             self.db.drop_collection(res)
 
         self.me = MatchEngine(self.db)
@@ -0,0 +1,65 @@
+"""Copyright 2016 Dana-Farber Cancer Institute"""
+
+import unittest
+import datetime as dt
+
+from matchengine.storage import MemoryDatabase
+from matchengine.ages import AgeCriteria, BirthDateIndex
+
+
+class TestAges(unittest.TestCase):
+
+    def setUp(self):
+        self.as_of = dt.datetime(2017, 6, 15, 12, 30)
+        self.db = MemoryDatabase()
+        self.db.clinical.insert_many([
+            {'SAMPLE_ID': 'S1', 'BIRTH_DATE': dt.datetime(1950, 1, 1)},
+            {'SAMPLE_ID': 'S2', 'BIRTH_DATE': dt.datetime(1999, 6, 15)},
+            {'SAMPLE_ID': 'S3', 'BIRTH_DATE': dt.datetime(1999, 6, 16)},
+            {'SAMPLE_ID': 'S4', 'BIRTH_DATE': dt.datetime(2017, 1, 1)},
+            {'SAMPLE_ID': 'S5', 'BIRTH_DATE': '1950-01-01'},
+            {'SAMPLE_ID': 'S6'}
+        ])
+
+    def test_condition(self):
+
+        ages = AgeCriteria(self.as_of)
+        assert ages.condition('>=18') == {'$lte': dt.datetime(1999, 6, 15, 12, 30)}
+        assert ages.condition('<18') == {'$gt': dt.datetime(1999, 6, 15, 12, 30)}
+        assert ages.condition('>=.25') == {'$lte': dt.datetime(2017, 3, 15, 12, 30)}
+
+        # every expression is translated once
+        assert ages.condition('>=18') is ages.condition('>=18')
+        assert sorted(ages.cutoffs) == ['<18', '>=.25', '>=18']
+
+    def test_birth_date_index(self):
+
+        ages = AgeCriteria(self.as_of)
+        index = BirthDateIndex(self.db)
+
+        # the vectorized comparison agrees with the query it replaces
+        for txt in ['>=18', '>18', '<=18', '<18', '>=.5', '<.5']:
+            condition = ages.condition(txt)
+            expected = set(self.db.clinical.find({'BIRTH_DATE': condition}).distinct('SAMPLE_ID'))
+            assert index.match(condition) == expected, txt
+
+        assert index.match(ages.condition('>=18')) == set(['S1', 'S2'])
+        assert index.match(ages.condition('<.5')) == set(['S4'])
+
+    def test_refresh(self):
+
+        # a given date is kept
+        ages = AgeCriteria(self.as_of)
+        ages.condition('>=18')
+        ages.refresh()
+        assert ages.as_of == self.as_of
+        assert sorted(ages.cutoffs) == ['>=18']
+
+        # otherwise the date moves to now and the cutoffs of the previous date are dropped
+        ages = AgeCriteria()
+        ages.as_of = self.as_of
+        ages.condition('>=18')
+        ages.refresh()
+        assert ages.as_of > self.as_of
+        assert ages.cutoffs == {}
+        assert ages.condition('>=18')['$lte'] > dt.datetime(1999, 6, 15, 12, 30)
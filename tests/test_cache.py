@@ -0,0 +1,118 @@
+"""Copyright 2016 Dana-Farber Cancer Institute"""
+
+import copy
+import datetime as dt
+
+from matchengine.cache import TrialCache, trial_hash, dump_plan, load_plan, _PLANS
+from tests import TestSetUp
+
+
+class TestCache(TestSetUp):
+
+    def setUp(self):
+        super(TestCache, self).setUp()
+        self.add_clinical()
+        self.add_genomic()
+        self.add_trials()
+        _PLANS.clear()
+
+    def tearDown(self):
+        self.db.clinical.drop()
+        self.db.genomic.drop()
+        self.db.trial.drop()
+        self.db.trial_cache.drop()
+
+    def test_trial_hash(self):
+
+        trial = self.db.trial.find_one({'protocol_no': '00-001'})
+
+        # the mongo id and the edit time do not change the hash
+        same = copy.deepcopy(trial)
+        same['_id'] = 'other'
+        same['_updated'] = dt.datetime(2017, 1, 1)
+        assert trial_hash(trial) == trial_hash(same)
+
+        # the content does
+        changed = copy.deepcopy(trial)
+        changed['treatment_list']['step'][0]['arm'][0]['dose_level'][0]['level_code'] = '2'
+        assert trial_hash(trial) != trial_hash(changed)
+
+        # and so do the compile options
+        assert trial_hash(trial) != trial_hash(trial, options={'version': 2})
+
+    def test_load(self):
+
+        trial = self.db.trial.find_one({'protocol_no': '00-001'})
+        cache = TrialCache(self.db)
+
+        # first load compiles and stores the plan
+        plan = cache.load(trial, self.me.compile_trial)
+        assert cache.misses == 1 and cache.hits == 0
+        assert self.db.trial_cache.count() == 1
+        assert len(plan) == 1
+        assert plan[0]['match_segment'] == 'dose'
+        assert plan[0]['trial_segment']['level_internal_id'] == 1
+
+        # leaves are compiled into mongo queries
+        tree = plan[0]['match_tree']
+        leaves = [tree.node[n]['compiled'] for n in tree.nodes() if 'compiled' in tree.node[n]]
+        assert sorted(leaf['collection'] for leaf in leaves) == ['clinical', 'genomic']
+
+        # age restrictions are resolved at run time
+        clinical = [leaf for leaf in leaves if leaf['collection'] == 'clinical'][0]
+        assert clinical['query']['BIRTH_DATE'] == {'$eq': '>=18'}, clinical
+
+        # second load is served from memory
+        cache.load(trial, self.me.compile_trial)
+        assert cache.hits == 1 and cache.misses == 1
+
+        # another process is served from the side collection
+        _PLANS.clear()
+        cache = TrialCache(self.db)
+        cache.load(trial, self.me.compile_trial)
+        assert cache.hits == 1 and cache.misses == 0
+
+        # a changed trial is recompiled and replaces its old plan
+        trial['treatment_list']['step'][0]['arm'][0]['dose_level'][0]['level_code'] = '2'
+        cache.load(trial, self.me.compile_trial)
+        assert cache.misses == 1
+        assert self.db.trial_cache.count() == 1
+
+    def test_dump_plan(self):
+
+        # plans are stored as plain json, and read back unchanged
+        for trial in self.db.trial.find():
+            plan = self.me.compile_trial(trial)
+            blob = dump_plan(plan)
+            assert isinstance(blob, str)
+            loaded = load_plan(blob)
+            assert dump_plan(loaded) == blob
+            for segment, original in zip(loaded, plan):
+                assert sorted(segment['match_tree'].edges()) == sorted(original['match_tree'].edges())
+                assert segment['match_tree'].node == original['match_tree'].node
+                assert segment['trial_segment'] == original['trial_segment']
+
+        # regexes and dates of compiled queries keep their type
+        tree = self.me.compile_match_tree({'genomic': {'hugo_symbol': 'NKX2-1', 'variant_category': 'SV'}})
+        leaf = [n for n in tree.nodes() if 'compiled' in tree.node[n]][0]
+        tree.node[leaf]['compiled']['when'] = dt.datetime(2017, 6, 15, 12, 30)
+        loaded = load_plan(dump_plan([{'match_segment': 'arm', 'trial_segment': {}, 'match_tree': tree}]))
+        compiled = loaded[0]['match_tree'].node[leaf]['compiled']
+        assert compiled['query']['$and'][0]['STRUCTURAL_VARIANT_COMMENT']['$in'][0].search('A nkx2-1 fusion')
+        assert compiled['when'] == dt.datetime(2017, 6, 15, 12, 30)
+
+        # anything else is not stored
+        tree.node[leaf]['compiled']['when'] = object()
+        with self.assertRaises(TypeError):
+            dump_plan([{'match_segment': 'arm', 'trial_segment': {}, 'match_tree': tree}])
+
+    def test_cached_matches(self):
+
+        # matching from compiled plans gives the same matches on every run
+        self.me.find_trial_matches()
+        first = sorted((m['sample_id'], m['protocol_no'], m['internal_id']) for m in self.db.trial_match.find())
+
+        self.me.find_trial_matches()
+        second = sorted((m['sample_id'], m['protocol_no'], m['internal_id']) for m in self.db.trial_match.find())
+        assert first == second
+        assert self.me.cache.hits > 0
@@ -222,6 +222,11 @@ class TestMatchEngine(TestSetUp):
                 cnt += 1
         assert cnt == 2
 
+        # changes to a returned tree do not reach the trees returned later
+        trial_tree.remove_nodes_from(list(trial_tree.nodes()))
+        status, trial_tree = self.me.create_trial_tree(test_inp)
+        assert len(list(trial_tree.nodes())) == 4
+
     def test_create_match_tree(self):
 
         # parse yaml file and create trial tree.
@@ -289,3 +294,14 @@ class TestMatchEngine(TestSetUp):
             'Melanoma', 'Congenital Nevus', 'Genitourinary Mucosal Melanoma', 'Cutaneous Melanoma',
             'Melanoma of Unknown Primary', 'Desmoplastic Melanoma', 'Lentigo Maligna Melanoma', 'Acral Melanoma'
         ]
+
+    def test_bootstrap_map(self):
+
+        # the map is updated in place, without duplicates, and entries no longer mapped are removed
+        self.db.map.insert_one({'key_old': 'RETIRED', 'key_new': 'RETIRED', 'values': {}})
+        MatchEngine(self.db)
+        MatchEngine(self.db)
+        keys = [item['key_old'] for item in self.db.map.find()]
+        assert 'RETIRED' not in keys
+        assert len(keys) == len(set(keys)) == 11
+        assert self.db.map.find_one({'key_old': 'HUGO_SYMBOL'})['key_new'] == 'TRUE_HUGO_SYMBOL'
@@ -0,0 +1,47 @@
+"""Copyright 2016 Dana-Farber Cancer Institute"""
+
+from matchengine.explain import explain_trial, collscans, format_trial, format_run
+from tests import TestSetUp
+
+
+class TestExplain(TestSetUp):
+
+    def setUp(self):
+        super(TestExplain, self).setUp()
+        self.add_clinical()
+        self.add_genomic()
+        self.add_trials()
+
+    def tearDown(self):
+        self.db.clinical.drop()
+        self.db.genomic.drop()
+        self.db.trial.drop()
+        self.db.trial_cache.drop()
+
+    def test_explain_trial(self):
+
+        trial = self.db.trial.find_one({'protocol_no': '00-001'})
+        segments = explain_trial(self.me, trial)
+        assert len(segments) == 1
+
+        # the tree is listed depth first from its root
+        nodes = segments[0]['nodes']
+        assert nodes[0]['node'] == 1 and nodes[0]['depth'] == 0
+        assert all(n['depth'] > 0 for n in nodes[1:])
+
+        # every leaf has its query and execution
+        leaves = [n for n in nodes if 'collection' in n]
+        assert sorted(n['collection'] for n in leaves) == ['clinical', 'genomic']
+        for leaf in leaves:
+            assert leaf['explain']['returned'] is not None
+
+        # the clinical collection has no index on the criteria fields
+        assert 'clinical' in [n['collection'] for n in collscans(segments)]
+
+        text = format_trial('00-001', segments)
+        assert 'db.genomic.find(' in text
+        assert '*** COLLSCAN ***' in text
+
+        text = format_run([('00-001', segments)])
+        assert text.splitlines()[1].startswith('00-001')
+        assert text.endswith('2 leaves, %d scanned a whole collection' % len(collscans(segments)))
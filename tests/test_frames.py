@@ -0,0 +1,67 @@
+"""Copyright 2016 Dana-Farber Cancer Institute"""
+
+import os
+import json
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import pandas as pd
+
+from matchengine.frames import read_patient_csv, frame_records, GENOMIC_CATEGORIES
+
+GENOMIC_CSV = """SAMPLE_ID,TRUE_HUGO_SYMBOL,TRUE_TRANSCRIPT_EXON,POSITION,TIER,ALLELE_FRACTION,WILDTYPE,TRUE_PROTEIN_CHANGE
+S1,EGFR,19,55242465,1,0.22,False,p.E746_A750del
+S1,BRAF,15,140453136,,0.481,False,p.V600E
+S2,EGFR,,,2,,True,
+S3,,21,55259515,1,0.05,False,p.L858R
+"""
+
+
+class TestFrames(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _read(self, content):
+        path = os.path.join(self.directory, 'genomic.csv')
+        with open(path, 'w') as f:
+            f.write(content)
+        expected = json.loads(pd.read_csv(path).to_json(orient='records'))
+        return read_patient_csv(path, GENOMIC_CATEGORIES), expected
+
+    def test_dense_types(self):
+
+        df, _ = self._read(GENOMIC_CSV)
+        assert str(df['SAMPLE_ID'].dtype) == 'category'
+        assert str(df['TRUE_HUGO_SYMBOL'].dtype) == 'category'
+        assert df['ALLELE_FRACTION'].dtype == np.float32
+        assert df['TRUE_TRANSCRIPT_EXON'].dtype == np.float32
+        assert df['POSITION'].dtype == np.float64
+        assert df['WILDTYPE'].dtype == bool
+
+    def test_records(self):
+
+        df, expected = self._read(GENOMIC_CSV)
+        records = [record for chunk in frame_records(df, chunk_size=3) for record in chunk]
+
+        # the documents are those built from the file read with inferred types, with integers kept integers
+        assert len(records) == len(expected)
+        for record, row in zip(records, expected):
+            for column in ['TRUE_TRANSCRIPT_EXON', 'POSITION', 'TIER']:
+                if row[column] is not None:
+                    row[column] = int(row[column])
+            assert record == row, (record, row)
+        assert isinstance(records[0]['TRUE_TRANSCRIPT_EXON'], int)
+        assert records[1]['ALLELE_FRACTION'] == 0.481
+
+    def test_numeric_categories(self):
+
+        # sample ids that are numbers are stored as numbers, as they would be without categories
+        df, expected = self._read('SAMPLE_ID,TRUE_HUGO_SYMBOL\n1,EGFR\n2,BRAF\n1,KRAS\n')
+        records = next(frame_records(df))
+        assert [r['SAMPLE_ID'] for r in records] == [1, 2, 1]
+        assert records == expected
@@ -0,0 +1,91 @@
+"""Copyright 2016 Dana-Farber Cancer Institute"""
+
+import re
+
+from matchengine.indexes import IndexAdvisor, BASE_INDEXES, query_branches, explain_summary
+from tests import TestSetUp
+
+
+class TestIndexes(TestSetUp):
+
+    def setUp(self):
+        super(TestIndexes, self).setUp()
+        self.add_clinical()
+        self.add_genomic()
+        self.add_trials()
+
+    def tearDown(self):
+        self.db.clinical.drop()
+        self.db.genomic.drop()
+        self.db.trial.drop()
+        self.db.trial_cache.drop()
+
+    def test_query_branches(self):
+
+        g = {'$and': [
+            {'TRUE_HUGO_SYMBOL': {'$eq': 'EGFR'}, 'TRUE_PROTEIN_CHANGE': {'$regex': '^p.L858[A-Z]'}},
+            {'$or': [{'WILDTYPE': False}, {'WILDTYPE': {'$exists': False}}]}
+        ]}
+        branches = query_branches(g)
+        assert branches == [
+            {'TRUE_HUGO_SYMBOL': 'eq', 'TRUE_PROTEIN_CHANGE': 'range', 'WILDTYPE': 'eq'},
+            {'TRUE_HUGO_SYMBOL': 'eq', 'TRUE_PROTEIN_CHANGE': 'range', 'WILDTYPE': 'other'}
+        ]
+
+        assert query_branches({'STRUCTURAL_VARIANT_COMMENT': re.compile('EGFR')}) == [
+            {'STRUCTURAL_VARIANT_COMMENT': 'range'}]
+
+    def test_explain_summary(self):
+
+        explain = {
+            'queryPlanner': {'winningPlan': {'stage': 'PROJECTION', 'inputStage': {
+                'stage': 'IXSCAN', 'indexName': 'TRUE_HUGO_SYMBOL_1_WILDTYPE_1'}}},
+            'executionStats': {'nReturned': 2, 'totalKeysExamined': 2, 'totalDocsExamined': 0,
+                               'executionTimeMillis': 1}
+        }
+        summary = explain_summary(explain)
+        assert summary['index'] == 'TRUE_HUGO_SYMBOL_1_WILDTYPE_1'
+        assert summary['docs_examined'] == 0
+        assert not summary['collscan']
+
+        summary = explain_summary({'cursor': 'BasicCursor', 'nscannedObjects': 10, 'nscanned': 10, 'n': 1})
+        assert summary['collscan']
+        assert summary['docs_examined'] == 10
+
+    def test_propose(self):
+
+        advisor = IndexAdvisor(self.db)
+        advisor.me.cache.clear()
+        queries = advisor.collect()
+        assert queries
+        assert set(q['collection'] for q in queries) == set(['genomic', 'clinical'])
+
+        # collecting compiles the trials without storing their plans
+        assert advisor.me.cache.misses > 0
+        assert self.db.trial_cache.count() == 0
+
+        proposals = advisor.propose()
+
+        # the base indexes are always proposed
+        assert [('SAMPLE_ID', 1)] in [keys for keys, _ in proposals['clinical']]
+        assert [('protocol_no', 1)] in [keys for keys, _ in proposals['trial']]
+
+        assert [('SAMPLE_ID', 1)] in [keys for keys, _ in proposals['genomic']]
+
+        # the other genomic indexes start with the gene, and no proposal is a prefix of another
+        genomic = [keys for keys, _ in proposals['genomic'] if keys not in BASE_INDEXES['genomic']]
+        assert genomic
+        assert all(keys[0] == ('TRUE_HUGO_SYMBOL', 1) for keys in genomic), genomic
+        for a in genomic:
+            for b in genomic:
+                assert a == b or b[:len(a)] != a
+
+        # clinical leaves only need sample ids and get covering indexes
+        assert any(keys[-1] == ('SAMPLE_ID', 1) and len(keys) > 1 for keys, _ in proposals['clinical'])
+
+        # creating the indexes leaves nothing to propose but the indexes that were capped
+        before = advisor.explain()
+        advisor.create(proposals)
+        after = advisor.explain()
+        assert len(before) == len(after)
+        assert 'genomic' not in advisor.propose()
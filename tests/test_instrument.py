@@ -0,0 +1,69 @@
+"""Copyright 2016 Dana-Farber Cancer Institute"""
+
+import os
+import json
+import tempfile
+import unittest
+
+from matchengine.instrument import Instrumentation
+
+
+class TestInstrumentation(unittest.TestCase):
+
+    def test_disabled(self):
+
+        stats = Instrumentation(enabled=False)
+        with stats.timer('sort'):
+            pass
+        stats.incr('trials')
+        stats.record_leaf('00-001', {'type': 'genomic', 'value': {}}, stats.start(), 10)
+
+        assert stats.start() is None
+        assert stats.stages == {}
+        assert stats.counters == {}
+        assert stats.leaves == []
+
+    def test_stages_and_counters(self):
+
+        stats = Instrumentation()
+        for _ in range(3):
+            with stats.timer('sort'):
+                pass
+        stats.incr('trials', 2)
+        stats.incr('trials')
+
+        assert stats.stages['sort']['calls'] == 3
+        assert stats.counters['trials'] == 3
+        assert 'sort' in stats.summary()
+
+    def test_top_n(self):
+
+        stats = Instrumentation(top_n=2)
+        for i, n_docs in enumerate([5, 50, 1, 20]):
+            node = {'type': 'genomic', 'value': {'hugo_symbol': 'GENE%d' % i}}
+            stats.record_leaf('00-00%d' % i, node, stats.start(), n_docs)
+            stats.record_trial('00-00%d' % i, stats.start(), n_docs)
+
+        report = stats.report()
+        assert len(report['slowest_leaves']) == 2
+        assert len(report['slowest_trials']) == 2
+        assert [l['documents'] for l in report['largest_leaves']] == [50, 20]
+        assert report['counters']['documents.genomic'] == 76
+        assert report['stages']['leaf.genomic']['calls'] == 4
+
+    def test_write(self):
+
+        stats = Instrumentation()
+        with stats.timer('write'):
+            pass
+
+        fd, path = tempfile.mkstemp(suffix='.json')
+        os.close(fd)
+        try:
+            stats.write(path)
+            with open(path) as f:
+                report = json.load(f)
+            assert 'write' in report['stages']
+            assert report['peak_rss_mb'] > 0
+        finally:
+            os.remove(path)
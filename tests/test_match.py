@@ -2,7 +2,15 @@
 
 import os
 import json
+import datetime as dt
+from pymongo.errors import ExecutionTimeout
 
+from matchengine.engine import MatchEngine
+from matchengine.instrument import Instrumentation
+from matchengine.runs import MatchRun
+from matchengine.shard import Coordinator, Worker
+from matchengine.summary import rebuild_summary
+from matchengine.utilities import update_ancestry
 from tests import TestSetUp
 
 YAML_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), 'data/yaml/'))
@@ -20,6 +28,7 @@ class TestMatch(TestSetUp):
         self.db.clinical.drop()
         self.db.genomic.drop()
         self.db.trial.drop()
+        self.db.genomic_summary.drop()
 
     def _match(self, match):
         g = self.me.create_match_tree(match)
@@ -82,6 +91,110 @@ class TestMatch(TestSetUp):
         matchengine = self._match(match)
         assert sorted(dbsearch) == sorted(matchengine)
 
+    def test_two_phase_match(self):
+
+        stats = Instrumentation()
+        me = MatchEngine(self.db, stats=stats)
+
+        # every EGFR sample is eliminated by the clinical clause, so no genomic detail is fetched
+        g = me.create_match_tree({'and': [
+            {'genomic': {'hugo_symbol': 'EGFR'}},
+            {'clinical': {'oncotree_primary_diagnosis': 'Adrenal Gland'}}
+        ]})
+        results, ginfo = me.traverse_match_tree(g)
+        assert results == set()
+        assert stats.counters.get('documents.hydrated', 0) == 0
+
+        # detail is fetched for the surviving samples only, from every leaf that matched them
+        g = me.create_match_tree({'and': [
+            {'genomic': {'hugo_symbol': 'EGFR', 'protein_change': 'p.L858R'}},
+            {'genomic': {'hugo_symbol': '!BRAF'}}
+        ]})
+        results, ginfo = me.traverse_match_tree(g)
+        assert results == set([self.sample_ids[1]])
+        assert stats.counters['documents.hydrated'] == 1
+        assert len(ginfo) == 1
+        assert sorted(info['genomic_alteration'] for info in ginfo[0]) == ['!BRAF', 'EGFR p.L858R']
+        assert [info['chromosome'] for info in ginfo[0] if 'chromosome' in info] == ['chr3']
+
+    def test_negative_match(self):
+
+        # negative leaves combined with each other and with positive leaves
+        match = {'or': [
+            {'and': [{'genomic': {'hugo_symbol': '!BRAF'}}, {'genomic': {'hugo_symbol': '!EGFR'}}]},
+            {'genomic': {'hugo_symbol': 'EGFR'}}
+        ]}
+        g1, _, _ = self.me.prepare_genomic_criteria({'hugo_symbol': 'BRAF'})
+        g2, _, _ = self.me.prepare_genomic_criteria({'hugo_symbol': 'EGFR'})
+        excluded = self._find('genomic', g1) | self._find('genomic', g2)
+        expected = (self.me.all_match - excluded) | self._find('genomic', g2)
+
+        g = self.me.create_match_tree(match)
+        results, ginfo = self.me.traverse_match_tree(g)
+        assert results == expected
+
+        # the shared alteration of a negative leaf is expanded for the matched samples only
+        negative = [info for infos in ginfo for info in infos if info['genomic_alteration'] == '!BRAF']
+        assert sorted(info['sample_id'] for info in negative) == sorted(self.me.all_match - excluded)
+
+    def test_partitioned_match(self):
+
+        fields = ['sample_id', 'protocol_no', 'internal_id', 'genomic_alteration', 'sort_order']
+        self.me.find_trial_matches()
+        expected = sorted(tuple(m.get(f) for f in fields) for m in self.db.trial_match.find())
+
+        # matching the cohort a few samples at a time publishes the same matches as a single run
+        self.me.find_partitioned_matches(3)
+        assert sorted(tuple(m.get(f) for f in fields) for m in self.db.trial_match.find()) == expected
+
+        # every leaf, negative ones included, only returns samples of the partition
+        sample_range = {'min': sorted(self.sample_ids)[3], 'max': sorted(self.sample_ids)[6]}
+        me = MatchEngine(self.db, sample_range=sample_range)
+        assert me.all_match == set(sorted(self.sample_ids)[3:6])
+        g1, _, _ = self.me.prepare_genomic_criteria({'hugo_symbol': 'BRAF'})
+        results, _ = me.traverse_match_tree(me.create_match_tree({'genomic': {'hugo_symbol': '!BRAF'}}))
+        assert results == me.all_match - self._find('genomic', g1)
+        results, _ = me.traverse_match_tree(me.create_match_tree({'genomic': {'hugo_symbol': 'BRAF'}}))
+        assert results == me.all_match & self._find('genomic', g1)
+
+        # and so do leaves answered from the genomic summary
+        rebuild_summary(self.db)
+        me = MatchEngine(self.db, sample_range=sample_range)
+        assert me.summary_is_current()
+        results, _ = me.traverse_match_tree(me.create_match_tree({'genomic': {'hugo_symbol': 'BRAF'}}))
+        assert results == me.all_match & self._find('genomic', g1)
+
+    def test_ancestry_match(self):
+
+        criteria = [
+            {'oncotree_primary_diagnosis': 'CNS/Brain'},
+            {'oncotree_primary_diagnosis': '!Glioblastoma'},
+            {'oncotree_primary_diagnosis': '_SOLID_'},
+            {'oncotree_primary_diagnosis': '!_SOLID_'},
+            {'oncotree_primary_diagnosis': '_LIQUID_'},
+            {'oncotree_primary_diagnosis': 'Not A Diagnosis'},
+            {'oncotree_primary_diagnosis': '!Not A Diagnosis'},
+            {'oncotree_primary_diagnosis': 'Melanoma', 'age_numerical': '>=18'}
+        ]
+        expected = [self._match({'clinical': dict(c)}) for c in criteria]
+
+        # diagnoses match on the ancestry stored on clinical documents as they match on the names below them
+        update_ancestry(self.db)
+        self.me = MatchEngine(self.db)
+        for c, samples in zip(criteria, expected):
+            leaf = self.me.compile_leaf({'type': 'clinical', 'value': dict(c)})
+            assert 'ONCOTREE_PRIMARY_DIAGNOSIS_NAME' not in self.me.leaf_query(leaf)[1]
+            assert self._match({'clinical': dict(c)}) == samples, c
+        assert expected[0] == set(self.db.clinical.find({'ONCOTREE_ANCESTORS': 'BRAIN'}).distinct('SAMPLE_ID'))
+
+    def test_age_as_of(self):
+
+        # ages are computed as of the date the engine was created with: in nine years the children are adults
+        me = MatchEngine(self.db, as_of=self.static_date + dt.timedelta(days=365 * 9))
+        results, _ = me.traverse_match_tree(me.create_match_tree({'clinical': {'age_numerical': '>=18'}}))
+        assert results == set(self.sample_ids[:9])
+        assert me.ages.cutoffs.keys() == ['>=18']
+
     def test_system_match(self):
         """
         Loops through all trials in the database, finds the matches at each dose, arm, and step level and
@@ -93,6 +206,184 @@ class TestMatch(TestSetUp):
         # checks that the entire process executes successfully
         self.me.find_trial_matches()
 
+    def test_incremental_match(self):
+
+        def _matches():
+            fields = ['sample_id', 'protocol_no', 'internal_id', 'genomic_alteration', 'sort_order']
+            return sorted(tuple(item.get(f) for f in fields) for item in self.db.trial_match.find())
+
+        self.me.find_trial_matches()
+        full = _matches()
+        assert full
+
+        # re-matching some trials or some samples leaves the same matches as a full run
+        MatchEngine(self.db).find_trial_matches(protocol_nos=['00-001'])
+        assert _matches() == full
+
+        MatchEngine(self.db, sample_ids=[self.sample_ids[1]]).find_trial_matches()
+        assert _matches() == full
+
+        # matches of removed trials are removed
+        self.db.trial.delete_many({'protocol_no': '00-001'})
+        MatchEngine(self.db).find_trial_matches(protocol_nos=['00-001'])
+        assert self.db.trial_match.count({'protocol_no': '00-001'}) == 0
+
+    def test_resume_run(self):
+
+        fields = ['sample_id', 'protocol_no', 'internal_id', 'genomic_alteration', 'sort_order']
+        self.me.find_trial_matches()
+        expected = sorted(tuple(m.get(f) for f in fields) for m in self.db.trial_match.find())
+        self.db.trial_match.drop()
+
+        # a run that died after matching its first trial
+        run = MatchRun(self.db)
+        trial = self.db.trial.find_one({'protocol_no': '00-001'})
+        mrn_map = dict(zip(self.sample_ids, self.mrns))
+        run.stage('00-001', self.me.match_trial(trial, mrn_map, []))
+
+        # resuming reuses the staged matches and publishes the same matches as a single run
+        resumed = MatchRun(self.db, run_id=run.run_id)
+        MatchEngine(self.db).find_trial_matches(run=resumed)
+        assert sorted(tuple(m.get(f) for f in fields) for m in self.db.trial_match.find()) == expected
+        assert resumed.completed == set(self.db.trial.distinct('protocol_no'))
+        assert self.db.trial_match_staging.count() == 0
+
+    def test_deferred_trials(self):
+
+        fields = ['sample_id', 'protocol_no', 'internal_id', 'genomic_alteration']
+        self.me.find_trial_matches()
+        expected = sorted(tuple(m.get(f) for f in fields) for m in self.db.trial_match.find())
+
+        class SlowEngine(MatchEngine):
+            """Engine whose queries for trial 00-001 run over any time limit below 100ms"""
+
+            def limit(self, cursor):
+                if self.current_protocol_no == '00-001' and self.max_time_ms < 100:
+                    raise ExecutionTimeout('operation exceeded time limit', 50)
+                return super(SlowEngine, self).limit(cursor)
+
+        # the retry pass matches the deferred trial with a larger time limit
+        me = SlowEngine(self.db, max_time_ms=50)
+        me.find_trial_matches()
+        assert me.deferred == {}
+        assert sorted(tuple(m.get(f) for f in fields) for m in self.db.trial_match.find()) == expected
+
+        # without a retry pass the other trials are matched and the deferred trial is reported
+        run = MatchRun(self.db)
+        me = SlowEngine(self.db, max_time_ms=50, retry_factor=0)
+        me.find_trial_matches(run=run)
+        assert me.deferred.keys() == ['00-001']
+        assert [d['protocol_no'] for d in run.manifest['deferred']] == ['00-001']
+        assert '00-001' not in run.completed
+
+        # and keeps its matches of the last run
+        assert sorted(tuple(m.get(f) for f in fields) for m in self.db.trial_match.find()) == expected
+
+        # a deferred trial that had no matches still gets none
+        self.db.trial_match.delete_many({'protocol_no': '00-001'})
+        SlowEngine(self.db, max_time_ms=50, retry_factor=0).find_trial_matches()
+        assert sorted(tuple(m.get(f) for f in fields) for m in self.db.trial_match.find()) == \
+            [m for m in expected if m[1] != '00-001']
+
+        # a trial over its budget keeps its matches in a run restricted to it
+        self.me.find_trial_matches()
+        me = MatchEngine(self.db, trial_budget=1e-9, retry_factor=0)
+        me.find_trial_matches(protocol_nos=['00-001'])
+        assert me.deferred.keys() == ['00-001']
+        assert sorted(tuple(m.get(f) for f in fields) for m in self.db.trial_match.find()) == expected
+
+        # and in runs restricted to some samples
+        me = SlowEngine(self.db, sample_ids=self.sample_ids[:5], max_time_ms=50, retry_factor=0)
+        me.find_trial_matches()
+        assert me.deferred.keys() == ['00-001']
+        assert sorted(tuple(m.get(f) for f in fields) for m in self.db.trial_match.find()) == expected
+
+        # partitioned runs report the trials deferred in any partition
+        me = SlowEngine(self.db, max_time_ms=50, retry_factor=0)
+        me.find_partitioned_matches(3)
+        assert me.deferred.keys() == ['00-001']
+        assert sorted(tuple(m.get(f) for f in fields) for m in self.db.trial_match.find()) == expected
+
+    def test_sharded_run(self):
+
+        fields = ['sample_id', 'protocol_no', 'internal_id', 'genomic_alteration', 'sort_order']
+        self.me.find_trial_matches()
+        expected = sorted(tuple(m.get(f) for f in fields) for m in self.db.trial_match.find())
+
+        # sharding by trial or by sample range publishes the same matches as a single run
+        for by in ['trial', 'sample']:
+            self.db.trial_match.drop()
+            coordinator = Coordinator(self.db, by=by, n_shards=3)
+            coordinator.enqueue()
+            coordinator.wait(poll=0, worker=Worker(self.db))
+            assert coordinator.progress() == {'done': 3}
+
+            coordinator.publish()
+            assert sorted(tuple(m.get(f) for f in fields) for m in self.db.trial_match.find()) == expected
+            assert self.db.trial_match_staging.count() == 0
+            assert self.db.match_queue.count() == 0
+
+    def test_simulate_trial(self):
+
+        # nothing is written while simulating
+        self.db.trial.drop()
+        draft = self._read_file(os.path.join(YAML_DIR, '00-001.yml'))
+        result = self.me.simulate_trial(draft)
+        assert not result['errors']
+        assert result['protocol_no'] == '00-001'
+        assert len(result['segments']) == 1
+        assert self.db.trial.count() == 0
+        assert self.db.trial_match.count() == 0
+        assert self.db.trial_cache.count() == 0
+
+        # every segment matches the samples a match run finds
+        self.add_trials(trials=['00-001'])
+        self.me.find_trial_matches()
+        for segment in result['segments']:
+            query = {'match_level': segment['match_level'], 'internal_id': segment['internal_id']}
+            assert set(segment['sample_ids']) == set(self.db.trial_match.find(query).distinct('sample_id'))
+            assert segment['n_samples'] == len(segment['sample_ids'])
+        assert result['n_samples'] > 0
+
+    def test_simulate_invalid_trial(self):
+
+        # drafts that are not yaml, or that fail schema validation, are reported, not matched
+        self.db.trial.drop()
+        result = self.me.simulate_trial(self._read_file(os.path.join(YAML_DIR, '00-000.yml')))
+        assert result['protocol_no'] is None
+        assert result['errors']
+        assert result['segments'] == []
+
+        result = self.me.simulate_trial(self._read_file(os.path.join(YAML_DIR, '00-005.yml')))
+        assert result['protocol_no'] == '00-005'
+        assert 'site_list' in result['errors']
+        assert result['segments'] == []
+        assert 'n_samples' not in result
+        assert self.db.trial_match.count() == 0
+
+    def test_count_trial_matches(self):
+
+        counts = self.me.count_trial_matches()
+        assert self.db.trial_match.count() == 0
+        assert self.db.trial_match_counts.count() == len(counts)
+
+        # the same samples and patients as a match run
+        self.me.find_trial_matches()
+        for item in counts:
+            query = {'protocol_no': item['protocol_no'], 'match_level': item['match_level'],
+                     'internal_id': item['internal_id']}
+            assert item['n_samples'] == len(self.db.trial_match.find(query).distinct('sample_id'))
+            assert item['n_patients'] == len(self.db.trial_match.find(query).distinct('mrn'))
+            for gene in item['genes']:
+                assert gene['n_samples'] <= item['n_samples']
+        assert any(gene['gene'] == 'EGFR' for item in counts for gene in item['genes'])
+
+        # genes are read from the conditions the criteria compile to
+        assert MatchEngine._leaf_gene({'$eq': 'EGFR'}) == 'EGFR'
+        assert MatchEngine._leaf_gene({'$in': ['BRAF']}) == 'BRAF'
+        assert MatchEngine._leaf_gene({'$in': ['BRAF', 'EGFR']}) is None
+        assert MatchEngine._leaf_gene(None) is None
+
     def test_assess_match(self):
 
         p = self.mrns[1]
@@ -144,6 +435,35 @@ class TestMatch(TestSetUp):
         assert list(set(trials)) == ['00-005'], self._debug(trials)
         assert list(set(doses)) == ['5', '6'], self._debug(doses)
 
+    def test_trial_context(self):
+
+        trial = {
+            'protocol_no': '00-000',
+            '_summary': {
+                'status': [{'value': 'Closed to Accrual'}],
+                'tumor_types': ['_SOLID_'],
+                'coordinating_center': 'DFCI'
+            }
+        }
+        context = self.me.trial_context(trial)
+        assert context == {
+            'protocol_no': '00-000',
+            'trial_accrual_status': 'closed',
+            'cancer_type_match': 'all_solid',
+            'coordinating_center': 'DFCI'
+        }
+        assert self.me.trial_context({'protocol_no': '00-000'})['trial_accrual_status'] == 'open'
+
+        # suspended segments are closed regardless of the trial status
+        context = self.me.trial_context({'protocol_no': '00-000'})
+        arm = {'arm_internal_id': 7, 'arm_code': 'A', 'arm_suspended': 'Y'}
+        fields = self.me.segment_context(context, arm, 'arm')
+        assert fields['internal_id'] == '7'
+        assert fields['code'] == 'A'
+        assert fields['match_level'] == 'arm'
+        assert fields['trial_accrual_status'] == 'closed'
+        assert context['trial_accrual_status'] == 'open'
+
     @staticmethod
     def _read_file(file):
         fh = open(file, 'r')
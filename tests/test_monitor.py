@@ -0,0 +1,109 @@
+"""Copyright 2016 Dana-Farber Cancer Institute"""
+
+import json
+import unittest
+
+from matchengine import monitor as mon
+from matchengine.monitor import CommandMonitor, query_shape, percentile
+
+
+class Event(object):
+    """Stands in for the events pymongo hands to command listeners"""
+
+    def __init__(self, request_id, command_name, command=None, reply=None, duration_micros=0):
+        self.request_id = request_id
+        self.command_name = command_name
+        self.command = command
+        self.reply = reply
+        self.duration_micros = duration_micros
+
+
+class TestMonitor(unittest.TestCase):
+
+    def test_query_shape(self):
+
+        q1 = {'$and': [{'TRUE_HUGO_SYMBOL': {'$eq': 'EGFR'}}, {'$or': [{'WILDTYPE': False}]}]}
+        q2 = {'$and': [{'TRUE_HUGO_SYMBOL': {'$eq': 'BRAF'}}, {'$or': [{'WILDTYPE': True}]}]}
+        assert query_shape(q1) == query_shape(q2)
+        assert json.loads(query_shape(q1)) == {'$and': [{'TRUE_HUGO_SYMBOL': {'$eq': '?'}},
+                                                         {'$or': [{'WILDTYPE': '?'}]}]}
+
+        q3 = {'SAMPLE_ID': {'$in': ['1', '2', '3']}}
+        assert json.loads(query_shape(q3)) == {'SAMPLE_ID': {'$in': '?'}}
+        assert query_shape(None) == '{}'
+
+    def test_percentile(self):
+        values = range(1, 101)
+        assert percentile(values, 50) in [50, 51]
+        assert percentile(values, 99) == 99
+        assert percentile([], 50) == 0.0
+
+    def test_aggregate(self):
+
+        monitor = CommandMonitor()
+
+        # a find with a second batch
+        monitor.started(Event(1, 'find', {'find': 'genomic', 'filter': {'TRUE_HUGO_SYMBOL': {'$eq': 'EGFR'}}}))
+        monitor.succeeded(Event(1, 'find', reply={'cursor': {'id': 42, 'firstBatch': [{}, {}]}}, duration_micros=2000))
+        monitor.started(Event(2, 'getMore', {'getMore': 42, 'collection': 'genomic'}))
+        monitor.succeeded(Event(2, 'getMore', reply={'cursor': {'id': 0, 'nextBatch': [{}]}}, duration_micros=1000))
+
+        # a distinct
+        monitor.started(Event(3, 'distinct', {'distinct': 'clinical', 'key': 'SAMPLE_ID', 'query': {}}))
+        monitor.succeeded(Event(3, 'distinct', reply={'values': ['1', '2', '3']}, duration_micros=500))
+
+        # a failure
+        monitor.started(Event(4, 'find', {'find': 'clinical', 'filter': {}}))
+        monitor.failed(Event(4, 'find', duration_micros=100))
+
+        # commands outside of collections are ignored
+        monitor.started(Event(5, 'ismaster', {'ismaster': 1}))
+        monitor.succeeded(Event(5, 'ismaster', reply={'ok': 1}))
+
+        report = monitor.report()
+        ops = dict(((op['collection'], op['operation']), op) for op in report['operations'])
+        assert sorted(ops.keys()) == [('clinical', 'distinct'), ('clinical', 'find'), ('genomic', 'find'),
+                                      ('genomic', 'getMore')]
+        assert ops[('genomic', 'find')]['documents'] == 2
+        assert ops[('genomic', 'getMore')]['documents'] == 1
+        assert ops[('clinical', 'distinct')]['documents'] == 3
+        assert ops[('clinical', 'find')]['failures'] == 1
+
+        # the getMore is attributed to the shape of the find that opened the cursor
+        slowest = report['slowest_shapes'][0]
+        assert slowest['collection'] == 'genomic'
+        assert slowest['count'] == 2
+        assert slowest['documents'] == 3
+        assert monitor.cursors == {}
+
+    def test_bounds(self):
+
+        limits = mon.MAX_LATENCIES, mon.MAX_SHAPES, mon.MAX_CURSORS
+        mon.MAX_LATENCIES, mon.MAX_SHAPES, mon.MAX_CURSORS = 10, 3, 2
+        try:
+            monitor = CommandMonitor()
+
+            # finds of many shapes that each leave a cursor open
+            for i in range(50):
+                monitor.started(Event(i, 'find', {'find': 'genomic', 'filter': {'F%d' % i: 1}}))
+                monitor.succeeded(Event(i, 'find', reply={'cursor': {'id': 100 + i, 'firstBatch': [{}]}},
+                                        duration_micros=1000 * (i + 1)))
+
+            # the counters are exact, the percentiles come from a sample
+            op = monitor.report()['operations'][0]
+            assert op['count'] == 50
+            assert op['documents'] == 50
+            assert op['max_ms'] == 50.0
+            assert op['total_ms'] == sum(range(1, 51))
+            assert len(monitor.operations[('genomic', 'find')]['latencies']) == 10
+
+            # shapes beyond the limit are grouped, and only the most recent cursors are remembered
+            assert len(monitor.shapes) == 4
+            assert monitor.shapes[('genomic', 'find', mon.OTHER_SHAPE)]['count'] == 47
+            assert list(monitor.cursors) == [148, 149]
+
+            # cursors closed before they were exhausted are forgotten
+            monitor.started(Event(50, 'killCursors', {'killCursors': 'genomic', 'cursors': [148]}))
+            assert list(monitor.cursors) == [149]
+        finally:
+            mon.MAX_LATENCIES, mon.MAX_SHAPES, mon.MAX_CURSORS = limits
@@ -0,0 +1,84 @@
+"""Copyright 2016 Dana-Farber Cancer Institute"""
+
+import unittest
+import datetime as dt
+
+from matchengine.storage import MemoryDatabase
+from matchengine.runs import MatchRun, unfinished_runs, expire_runs, RUN_COLLECTION, STAGING_COLLECTION, \
+    QUEUE_COLLECTION
+
+
+class TestRuns(unittest.TestCase):
+
+    def setUp(self):
+        self.db = MemoryDatabase()
+        self.matches = [
+            {'sample_id': 'S1', 'protocol_no': '00-001', 'internal_id': '1'},
+            {'sample_id': 'S2', 'protocol_no': '00-001', 'internal_id': '1'}
+        ]
+
+    def test_stage(self):
+
+        run = MatchRun(self.db)
+        run.stage('00-001', self.matches)
+        run.stage('00-002', [])
+        assert run.completed == set(['00-001', '00-002'])
+        assert self.matches[0] == {'sample_id': 'S1', 'protocol_no': '00-001', 'internal_id': '1'}
+
+        # staging a trial again replaces its matches
+        run.stage('00-001', self.matches[:1])
+        assert run.staged() == self.matches[:1]
+        assert [m['_id'] for m in unfinished_runs(self.db)] == [run.run_id]
+
+    def test_deferred(self):
+
+        run = MatchRun(self.db)
+        run.set_deferred({'00-002': 'over its budget of 60s', '00-001': 'a leaf query ran over its time limit'})
+        manifest = self.db[RUN_COLLECTION].find_one({'_id': run.run_id})
+        assert [d['protocol_no'] for d in manifest['deferred']] == ['00-001', '00-002']
+        assert manifest['deferred'][1]['reason'] == 'over its budget of 60s'
+
+    def test_resume(self):
+
+        run = MatchRun(self.db)
+        run.stage('00-001', self.matches)
+
+        # a new process picks up where the run stopped
+        resumed = MatchRun(self.db, run_id=run.run_id)
+        assert resumed.completed == set(['00-001'])
+        assert sorted(resumed.staged()) == sorted(self.matches)
+
+        resumed.finish()
+        assert self.db[RUN_COLLECTION].find_one({'_id': run.run_id})['status'] == 'done'
+        assert self.db[STAGING_COLLECTION].count() == 0
+        assert unfinished_runs(self.db) == []
+
+        # finished and unknown runs cannot be resumed
+        with self.assertRaises(ValueError):
+            MatchRun(self.db, run_id=run.run_id)
+        with self.assertRaises(ValueError):
+            MatchRun(self.db, run_id='unknown')
+
+    def test_expire(self):
+
+        old = MatchRun(self.db)
+        old.stage('00-001', self.matches)
+        old.stage_shard(0, self.matches)
+        self.db[QUEUE_COLLECTION].insert_one({'run_id': old.run_id, 'shard': 0, 'status': 'pending'})
+        self.db[RUN_COLLECTION].update_one({'_id': old.run_id}, {'$set': {
+            'started': dt.datetime.utcnow() - dt.timedelta(days=30)}})
+
+        recent = MatchRun(self.db)
+        recent.stage('00-001', self.matches)
+
+        # only the staged matches and queued shards of the abandoned run are removed
+        assert expire_runs(self.db) == [old.run_id]
+        assert self.db[STAGING_COLLECTION].find({'run_id': old.run_id}).count() == 0
+        assert self.db[QUEUE_COLLECTION].count() == 0
+        assert sorted(recent.staged()) == sorted(self.matches)
+        assert [m['_id'] for m in unfinished_runs(self.db)] == [recent.run_id]
+        assert expire_runs(self.db) == []
+
+        # expired runs cannot be resumed
+        with self.assertRaises(ValueError):
+            MatchRun(self.db, run_id=old.run_id)
@@ -0,0 +1,64 @@
+"""Copyright 2016 Dana-Farber Cancer Institute"""
+
+import itertools
+import unittest
+
+from matchengine.samples import Complement, intersect, materialize, union, in_range, range_slice, sample_range_query
+
+
+class TestSamples(unittest.TestCase):
+
+    def setUp(self):
+        self.universe = set(['S1', 'S2', 'S3', 'S4', 'S5'])
+
+        # plain sets, including a sample outside the cohort, and negative leaves
+        self.operands = [
+            set(),
+            set(['S1', 'S2']),
+            set(['S2', 'S6']),
+            Complement(self.universe, set()),
+            Complement(self.universe, set(['S2', 'S3'])),
+            Complement(self.universe, set(['S3', 'S7']), set(['S8']))
+        ]
+
+    def test_complement(self):
+
+        c = Complement(self.universe, set(['S2', 'S7']), set(['S8']))
+        assert c.materialize() == set(['S1', 'S3', 'S4', 'S5', 'S8'])
+        assert 'S1' in c
+        assert 'S8' in c
+        assert 'S2' not in c
+        assert 'S6' not in c
+        assert len(c) == 5
+        assert materialize(set(['S1'])) == set(['S1'])
+
+    def test_algebra(self):
+
+        # every combination agrees with the same operation on materialized sets
+        for a, b in itertools.product(self.operands, repeat=2):
+            assert materialize(intersect(a, b)) == materialize(a) & materialize(b)
+            assert materialize(union(a, b)) == materialize(a) | materialize(b)
+
+    def test_negative_stays_compact(self):
+
+        a = Complement(self.universe, set(['S1']))
+        b = Complement(self.universe, set(['S2']))
+        assert isinstance(intersect(a, b), Complement)
+        assert intersect(a, b).excluded == set(['S1', 'S2'])
+        assert isinstance(union(set(['S1']), a), Complement)
+        assert union(set(['S1']), a).excluded == set()
+        assert intersect(set(['S1', 'S2']), a) == set(['S2'])
+
+    def test_sample_range(self):
+
+        assert sample_range_query({'min': 'S2', 'max': 'S4'}) == {'SAMPLE_ID': {'$gte': 'S2', '$lt': 'S4'}}
+        assert sample_range_query({'min': None, 'max': 'S4'}) == {'SAMPLE_ID': {'$lt': 'S4'}}
+        assert sample_range_query({'min': None, 'max': None}) == {}
+
+        # ranges are half open
+        assert [s for s in sorted(self.universe) if in_range(s, {'min': 'S2', 'max': 'S4'})] == ['S2', 'S3']
+        assert all(in_range(s, {'min': None, 'max': None}) for s in self.universe)
+
+        # a sorted list is sliced to the same samples
+        assert range_slice(sorted(self.universe), {'min': 'S2', 'max': 'S4'}) == ['S2', 'S3']
+        assert range_slice(sorted(self.universe), None) == sorted(self.universe)
@@ -0,0 +1,101 @@
+"""Copyright 2016 Dana-Farber Cancer Institute"""
+
+import unittest
+import datetime as dt
+
+from matchengine.storage import MemoryDatabase
+from matchengine.scheduler import Changes, ChangeWatcher, MatchScheduler
+
+
+class TestScheduler(unittest.TestCase):
+
+    def setUp(self):
+        self.db = MemoryDatabase()
+        self.db.trial.insert_one({'protocol_no': '00-001', 'treatment_list': {'step': []}})
+        self.db.trial.insert_one({'protocol_no': '00-002', 'treatment_list': {'step': []}})
+        self.db.clinical.insert_one({'SAMPLE_ID': 'S1', 'MRN': 'M1'})
+        self.db.genomic.insert_one({'SAMPLE_ID': 'S1', 'TRUE_HUGO_SYMBOL': 'EGFR'})
+
+        self.now = 0
+        self.runs = []
+
+    def _run(self, protocol_nos=None, sample_ids=None):
+        self.runs.append((protocol_nos, sample_ids))
+
+    def _scheduler(self, **kwargs):
+        return MatchScheduler(ChangeWatcher(self.db), self._run, clock=lambda: self.now, **kwargs)
+
+    def test_watcher(self):
+
+        watcher = ChangeWatcher(self.db)
+        assert not watcher.poll()
+
+        # edited and removed trials, new clinical and genomic documents
+        self.db.trial.update_one({'protocol_no': '00-001'}, {'$set': {'treatment_list': {'step': [{}]},
+                                                                     '_updated': dt.datetime(2017, 1, 1)}})
+        self.db.trial.delete_one({'protocol_no': '00-002'})
+        self.db.clinical.insert_one({'SAMPLE_ID': 'S2', 'MRN': 'M2'})
+        self.db.genomic.insert_one({'SAMPLE_ID': 'S1', 'TRUE_HUGO_SYMBOL': 'BRAF'})
+
+        changes = watcher.poll()
+        assert changes.trials == set(['00-001', '00-002'])
+        assert changes.samples == set(['S1', 'S2'])
+        assert not changes.full
+        assert not watcher.poll()
+
+        # trials are compared by their _id and edit time only, so a re-inserted trial is seen
+        trial = self.db.trial.find_one({'protocol_no': '00-001'}, {'_id': 0})
+        self.db.trial.delete_one({'protocol_no': '00-001'})
+        self.db.trial.insert_one(trial)
+        assert watcher.poll().trials == set(['00-001'])
+
+        # and an edit that does not set the edit time is not
+        self.db.trial.update_one({'protocol_no': '00-001'}, {'$set': {'treatment_list': {'step': []}}})
+        assert not watcher.poll()
+
+        # removed patient documents cannot be traced back to a sample
+        self.db.genomic.delete_many({'SAMPLE_ID': 'S1'})
+        assert watcher.poll().full
+
+    def test_debounce(self):
+
+        scheduler = self._scheduler(debounce=60, max_staleness=900, quiet_hours=None)
+        assert scheduler.step() is None
+
+        # matched once no change arrived for the debounce period
+        self.db.clinical.insert_one({'SAMPLE_ID': 'S2', 'MRN': 'M2'})
+        assert scheduler.step() is None
+        self.now = 30
+        self.db.clinical.insert_one({'SAMPLE_ID': 'S3', 'MRN': 'M3'})
+        assert scheduler.step() is None
+        self.now = 89
+        assert scheduler.step() is None
+        self.now = 90
+        assert scheduler.step() == 'incremental'
+        assert self.runs == [(None, ['S2', 'S3'])]
+
+    def test_max_staleness(self):
+
+        scheduler = self._scheduler(debounce=60, max_staleness=100, quiet_hours=None)
+
+        # a steady stream of changes is matched once the oldest is as old as the maximum staleness
+        for i in range(5):
+            self.now = i * 30
+            self.db.trial.insert_one({'protocol_no': '01-%03d' % i, 'treatment_list': {'step': []}})
+            scheduler.step()
+        assert self.runs == [(['01-000', '01-001', '01-002', '01-003', '01-004'], None)]
+
+    def test_quiet_hours(self):
+
+        night = dt.datetime(2018, 6, 7, 3)
+        self.now = (night - dt.datetime.fromtimestamp(0)).total_seconds()
+        scheduler = self._scheduler(quiet_hours=(2, 5))
+
+        # one full run per night
+        assert scheduler.step() == 'full'
+        assert scheduler.step() is None
+        assert self.runs == [(None, None)]
+
+        # and whenever changes cannot be matched incrementally
+        scheduler.pending = Changes(full=True)
+        assert scheduler.step() == 'full'
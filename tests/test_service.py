@@ -0,0 +1,129 @@
+"""Copyright 2016 Dana-Farber Cancer Institute"""
+
+import os
+import json
+import yaml
+import urllib2
+import threading
+import datetime as dt
+
+from matchengine.service import MatchService, MatchError, make_server
+from tests import TestSetUp, YAML_DIR
+
+
+class TestService(TestSetUp):
+
+    def setUp(self):
+        super(TestService, self).setUp()
+        self.add_clinical()
+        self.add_genomic()
+        self.add_trials(trials=['00-001', '00-002'])
+
+        self.me.find_trial_matches()
+        self.service = MatchService(self.db)
+
+    def tearDown(self):
+        self.db.clinical.drop()
+        self.db.genomic.drop()
+        self.db.trial.drop()
+        self.db.trial_match.drop()
+
+    @staticmethod
+    def _keys(matches):
+        return sorted((m['sample_id'], m['protocol_no'], m['internal_id'], m['genomic_alteration']) for m in matches)
+
+    def test_match_sample(self):
+
+        # a single sample gets the matches of a full run
+        sample_id = self.sample_ids[1]
+        expected = list(self.db.trial_match.find({'sample_id': sample_id}))
+        matches = self.service.match_sample(sample_id)
+        assert matches
+        assert self._keys(matches) == self._keys(expected)
+        assert self.service.me.all_match == self.service.me.cohort
+
+        with self.assertRaises(MatchError):
+            self.service.match_sample('UNKNOWN')
+
+        # ages are computed as of the request, not as of the day the service started
+        self.service.me.ages.as_of = dt.datetime(2000, 1, 1)
+        self.service.me.ages.condition('>=18')
+        self.service.match_sample(sample_id)
+        assert self.service.me.ages.as_of.year > 2000
+        assert all(d.year > 1982 for c in self.service.me.ages.cutoffs.values() for d in c.values())
+
+    def test_match_trial(self):
+
+        # a draft is matched without being stored, like the stored trial it copies
+        with open(os.path.join(YAML_DIR, '00-001.yml')) as f:
+            draft = yaml.load(f.read())
+        draft['protocol_no'] = '99-999'
+        draft['protocol_id'] = 99999
+        expected = list(self.db.trial_match.find({'protocol_no': '00-001'}))
+        n = self.db.trial_match.count()
+
+        matches = self.service.match_trial(draft)
+        assert matches
+        assert set(m['protocol_no'] for m in matches) == set(['99-999'])
+        assert self._keys(matches) == [k[:1] + ('99-999',) + k[2:] for k in self._keys(expected)]
+        assert self.db.trial_match.count() == n
+
+        # an invalid draft is rejected
+        del draft['short_title']
+        with self.assertRaises(MatchError) as cm:
+            self.service.match_trial(draft)
+        assert cm.exception.status == 400
+
+    def test_rematch(self):
+
+        n = self.db.trial_match.count({'protocol_no': '00-001'})
+        assert self.service.rematch('00-001') == n
+        assert self.db.trial_match.count({'protocol_no': '00-001'}) == n
+
+        self.db.trial.delete_many({'protocol_no': '00-001'})
+        assert self.service.rematch('00-001') == 0
+        assert self.db.trial_match.count({'protocol_no': '00-001'}) == 0
+        assert '00-001' not in self.service.trials
+
+    def _request(self, path, body=None):
+        try:
+            response = urllib2.urlopen('http://127.0.0.1:%d%s' % (self.port, path),
+                                       json.dumps(body) if body is not None else None)
+        except urllib2.HTTPError as e:
+            response = e
+        return response.getcode(), json.loads(response.read())
+
+    def test_handler(self):
+
+        server = make_server(self.service, port=0)
+        self.port = server.server_address[1]
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        try:
+            status, result = self._request('/health')
+            assert status == 200
+            assert result['samples'] == len(self.service.me.cohort)
+            assert result['trials'] == 2
+
+            sample_id = self.sample_ids[1]
+            status, result = self._request('/match/sample', {'sample_id': sample_id})
+            assert status == 200
+            assert self._keys(result['matches']) == self._keys(self.service.match_sample(sample_id))
+
+            # requests the service cannot answer get their status and an error
+            assert self._request('/match/sample', {})[0] == 400
+            assert self._request('/match/sample', {'sample_id': 'UNKNOWN'})[0] == 404
+            assert self._request('/unknown')[0] == 404
+
+            # unexpected errors are answered too, and the server keeps serving
+            def fail(*args):
+                raise KeyError('boom')
+            self.service.matches = fail
+            status, result = self._request('/matches')
+            assert status == 500
+            assert 'KeyError' in result['error']
+            assert self._request('/health')[0] == 200
+        finally:
+            server.shutdown()
+            server.server_close()
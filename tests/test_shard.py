@@ -0,0 +1,102 @@
+"""Copyright 2016 Dana-Farber Cancer Institute"""
+
+import unittest
+import datetime as dt
+
+from matchengine.storage import MemoryDatabase
+from matchengine.samples import sample_range_query
+from matchengine.shard import Coordinator, Worker, LeaseLost, plan_shards, QUEUE_COLLECTION
+
+
+class TestShard(unittest.TestCase):
+
+    def setUp(self):
+        self.db = MemoryDatabase()
+        self.db.trial.insert_many([{'protocol_no': '00-00%d' % i, 'treatment_list': {'step': []}} for i in range(5)])
+        self.db.clinical.insert_many([{'SAMPLE_ID': 'S%d' % i} for i in range(5)])
+
+    def test_plan_shards(self):
+
+        assert plan_shards(self.db, 'trial', 2) == [
+            {'protocol_nos': ['00-000', '00-001', '00-002']},
+            {'protocol_nos': ['00-003', '00-004']}
+        ]
+
+        # sample ranges are half open and unbounded at both ends
+        shards = plan_shards(self.db, 'sample', 2)
+        assert shards == [{'min': None, 'max': 'S3'}, {'min': 'S3', 'max': None}]
+        assert sample_range_query(shards[0]) == {'SAMPLE_ID': {'$lt': 'S3'}}
+        assert sample_range_query({'min': None, 'max': None}) == {}
+
+        covered = []
+        for shard in shards:
+            covered += self.db.clinical.find(sample_range_query(shard)).distinct('SAMPLE_ID')
+        assert sorted(covered) == sorted(self.db.clinical.distinct('SAMPLE_ID'))
+
+        with self.assertRaises(ValueError):
+            plan_shards(self.db, 'gene', 2)
+
+    def test_claim(self):
+
+        coordinator = Coordinator(self.db, n_shards=2)
+        coordinator.enqueue()
+        coordinator.enqueue()
+        assert coordinator.progress() == {'pending': 2}
+
+        # every shard is claimed once
+        worker = Worker(self.db, worker_id='a')
+        first = worker.claim()
+        second = Worker(self.db, worker_id='b').claim()
+        assert (first['shard'], first['worker'], first['attempts']) == (0, 'a', 1)
+        assert second['shard'] == 1
+        assert worker.claim() is None
+
+        # shards of workers that stopped renewing their lease are claimed again
+        self.db[QUEUE_COLLECTION].update_one({'_id': first['_id']}, {'$set': {
+            'lease_until': dt.datetime.utcnow() - dt.timedelta(seconds=1)}})
+        coordinator.requeue_expired()
+        assert coordinator.progress() == {'pending': 1, 'running': 1}
+        assert worker.claim()['attempts'] == 2
+
+    def test_fail(self):
+
+        coordinator = Coordinator(self.db, n_shards=1)
+        coordinator.enqueue()
+        worker = Worker(self.db)
+
+        # failed shards are retried, and fail the run after the last attempt
+        for _ in range(2):
+            worker.fail(worker.claim(), 'error')
+            assert coordinator.progress() == {'pending': 1}
+        worker.fail(worker.claim(), 'error')
+        assert coordinator.progress() == {'failed': 1}
+
+        with self.assertRaises(RuntimeError):
+            coordinator.wait(poll=0)
+
+    def test_lease_lost(self):
+
+        coordinator = Coordinator(self.db, n_shards=1)
+        coordinator.enqueue()
+        stale = Worker(self.db, worker_id='a')
+        first = stale.claim()
+
+        # the lease expires and another worker claims the shard
+        self.db[QUEUE_COLLECTION].update_one({'_id': first['_id']}, {'$set': {
+            'lease_until': dt.datetime.utcnow() - dt.timedelta(seconds=1)}})
+        coordinator.requeue_expired()
+        second = Worker(self.db, worker_id='b').claim()
+
+        # the stale worker neither stages its matches nor changes the state of the new claim
+        with self.assertRaises(LeaseLost):
+            stale.process(first)
+        stale.fail(first, 'error')
+        assert coordinator.run.staged() == []
+        assert coordinator.run.completed == set()
+        assert self.db[QUEUE_COLLECTION].find_one({'_id': second['_id']})['worker'] == 'b'
+        assert coordinator.progress() == {'running': 1}
+
+        # the same worker claiming the shard again holds a new lease
+        self.db[QUEUE_COLLECTION].update_one({'_id': first['_id']}, {'$set': {'worker': 'a'}})
+        with self.assertRaises(LeaseLost):
+            stale.process(first)
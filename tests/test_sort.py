@@ -171,6 +171,14 @@ class TestSort(TestSetUp):
         assert sort_order[('01', '15-111')] == [7, 0, 0, 0, 1]
         assert sort_order[('01', '22-222')] == [7, 1, 0, 0, 0]
 
+        # protocol numbers of the same year are ordered the same whatever the order of the matches
+        matches = [{'protocol_no': '00-001', 'sample_id': '01'}, {'protocol_no': '00-003', 'sample_id': '01'}]
+        for ordered in [matches, matches[::-1]]:
+            sort_order = sort_by_reverse_protocol_no(ordered, {('01', '00-001'): [0, 0, 0, 0],
+                                                               ('01', '00-003'): [0, 0, 0, 0]})
+            assert sort_order[('01', '00-003')] == [0, 0, 0, 0, 0]
+            assert sort_order[('01', '00-001')] == [0, 0, 0, 0, 1]
+
     def test_final_sort(self):
 
         mso = {}
@@ -0,0 +1,36 @@
+"""Copyright 2016 Dana-Farber Cancer Institute"""
+
+import os
+import sys
+import json
+import unittest
+import subprocess
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+HEAVY_MODULES = ['pandas', 'networkx', 'yaml', 'oncotreenx', 'cerberus1', 'pymongo', 'matchengine.engine']
+
+# prints which heavy modules are loaded after the statement runs
+CHECK = "%s; import sys, json; print json.dumps([m for m in " + json.dumps(HEAVY_MODULES) + " if m in sys.modules])"
+
+
+class TestStartup(unittest.TestCase):
+
+    def _loaded(self, statement):
+        output = subprocess.check_output([sys.executable, '-c', CHECK % statement], cwd=ROOT)
+        return json.loads(output.strip().splitlines()[-1])
+
+    def test_cli_imports(self):
+
+        # the command line module loads the heavy modules in the subcommands that use them
+        assert self._loaded("import imp; imp.load_source('cli', 'matchengine.py')") == []
+
+    def test_worker_imports(self):
+
+        # a worker imports the engine with its first shard
+        assert self._loaded('import matchengine.shard') == []
+        assert self._loaded('import matchengine.utilities') == []
+
+        # and an idle worker on an in-memory database does not load pymongo either
+        assert self._loaded("from matchengine.utilities import get_db; from matchengine.shard import Worker; "
+                            "Worker(get_db('memory://')).run(exit_when_idle=True)") == []
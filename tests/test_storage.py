@@ -0,0 +1,126 @@
+"""Copyright 2016 Dana-Farber Cancer Institute"""
+
+import re
+import shutil
+import tempfile
+import unittest
+import datetime as dt
+
+from pymongo.errors import ExecutionTimeout
+
+from matchengine.storage import MemoryDatabase, match_query
+
+
+class TestStorage(unittest.TestCase):
+
+    def setUp(self):
+        self.db = MemoryDatabase()
+        self.db.genomic.insert_many([
+            {'SAMPLE_ID': 'S1', 'TRUE_HUGO_SYMBOL': 'EGFR', 'TRUE_PROTEIN_CHANGE': 'p.L858R', 'WILDTYPE': False,
+             'TRUE_EXON_CHANGE': 19, 'VARIANT_CATEGORY': 'MUTATION'},
+            {'SAMPLE_ID': 'S2', 'TRUE_HUGO_SYMBOL': 'BRAF', 'TRUE_PROTEIN_CHANGE': 'p.V600E', 'WILDTYPE': False,
+             'VARIANT_CATEGORY': 'MUTATION'},
+            {'SAMPLE_ID': 'S3', 'VARIANT_CATEGORY': 'SV', 'WILDTYPE': False,
+             'STRUCTURAL_VARIANT_COMMENT': 'EML4-ALK fusion', 'SV_GENES': ['EML4', 'ALK']},
+            {'SAMPLE_ID': 'S4', 'TRUE_HUGO_SYMBOL': 'EGFR', 'WILDTYPE': True, 'VARIANT_CATEGORY': 'MUTATION'}
+        ])
+
+    def test_match_query(self):
+
+        doc = {'a': 1, 'b': 'EGFR', 'c': [1, 2], 'd': None, 'e': {'f': 'x'}, 'g': True}
+
+        assert match_query(doc, {'a': 1})
+        assert match_query(doc, {'a': {'$eq': 1.0}})
+        assert not match_query(doc, {'g': 1})
+        assert match_query(doc, {'a': {'$ne': 2}, 'b': {'$in': ['EGFR', 'BRAF']}})
+        assert match_query(doc, {'b': {'$nin': ['BRAF']}, 'missing': {'$nin': ['BRAF']}})
+        assert match_query(doc, {'b': {'$regex': '^eg', '$options': 'i'}})
+        assert match_query(doc, {'b': {'$in': [re.compile('GF')]}})
+        assert not match_query(doc, {'a': {'$regex': '1'}})
+        assert match_query(doc, {'c': 2, 'e.f': 'x'})
+        assert match_query(doc, {'c': [1, 2]})
+        assert match_query(doc, {'c': {'$gt': 1, '$lt': 3}})
+        assert not match_query(doc, {'b': {'$gt': 1}})
+        assert match_query(doc, {'d': None, 'missing': None})
+        assert match_query(doc, {'missing': {'$exists': False}, 'a': {'$exists': True}})
+        assert match_query(doc, {'$or': [{'a': 2}, {'b': 'EGFR'}], '$and': [{'a': 1}]})
+        assert not match_query(doc, {'$nor': [{'a': 1}]})
+        assert match_query(doc, {'a': {'$not': {'$gt': 5}}})
+
+    def test_find(self):
+
+        # queries as prepare_genomic_criteria emits them
+        assert self.db.genomic.find({'TRUE_HUGO_SYMBOL': 'EGFR', 'WILDTYPE': False}).count() == 1
+        assert self.db.genomic.count({'TRUE_EXON_CHANGE': {'$ne': 19}}) == 3
+        assert sorted(self.db.genomic.find({'TRUE_HUGO_SYMBOL': {'$in': ['EGFR', 'BRAF']}}).distinct(
+            'SAMPLE_ID')) == ['S1', 'S2', 'S4']
+        assert sorted(self.db.genomic.distinct('SV_GENES')) == ['ALK', 'EML4']
+        assert self.db.genomic.find_one({'SV_GENES': 'ALK'})['SAMPLE_ID'] == 'S3'
+
+        # projections
+        doc = self.db.genomic.find_one({'SAMPLE_ID': 'S1'}, {'TRUE_HUGO_SYMBOL': 1})
+        assert sorted(doc.keys()) == ['TRUE_HUGO_SYMBOL', '_id']
+        doc = self.db.genomic.find_one({'SAMPLE_ID': 'S1'}, {'TRUE_HUGO_SYMBOL': 1, '_id': 0})
+        assert doc.keys() == ['TRUE_HUGO_SYMBOL']
+        doc = self.db.genomic.find_one({'SAMPLE_ID': 'S1'}, {'TRUE_HUGO_SYMBOL': 0})
+        assert 'TRUE_HUGO_SYMBOL' not in doc and 'SAMPLE_ID' in doc
+
+        # results are copies
+        doc['SAMPLE_ID'] = 'changed'
+        assert self.db.genomic.count({'SAMPLE_ID': 'changed'}) == 0
+
+        # sorting and limits
+        ids = [d['SAMPLE_ID'] for d in self.db.genomic.find().sort('SAMPLE_ID', -1).limit(2)]
+        assert ids == ['S4', 'S3']
+
+    def test_max_time_ms(self):
+
+        self.db.scan.insert_many([{'SAMPLE_ID': 'S%d' % i, 'COMMENT': 'x' * 100} for i in range(20000)])
+        query = {'COMMENT': {'$regex': 'y'}}
+
+        # a scan that runs over its time limit fails as in Mongo
+        assert list(self.db.scan.find(query).max_time_ms(10000)) == []
+        with self.assertRaises(ExecutionTimeout):
+            list(self.db.scan.find(query).max_time_ms(1))
+        with self.assertRaises(ExecutionTimeout):
+            self.db.scan.find(query).max_time_ms(1).distinct('SAMPLE_ID')
+
+    def test_write(self):
+
+        # inserts set the _id on the document like pymongo
+        doc = {'SAMPLE_ID': 'S5'}
+        self.db.genomic.insert_one(doc)
+        assert '_id' in doc
+        assert self.db.genomic.find_one(doc['_id'])['SAMPLE_ID'] == 'S5'
+
+        # updates
+        self.db.genomic.update_one({'SAMPLE_ID': 'S5'}, {'$set': {'WILDTYPE': True}, '$inc': {'n': 2}})
+        assert self.db.genomic.find_one({'SAMPLE_ID': 'S5'})['n'] == 2
+        self.db.genomic.update_one({'SAMPLE_ID': 'S6'}, {'$addToSet': {'tags': 'a'}}, upsert=True)
+        self.db.genomic.update_one({'SAMPLE_ID': 'S6'}, {'$addToSet': {'tags': 'a'}}, upsert=True)
+        assert self.db.genomic.find_one({'SAMPLE_ID': 'S6'})['tags'] == ['a']
+        self.db.genomic.replace_one({'_id': 'key'}, {'plan': 1}, upsert=True)
+        assert self.db.genomic.find_one('key')['plan'] == 1
+
+        doc = self.db.genomic.find_one_and_update({'SAMPLE_ID': 'S6'}, {'$set': {'claimed': True}})
+        assert 'claimed' not in doc
+        assert self.db.genomic.find_one({'SAMPLE_ID': 'S6'})['claimed']
+
+        # deletes
+        assert self.db.genomic.delete_many({'SAMPLE_ID': {'$in': ['S5', 'S6']}}).deleted_count == 2
+        self.db.genomic.drop()
+        assert self.db.genomic.count() == 0
+
+    def test_persistence(self):
+
+        path = tempfile.mkdtemp()
+        try:
+            db = MemoryDatabase(path=path)
+            db.clinical.insert_one({'SAMPLE_ID': 'S1', 'BIRTH_DATE': dt.datetime(1970, 1, 1)})
+            db.save()
+
+            db = MemoryDatabase(path=path)
+            assert db.collection_names() == ['clinical']
+            assert db.clinical.find_one({'BIRTH_DATE': {'$lte': dt.datetime(1980, 1, 1)}})['SAMPLE_ID'] == 'S1'
+        finally:
+            shutil.rmtree(path)
@@ -0,0 +1,121 @@
+"""Copyright 2016 Dana-Farber Cancer Institute"""
+
+import unittest
+
+from matchengine.storage import MemoryDatabase
+from matchengine.summary import summary_key, summarizable, update_summary, rebuild_summary, summary_is_current, \
+    summary_sample_ids, SUMMARY_COLLECTION
+from tests import TestSetUp
+
+
+class TestSummary(unittest.TestCase):
+
+    def setUp(self):
+        self.db = MemoryDatabase()
+        self.genomic = [
+            {'SAMPLE_ID': 'S1', 'TRUE_HUGO_SYMBOL': 'EGFR', 'VARIANT_CATEGORY': 'MUTATION', 'WILDTYPE': False,
+             'TRUE_PROTEIN_CHANGE': 'p.L858R', 'TRUE_VARIANT_CLASSIFICATION': 'Missense_Mutation'},
+            {'SAMPLE_ID': 'S1', 'TRUE_HUGO_SYMBOL': 'EGFR', 'VARIANT_CATEGORY': 'MUTATION', 'WILDTYPE': False,
+             'TRUE_PROTEIN_CHANGE': 'p.T790M', 'TRUE_VARIANT_CLASSIFICATION': 'Missense_Mutation'},
+            {'SAMPLE_ID': 'S2', 'TRUE_HUGO_SYMBOL': 'EGFR', 'VARIANT_CATEGORY': 'MUTATION', 'WILDTYPE': False,
+             'TRUE_PROTEIN_CHANGE': 'p.G719A', 'TRUE_VARIANT_CLASSIFICATION': 'Missense_Mutation'},
+            {'SAMPLE_ID': 'S3', 'TRUE_HUGO_SYMBOL': 'EGFR', 'VARIANT_CATEGORY': 'CNV', 'CNV_CALL': 'Gain'},
+            {'SAMPLE_ID': 'S4', 'TRUE_HUGO_SYMBOL': 'EGFR', 'VARIANT_CATEGORY': 'CNV', 'CNV_CALL': 'Gain',
+             'WILDTYPE': None}
+        ]
+        self.db.genomic.insert_many(self.genomic)
+        update_summary(self.db, self.genomic)
+
+    def test_update_summary(self):
+
+        docs = list(self.db[SUMMARY_COLLECTION].find())
+        assert len(docs) == 3
+        assert summary_is_current(self.db)
+
+        mutation = self.db[SUMMARY_COLLECTION].find_one({'VARIANT_CATEGORY': 'MUTATION'})
+        assert mutation['SAMPLE_IDS'] == ['S1', 'S2']
+        assert mutation['n_samples'] == 2 and mutation['n_documents'] == 3
+
+        # a missing field is told apart from a null field
+        assert summary_key(self.genomic[3]) != summary_key(self.genomic[4])
+
+        # loading more documents updates their keys only
+        new = [{'SAMPLE_ID': 'S5', 'TRUE_HUGO_SYMBOL': 'EGFR', 'VARIANT_CATEGORY': 'CNV', 'CNV_CALL': 'Gain'}]
+        self.db.genomic.insert_many(new)
+        assert not summary_is_current(self.db)
+        update_summary(self.db, new)
+        assert summary_is_current(self.db)
+        gain = self.db[SUMMARY_COLLECTION].find_one({'CNV_CALL': 'Gain', 'WILDTYPE': {'$exists': False}})
+        assert gain['SAMPLE_IDS'] == ['S3', 'S5']
+
+        # removing documents removes keys without documents left
+        docs = list(self.db.genomic.find({'SAMPLE_ID': {'$in': ['S3', 'S5']}}))
+        self.db.genomic.delete_many({'SAMPLE_ID': {'$in': ['S3', 'S5']}})
+        update_summary(self.db, docs)
+        assert self.db[SUMMARY_COLLECTION].count() == 2
+        assert summary_is_current(self.db)
+
+        rebuild_summary(self.db)
+        assert self.db[SUMMARY_COLLECTION].count() == 2
+
+    def test_summary_is_current(self):
+
+        # edits and removals offset by as many inserts leave the count unchanged, but not the summary
+        self.db.genomic.update_one({'SAMPLE_ID': 'S2'}, {'$set': {'TRUE_HUGO_SYMBOL': 'BRAF'}})
+        assert not summary_is_current(self.db)
+        rebuild_summary(self.db)
+        assert summary_is_current(self.db)
+
+        self.db.genomic.delete_one({'SAMPLE_ID': 'S3'})
+        self.db.genomic.insert_one({'SAMPLE_ID': 'S5', 'TRUE_HUGO_SYMBOL': 'EGFR', 'VARIANT_CATEGORY': 'CNV',
+                                    'CNV_CALL': 'Gain'})
+        assert not summary_is_current(self.db)
+        rebuild_summary(self.db)
+        assert summary_is_current(self.db)
+
+    def test_summary_queries(self):
+
+        # the wildtype clause excludes null wildtype calls on the genomic documents and the summary alike
+        g = {'$and': [{'TRUE_HUGO_SYMBOL': {'$eq': 'EGFR'}},
+                      {'$or': [{'WILDTYPE': False}, {'WILDTYPE': {'$exists': False}}]}]}
+        assert summarizable(g)
+        assert summary_sample_ids(self.db, g) == set(self.db.genomic.find(g).distinct('SAMPLE_ID'))
+        assert summary_sample_ids(self.db, g) == set(['S1', 'S2', 'S3'])
+
+        # and restricted to a range of sample ids
+        assert summary_sample_ids(self.db, g, {'min': 'S2', 'max': 'S3'}) == set(['S2'])
+        assert summary_sample_ids(self.db, g, {'min': 'S2', 'max': None}) == set(['S2', 'S3'])
+
+        # criteria on fields the summary does not have
+        assert not summarizable({'TRUE_HUGO_SYMBOL': 'EGFR', 'TRUE_PROTEIN_CHANGE': 'p.L858R'})
+        assert not summarizable({})
+
+
+class TestSummaryMatching(TestSetUp):
+
+    def tearDown(self):
+        self.db.clinical.drop()
+        self.db.genomic.drop()
+        self.db.trial.drop()
+        self.db.genomic_summary.drop()
+
+    def test_negative_leaves(self):
+
+        self.add_clinical()
+        self.add_genomic()
+        item = {'hugo_symbol': '!BRAF'}
+        node = {'type': 'genomic', 'value': item}
+
+        # without a summary the genomic collection is queried
+        leaf = self.me.compile_leaf(node)
+        assert leaf['neg'] and leaf['summary']
+        expected, _ = self.me.run_query(node)
+        assert not self.me.summary_is_current()
+
+        # with a current summary the same samples match
+        rebuild_summary(self.db)
+        self.me._summary_current = None
+        matched, _ = self.me.run_query(node)
+        assert self.me.summary_is_current()
+        assert matched == expected
+        assert self.sample_id not in matched
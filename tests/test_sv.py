@@ -1,5 +1,7 @@
 import datetime as dt
 
+from matchengine.utilities import annotate_genomic
+from matchengine.engine import MatchEngine
 from tests import TestSetUp
 
 
@@ -142,3 +144,38 @@ class TestSV(TestSetUp):
         # add sample id to trial_matches dictionary
         t = self.me._assess_match(mrn_map, trial_matches, trial, trial_segment, match_segment, 'open')
         assert len(t) == 1
+
+    def test_sv_genes(self):
+
+        # documents annotated by the loader are found through their gene tokens
+        for item in self.db.genomic.find():
+            self.db.genomic.replace_one({'_id': item['_id']}, annotate_genomic(item))
+        self.db.genomic.insert_one({
+            "SAMPLE_ID": "MATCH",
+            "VARIANT_CATEGORY": "SV",
+            "STRUCTURAL_VARIANT_COMMENT": "Tokens win over the comment: NTRK1",
+            "SV_GENES": ["TOKENS"]
+        })
+
+        g, neg, sv = self.me.prepare_genomic_criteria({'HUGO_SYMBOL': 'NTRK3', 'VARIANT_CATEGORY': 'SV'})
+        assert sv
+        assert self.db.genomic.count(g) == 1
+
+        g, neg, sv = self.me.prepare_genomic_criteria({'HUGO_SYMBOL': 'NTRK1', 'VARIANT_CATEGORY': 'SV'})
+        assert self.db.genomic.count(g) == 0
+
+    def test_sv_annotated(self):
+
+        # a comment without gene tokens is searched by regex, annotated comments through their tokens
+        mrn_map = dict(zip(["MATCH"], ["MRN00"]))
+        trial = self.db.trial.find_one({'protocol_no': '00-000'})
+        trial_segment = trial['treatment_list']['step'][0]['arm'][1]
+        assert not self.me.sv_genes_is_current()
+
+        for item in self.db.genomic.find():
+            self.db.genomic.replace_one({'_id': item['_id']}, annotate_genomic(item))
+        me = MatchEngine(self.db)
+        assert me.sv_genes_is_current()
+
+        t = me._assess_match(mrn_map, [], trial, trial_segment, 'arm', 'open')
+        assert len(t) == 1
@@ -0,0 +1,67 @@
+"""Copyright 2016 Dana-Farber Cancer Institute"""
+
+import os
+import datetime as dt
+import shutil
+import tempfile
+import unittest
+
+from matchengine.synthetic import generate_cohort, generate_trials, write_cohort, write_trials
+
+
+class TestSynthetic(unittest.TestCase):
+
+    def test_cohort(self):
+
+        today = dt.datetime(2018, 1, 1)
+        clinical, genomic = generate_cohort(200, seed=3, today=today)
+        assert len(clinical) == 200
+        assert len(genomic) > 0
+
+        # deterministic
+        clinical2, genomic2 = generate_cohort(200, seed=3, today=today)
+        assert clinical == clinical2
+        assert [g['TRUE_HUGO_SYMBOL'] for g in genomic] == [g['TRUE_HUGO_SYMBOL'] for g in genomic2]
+        assert [g['CLINICAL_ID'] for g in genomic] == [g['CLINICAL_ID'] for g in genomic2]
+
+        # every genomic document belongs to a sample
+        sample_ids = set(c['SAMPLE_ID'] for c in clinical)
+        assert set(g['SAMPLE_ID'] for g in genomic) <= sample_ids
+
+        # all variant categories are present
+        assert set(g['VARIANT_CATEGORY'] for g in genomic) == set(['MUTATION', 'CNV', 'SV'])
+
+        # samples per patient
+        clinical, _ = generate_cohort(10, samples_per_patient=2)
+        assert len(clinical) == 20
+        assert len(set(c['MRN'] for c in clinical)) == 10
+
+    def test_trials(self):
+
+        trials = generate_trials(20, seed=3)
+        assert len(trials) == 20
+        assert len(set(t['protocol_no'] for t in trials)) == 20
+        assert [t['protocol_no'] for t in trials] == [t['protocol_no'] for t in generate_trials(20, seed=3)]
+
+        # every trial has at least one match clause
+        for trial in trials:
+            arms = trial['treatment_list']['step'][0]['arm']
+            n = sum(1 for arm in arms if 'match' in arm) + sum(len(arm['dose_level']) for arm in arms)
+            assert n > 0
+
+            # protocol numbers are sortable by the sort order logic
+            int(trial['protocol_no'].split('-')[0])
+
+    def test_write(self):
+
+        tmp = tempfile.mkdtemp()
+        try:
+            clinical, genomic = generate_cohort(10)
+            write_cohort(clinical, genomic, os.path.join(tmp, 'clinical.csv'), os.path.join(tmp, 'genomic.csv'))
+            write_trials(generate_trials(3), os.path.join(tmp, 'trials'))
+
+            with open(os.path.join(tmp, 'clinical.csv')) as f:
+                assert len(f.readlines()) == 11
+            assert len(os.listdir(os.path.join(tmp, 'trials'))) == 3
+        finally:
+            shutil.rmtree(tmp)
@@ -33,6 +33,39 @@ class TestUtilities(TestSetUp):
         assert mrn_map == {self.sample_id: self.mrn}, 'MRN MAP: %s\nMRN: %s\nSAMPLE_ID: %s' % (
             mrn_map, self.mrn, self.sample_id)
 
+    def test_sample_partitions(self):
+
+        sample_ids = sorted(self.sample_ids)
+        partitions = sample_partitions(self.db, 4)
+        assert partitions == [
+            {'min': None, 'max': sample_ids[4]},
+            {'min': sample_ids[4], 'max': sample_ids[8]},
+            {'min': sample_ids[8], 'max': None}
+        ]
+        assert sample_partitions(self.db, 100) == [{'min': None, 'max': None}]
+
+    def test_oncotree_ancestry(self):
+
+        onco_tree = build_oncotree()
+        ancestry = oncotree_ancestry(onco_tree, 'Glioblastoma')
+        assert set(['GB', 'DIFG', 'BRAIN']) <= set(ancestry['ONCOTREE_ANCESTORS'])
+        assert ancestry['IS_SOLID'] and not ancestry['IS_LIQUID']
+
+        ancestry = oncotree_ancestry(onco_tree, 'Chronic Lymphocytic Leukemia')
+        assert set(['CLL', 'LEUK', 'BLOOD']) <= set(ancestry['ONCOTREE_ANCESTORS'])
+        assert ancestry['IS_LIQUID'] and not ancestry['IS_SOLID']
+
+        empty = {'ONCOTREE_ANCESTORS': [], 'IS_SOLID': False, 'IS_LIQUID': False}
+        assert oncotree_ancestry(onco_tree, 'Not A Diagnosis') == empty
+        assert oncotree_ancestry(onco_tree, None) == empty
+
+        # every clinical document is updated once
+        assert not ancestry_is_current(self.db)
+        assert update_ancestry(self.db, onco_tree) == len(self.clinical)
+        assert update_ancestry(self.db, onco_tree) == 0
+        assert ancestry_is_current(self.db)
+        assert self.db.clinical.count({'ONCOTREE_ANCESTORS': 'BRAIN'}) == 4
+
     def test_get_months(self):
 
         self.today = self.today.replace(year=2016, month=11, day=3)
@@ -364,6 +397,85 @@ class TestUtilities(TestSetUp):
         tcc = get_coordinating_center(trial)
         assert tcc == 'Massachusetts General Hospital'
 
+    def test_sv_gene_tokens(self):
+        comment = 'An ETV6-ntrk3 fusion is identified (chr12:12035285 to chr15:88559895). '
+        tokens = sv_gene_tokens(comment)
+        assert 'ETV6' in tokens and 'NTRK3' in tokens
+        assert '12035285' not in tokens
+        assert sv_gene_tokens(None) == []
+
+        item = annotate_genomic({'STRUCTURAL_VARIANT_COMMENT': comment})
+        assert item['SV_GENES'] == tokens
+        assert annotate_genomic({'TRUE_HUGO_SYMBOL': 'EGFR'})['SV_GENES'] == []
+
+    def test_get_structural_variants(self):
+        g = get_structural_variants({'TRUE_HUGO_SYMBOL': {'$in': ['NTRK1', 'ntrk3']}, 'VARIANT_CATEGORY': 'SV'})
+        assert 'TRUE_HUGO_SYMBOL' not in g
+        assert g == {'SV_GENES': {'$in': ['NTRK1', 'NTRK3']}, 'VARIANT_CATEGORY': 'SV'}
+
+        # symbols with punctuation are found through their tokens, then matched by regex
+        g = get_structural_variants({'TRUE_HUGO_SYMBOL': {'$eq': 'NKX2-1'}, 'VARIANT_CATEGORY': 'SV'})
+        assert g['SV_GENES'] == {'$in': ['NKX2']}
+        assert g['STRUCTURAL_VARIANT_COMMENT']['$in'][0].search('A NKX2-1 fusion')
+        assert not g['STRUCTURAL_VARIANT_COMMENT']['$in'][0].search('A NKX2-2 fusion')
+
+        # without tokens the comment alone is matched by regex
+        g = get_structural_variants({'TRUE_HUGO_SYMBOL': {'$in': ['NTRK1']}, 'VARIANT_CATEGORY': 'SV'}, tokens=False)
+        assert 'SV_GENES' not in g
+        assert g['STRUCTURAL_VARIANT_COMMENT']['$in'][0].search('An ETV6-NTRK1 fusion')
+
+    def test_create_load_indexes(self):
+        create_load_indexes(self.db)
+        for collection, keys in LOAD_INDEXES:
+            assert keys in [index['key'] for index in self.db[collection].index_information().values()]
+
+    def test_update_sv_genes(self):
+        self.db.genomic.drop()
+        self.db.genomic.insert_many([
+            {'SAMPLE_ID': 'S1', 'STRUCTURAL_VARIANT_COMMENT': 'An EML4-ALK fusion'},
+            {'SAMPLE_ID': 'S2', 'TRUE_HUGO_SYMBOL': 'EGFR'},
+            {'SAMPLE_ID': 'S3', 'STRUCTURAL_VARIANT_COMMENT': 'A RET fusion', 'SV_GENES': ['RET']}
+        ])
+
+        # documents loaded before the tokens were added get them, and every document has the field
+        assert not sv_genes_is_current(self.db)
+        assert update_sv_genes(self.db) == 2
+        assert update_sv_genes(self.db) == 0
+        assert sv_genes_is_current(self.db)
+        assert self.db.genomic.find_one({'SAMPLE_ID': 'S1'})['SV_GENES'] == ['ALK', 'AN', 'EML4', 'FUSION']
+        assert self.db.genomic.find_one({'SAMPLE_ID': 'S2'})['SV_GENES'] == []
+        assert self.db.genomic.count({'SV_GENES': {'$exists': False}}) == 0
+
+    def test_protein_codon(self):
+        assert protein_codon('p.G719A') == ('G719', 719)
+        assert protein_codon('p.G719Dfs*12') == ('G719', 719)
+        assert protein_codon('p.G719_K720del') == (None, None)
+        assert protein_codon(None) == (None, None)
+
+        item = annotate_genomic({'TRUE_PROTEIN_CHANGE': 'p.V600E'})
+        assert item['TRUE_PROTEIN_CODON'] == 'V600'
+        assert item['TRUE_PROTEIN_POSITION'] == 600
+
+    def test_indexed_genomic_query(self):
+        regex = {'$regex': '^p.V600[A-Z]'}
+        g = {'$and': [
+            {'TRUE_HUGO_SYMBOL': {'$eq': 'BRAF'}, 'TRUE_PROTEIN_CHANGE': regex},
+            {'$or': [{'WILDTYPE': False}, {'WILDTYPE': {'$exists': False}}]}
+        ]}
+        q = indexed_genomic_query(g)
+
+        # the logical query is left untouched for formatting
+        assert g['$and'][0]['TRUE_PROTEIN_CHANGE'] == regex
+        assert q['$and'][1] == g['$and'][1]
+        assert q['$and'][0] == {'TRUE_HUGO_SYMBOL': {'$eq': 'BRAF'}, '$or': [
+            {'TRUE_PROTEIN_CODON': 'V600'},
+            {'TRUE_PROTEIN_CODON': {'$exists': False}, 'TRUE_PROTEIN_CHANGE': regex}
+        ]}
+
+        # exact protein changes are not rewritten
+        g = {'TRUE_PROTEIN_CHANGE': {'$eq': 'p.V600E'}}
+        assert indexed_genomic_query(g) == g
+
     def _assert_age(self, bd, age, month=None):
 
         if month: